@@ -2,6 +2,7 @@
 import sys
 import os
 import re
+import seq_io
 
 
 # fasta text is streamed in , and each sequence name is edited using the 
@@ -17,17 +18,19 @@ def main():
     match = re.match("^([^\.]+)\.", os.path.basename(sample_file_name))
     if match is None:
         raise Exception("unable to parse sample id from %s"%os.path.basename(sample_file_name))
-    sample = match.groups()[0]
+    sample = match.groups()[0].encode()
  
+    out_stream = seq_io.open_output()
     seq_number = 1
-    for record in sys.stdin:
-        match = re.match("^>(\S+)", record )
-        if match is not None:
-            illumina_moniker = match.groups()[0]
-            sys.stdout.write(">%s.%09d %s\n"%(sample, seq_number, illumina_moniker))
+    for record in seq_io.line_iter(seq_io.open_input("-")):
+        # (as the regular expression ^>(\S+) used to - a name line needs a non-space after the >)
+        if record[0:1] == b">" and len(record) > 1 and not record[1:2].isspace():
+            illumina_moniker = record[1:].split(None, 1)[0]
+            out_stream.write(b">" + sample + b"." + str(seq_number).zfill(9).encode() + b" " + illumina_moniker + b"\n")
             seq_number += 1
         else:
-            sys.stdout.write(record)
+            out_stream.write(record + b"\n")
+    out_stream.flush()
 
 if __name__ == "__main__":
    main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import gzip
+import json
+import time
+import glob
+import random
+import bisect
+import socket
+import platform
+import subprocess
+import argparse
+
+#
+# synthetic-data benchmarks of the python (and shell) hot paths of melseq_prism.
+#
+# generate writes a realistic data set of a configurable size (all from a seeded random number generator, so
+# no network or reference data is needed) :
+#
+# * a GTDB-shaped taxonomy csv (as written by gtdb/format_database.py -t format_taxonomy)
+# * for each sample, trimmed PstI-tag fastq (reads start with the TGCAG remnant of the cut site), with a skewed
+#   (zipf-like) abundance of tags and a small rate of sequencing errors, so there is a long tail of singletons. Also the
+#   same reads as fasta, the non-redundant fasta, and the non-redundant fasta of each of two lanes
+# * for each sample, blast results (-outfmt '6 std qlen') for the non-redundant fasta, with several hits for most
+#   queries (mostly from the same genus as the source genome), some with no hits and some below the bitscore cutoff
+#
+# run times each benchmark (the median of several repeats) and writes the results as json, which can be kept
+# as a baseline - and compare compares two such results files, flagging benchmarks that have become slower.
+#
+# Benchmarks that fail (e.g. as a dependency such as seq_prisms/data_prism.py is not available) are recorded as
+# failed, with the tail of the error output, rather than stopping the run. profile_prism.py (like data_prism) only
+# runs under python 2, so it is run with a separate python 2 interpreter (-2) - if there is none, its benchmarks are
+# recorded as skipped
+#
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DATA_MANIFEST = "benchmark_data.json"
+RUN_NAME = "BENCH01_HBENCHDRX1"
+PSTI_REMNANT = "TGCAG"
+BASES = "ACGT"
+RANK_PREFIXES = ["", "p", "c", "o", "f", "g", "s"]
+PYTHON2_NAMES = ["python2", "python2.7"]
+
+
+class benchmark_exception(Exception):
+    def __init__(self,args=None):
+        super(benchmark_exception, self).__init__(args)
+
+
+def weighted_choice_iter(rng, weights, count):
+    cumulative = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    for i in range(count):
+        yield bisect.bisect_left(cumulative, rng.random() * total)
+
+
+def random_sequence(rng, length):
+    return "".join(rng.choice(BASES) for i in range(length))
+
+
+def generate_taxonomy(rng, num_genomes):
+    """
+    a random taxonomy tree, with genomes assigned to species. Returns a list of (accession, lineage) and a dictionary
+    of genus => genome numbers
+    """
+    genomes = []
+    genera = {}
+    lineage_parents = [("Bacteria",), ("Archaea",)]
+    # branch each rank, so that there are roughly num_genomes / 2 species
+    branching = max(2, int(round((num_genomes / 4.0) ** (1.0 / 6))))
+    for rank in range(1, 7):
+        lineages = []
+        for parent in lineage_parents:
+            for i in range(rng.randint(1, 2 * branching - 1)):
+                if rank == 6:
+                    name = "%s sp%06d" % (parent[5].split("__")[-1], len(lineages))
+                else:
+                    name = "%s__%s%d" % (RANK_PREFIXES[rank], parent[-1].split("__")[-1][0:3], len(lineages))
+                lineages.append(parent + (name,))
+        lineage_parents = lineages
+
+    for genome in range(num_genomes):
+        lineage = list(rng.choice(lineage_parents))
+        if rng.random() < 0.05:
+            lineage[6] = "NA"      # some genomes are not assigned to a species
+        accession = "%s_%09d.1" % (rng.choice(["GCA", "GCF"]), genome + 1)
+        genomes.append((accession, tuple(lineage)))
+        genera.setdefault(lineage[5], []).append(genome)
+    return (genomes, genera)
+
+
+def write_taxonomy(genomes, taxonomy_file):
+    with open(taxonomy_file, "w") as tax_stream:
+        print("ID,Species,Genus,T_Kingdom,T_Phylum,T_Class,T_Order,T_Family,T_Genus,T_Species", file=tax_stream)
+        for (accession, lineage) in genomes:
+            print(",".join((accession, lineage[6], lineage[5]) + lineage), file=tax_stream)
+
+
+def mutate(rng, seq):
+    position = rng.randint(len(PSTI_REMNANT), len(seq) - 1)
+    return seq[0:position] + rng.choice([base for base in BASES if base != seq[position]]) + seq[position + 1:]
+
+
+def write_non_redundant_fasta(counts, filename):
+    with open(filename, "w") as fasta_stream:
+        for (number, seq) in enumerate(sorted(counts)):
+            fasta_stream.write(">Sequence%d_count=%d\n%s\n" % (number + 1, counts[seq], seq))
+
+
+def write_blast_results(rng, counts, tag_of_seq, tag_genomes, genomes, genera, results_file):
+    """
+    tabular blast results for the non-redundant fasta with the given counts - returns the number of hit records
+    """
+    hit_records = 0
+    with gzip.open(results_file, "wt") if sys.version_info[0] >= 3 else gzip.open(results_file, "w") as results_stream:
+        for (number, seq) in enumerate(sorted(counts)):
+            qseqid = "Sequence%d_count=%d" % (number + 1, counts[seq])
+            draw = rng.random()
+            if draw < 0.08:
+                continue              # no hits
+            true_genome = tag_genomes[tag_of_seq[seq]]
+            qlen = len(seq)
+            if draw < 0.11:
+                length = rng.randint(15, 25)      # a short hit, which is below the bitscore cutoff
+            else:
+                length = qlen - rng.randint(0, 3)
+            best_bitscore = 1.85 * length - rng.uniform(0, 5)
+            same_genus = genera[genomes[true_genome][1][5]]
+            hit_genomes = [true_genome]
+            for i in range(min(19, int(rng.expovariate(1.0 / 4)))):
+                hit_genomes.append(rng.choice(same_genus) if rng.random() < 0.8 else rng.randint(0, len(genomes) - 1))
+            for (i, genome) in enumerate(hit_genomes):
+                bitscore = best_bitscore if i == 0 else best_bitscore * rng.uniform(0.8, 1.0)
+                mismatch = 0 if i == 0 else rng.randint(0, 4)
+                sseqid = "GTDB1:%s_NZ_CONTIG%06d.1" % (genomes[genome][0], genome)
+                sstart = rng.randint(1, 2000000)
+                results_stream.write("%s\t%s\t%.3f\t%d\t%d\t0\t1\t%d\t%d\t%d\t%.2e\t%.1f\t%d\n" % (qseqid, sseqid, 100.0 * (length - mismatch) / length,
+                    length, mismatch, length, sstart, sstart + length - 1, 10 ** -(bitscore / 10.0), bitscore, qlen))
+                hit_records += 1
+    return hit_records
+
+
+def generate(options):
+    rng = random.Random(options["seed"])
+    data_folder = options["data_folder"]
+    for folder in ("taxonomy", "trimming", "fasta", "lanes", "blast"):
+        if not os.path.isdir(os.path.join(data_folder, folder)):
+            os.makedirs(os.path.join(data_folder, folder))
+
+    (genomes, genera) = generate_taxonomy(rng, options["num_genomes"])
+    write_taxonomy(genomes, os.path.join(data_folder, "taxonomy", "taxonomy.csv"))
+
+    # the reference tags, each from a genome (a few genomes contribute many of the tags)
+    tags = [PSTI_REMNANT + random_sequence(rng, rng.randint(35, 95)) for i in range(options["num_tags"])]
+    genome_weights = [1.0 / (rank + 1) for rank in range(len(genomes))]
+    tag_genomes = list(weighted_choice_iter(rng, genome_weights, len(tags)))
+    tag_weights = [1.0 / (rank + 1) ** options["zipf_exponent"] for rank in range(len(tags))]
+
+    totals = {"reads": 0, "unique_sequences": 0, "blast_records": 0, "samples": options["num_samples"]}
+    for sample_number in range(options["num_samples"]):
+        sample = "%06d_%s_psti" % (966001 + sample_number, random_sequence(rng, 10))
+        sample_base = "%s_s_merged_fastq.txt.gz.demultiplexed_%s.R1_trimmed.fastq" % (RUN_NAME, sample)
+
+        # each sample has its own abundances, varying about the shared skewed distribution
+        sample_weights = [weight * rng.lognormvariate(0, 1) for weight in tag_weights]
+        counts = {}
+        lane_counts = ({}, {})
+        tag_of_seq = {}
+        with open(os.path.join(data_folder, "trimming", sample_base), "w") as fastq_stream, open(os.path.join(data_folder, "fasta", "%s.fasta" % sample_base), "w") as fasta_stream:
+            for (read_number, tag) in enumerate(weighted_choice_iter(rng, sample_weights, options["reads_per_sample"])):
+                seq = tags[tag]
+                if rng.random() < options["error_rate"]:
+                    seq = mutate(rng, seq)
+                tag_of_seq[seq] = tag
+                counts[seq] = counts.get(seq, 0) + 1
+                lane = rng.randint(0, 1)
+                lane_counts[lane][seq] = lane_counts[lane].get(seq, 0) + 1
+                read_name = "A01439:%d:HBENCHDRX1:%d:%d:%d:%d" % (sample_number + 1, lane + 1, 1101 + read_number % 1000, read_number % 32000, read_number // 32000)
+                fastq_stream.write("@%s 1:N:0:%s\n%s\n+\n%s\n" % (read_name, sample.split("_")[1], seq, "F" * len(seq)))
+                fasta_stream.write(">%s\n%s\n" % (read_name, seq))
+
+        write_non_redundant_fasta(counts, os.path.join(data_folder, "fasta", "%s.non-redundant.fasta" % sample_base))
+        for lane in (0, 1):
+            lane_base = sample_base.replace("_s_merged_fastq", "_s_%d_fastq" % (lane + 1))
+            write_non_redundant_fasta(lane_counts[lane], os.path.join(data_folder, "lanes", "%s.non-redundant.fasta" % lane_base))
+        totals["blast_records"] += write_blast_results(rng, counts, tag_of_seq, tag_genomes, genomes, genera, os.path.join(data_folder, "blast", "%s.non-redundant.fasta.blastn.GTDB1.results.gz" % sample_base))
+
+        totals["reads"] += options["reads_per_sample"]
+        totals["unique_sequences"] += len(counts)
+        print("generated sample %s (%d reads, %d unique sequences)" % (sample, options["reads_per_sample"], len(counts)), file=sys.stderr)
+
+    manifest = {
+        "seed": options["seed"],
+        "num_samples": options["num_samples"],
+        "reads_per_sample": options["reads_per_sample"],
+        "num_tags": options["num_tags"],
+        "num_genomes": options["num_genomes"],
+        "error_rate": options["error_rate"],
+        "zipf_exponent": options["zipf_exponent"],
+        "totals": totals
+    }
+    with open(os.path.join(data_folder, DATA_MANIFEST), "w") as manifest_stream:
+        json.dump(manifest, manifest_stream, indent=2, sort_keys=True)
+    print("wrote benchmark data to %s : %s" % (data_folder, json.dumps(totals, sort_keys=True)), file=sys.stderr)
+
+
+def get_default_python2():
+    """
+    the first python 2 interpreter on the path, or None
+    """
+    for folder in os.environ.get("PATH", "").split(os.pathsep):
+        for name in PYTHON2_NAMES:
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+
+def get_benchmarks(data_folder, work_folder, python, python2):
+    """
+    the benchmarks, in the order they are run (later benchmarks use the output of earlier ones - e.g. profile_prism.py
+    summarises the summaries written by summarize_counts.py). Each is (name, commands, the totals field giving the number
+    of items processed) - the commands are None for the python 2 only benchmarks if there is no python 2 interpreter
+    """
+    def data_files(folder, pattern):
+        return sorted(glob.glob(os.path.join(data_folder, folder, pattern)))
+
+    def work_path(*names):
+        return os.path.join(work_folder, *names)
+
+    script = lambda name: os.path.join(REPO_ROOT, name)
+    fastq_files = data_files("trimming", "*_trimmed.fastq")
+    read_fasta_files = data_files("fasta", "*_trimmed.fastq.fasta")
+    nr_fasta_files = data_files("fasta", "*.non-redundant.fasta")
+    results_files = data_files("blast", "*.results.gz")
+    taxonomy_file = os.path.join(data_folder, "taxonomy", "taxonomy.csv")
+    taxonomy_index_file = work_path("taxonomy.idx")
+    summaries = lambda folder: [work_path(folder, re.sub("\.results\.gz$", ".summary", os.path.basename(filename))) for filename in results_files]
+
+    return [
+        ("add_sample_name", ["%s %s %s < %s > %s" % (python, script("add_sample_name.py"), os.path.basename(fastq_file), read_fasta_file, work_path("named.fasta"))
+            for (fastq_file, read_fasta_file) in zip(fastq_files, read_fasta_files)], "reads"),
+        ("countUniqueReads", ["%s %s < %s > %s" % (script("countUniqueReads.sh"), work_path("sort_temp"), read_fasta_file, work_path("countUniqueReads.fasta"))
+            for read_fasta_file in read_fasta_files], "reads"),
+        ("dereplicate_fastq", ["%s %s -T %s -o %s %s" % (python, script("dereplicate_fastq.py"), work_path("sort_temp"), work_path("dereplicate_fastq.fasta"), fastq_file)
+            for fastq_file in fastq_files], "reads"),
+        ("global_dereplicate_build_catalogue", ["%s %s -t build_catalogue -O %s %s" % (python, script("global_dereplicate.py"), work_path("catalogue"), " ".join(nr_fasta_files))], "unique_sequences"),
+        ("count_non_redundant_fasta", ["%s %s < %s" % (python, script("count_non_redundant_fasta.py"), nr_fasta_file) for nr_fasta_file in nr_fasta_files], "unique_sequences"),
+        ("count_blast", ["gunzip -c %s | %s %s" % (results_file, python, script("count_blast.py")) for results_file in results_files], "blast_records"),
+        ("merge_lanes", ["%s %s -t generate_merge_non_redundant_commands -M %s -O %s %s" % (python, script("merge_lanes.py"), work_path("merged_fasta"), work_path("merge_lanes_commands.txt"), work_path("lanes_file_list.txt")),
+            "sed 's/^\S*merge_lanes.py/%s &/' %s | sh" % (python.replace("/", "\\/"), work_path("merge_lanes_commands.txt"))], "unique_sequences"),
+        ("summarize_counts_build_index", ["%s %s -t build_index -O %s %s" % (python, script("gtdb/format_database.py"), taxonomy_index_file, taxonomy_file)], None),
+        ("summarize_counts_csv", ["%s %s -T %s -O %s %s" % (python, script("gtdb/summarize_counts.py"), taxonomy_file, work_path("summary_csv"), " ".join(results_files))], "blast_records"),
+        ("summarize_counts_index", ["%s %s -T %s -O %s %s" % (python, script("gtdb/summarize_counts.py"), taxonomy_index_file, work_path("summary"), " ".join(results_files))], "blast_records"),
+        ("summarize_counts_collapsed", ["%s %s -T %s -F collapsed -O %s %s" % (python, script("gtdb/summarize_counts.py"), taxonomy_index_file, work_path("summary_collapsed"), " ".join(results_files))], "blast_records"),
+        ("profile_prism_sample_summaries", python2 and ["%s %s --summary_type sample_summaries --weighting_method line %s > /dev/null" % (python2, script("profile_prism.py"), " ".join(summaries("summary")))], "reads"),
+        ("profile_prism_summary_table", python2 and ["%s %s --summary_type summary_table --measure frequency %s > %s" % (python2, script("profile_prism.py"), " ".join("%s.taxonomy.pickle" % summary for summary in summaries("summary")), work_path("taxonomy_frequency_table.txt"))], "samples")
+    ]
+
+
+def time_commands(commands, env):
+    """
+    run the commands in turn, returning (status, wall seconds, cpu seconds, max rss (Mb), error text)
+    """
+    wall = 0.0
+    cpu = 0.0
+    max_rss = 0.0
+    for command in commands:
+        start = time.time()
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.DEVNULL if hasattr(subprocess, "DEVNULL") else open(os.devnull, "w"), stderr=subprocess.PIPE, env=env)
+        error_text = process.stderr.read()
+        (pid, status, usage) = os.wait4(process.pid, 0)
+        process.stderr.close()
+        wall += time.time() - start
+        cpu += usage.ru_utime + usage.ru_stime
+        max_rss = max(max_rss, usage.ru_maxrss / 1024.0)
+        if status != 0:
+            return ("failed", wall, cpu, max_rss, error_text.decode("utf-8", "replace")[-2000:])
+    return ("ok", wall, cpu, max_rss, None)
+
+
+def run(options):
+    data_folder = options["data_folder"]
+    manifest_file = os.path.join(data_folder, DATA_MANIFEST)
+    if not os.path.isfile(manifest_file):
+        raise benchmark_exception("no benchmark data in %s - run -t generate first" % data_folder)
+    with open(manifest_file, "r") as manifest_stream:
+        manifest = json.load(manifest_stream)
+
+    work_folder = options["work_folder"] or os.path.join(data_folder, "work")
+    for folder in ("", "sort_temp", "catalogue", "merged_fasta", "summary_csv", "summary", "summary_collapsed"):
+        if not os.path.isdir(os.path.join(work_folder, folder)):
+            os.makedirs(os.path.join(work_folder, folder))
+    with open(os.path.join(work_folder, "lanes_file_list.txt"), "w") as lanes_stream:
+        for filename in sorted(glob.glob(os.path.join(data_folder, "lanes", "*.non-redundant.fasta"))):
+            print(filename, file=lanes_stream)
+
+    env = dict(os.environ)
+    env["LC_ALL"] = "C"      # (as the non-redundant fasta is sorted bytewise)
+    if options["seq_prisms"] is not None:
+        env["PYTHONPATH"] = os.pathsep.join([options["seq_prisms"]] + [path for path in [env.get("PYTHONPATH")] if path])
+
+    results = {}
+    for (name, commands, items_field) in get_benchmarks(data_folder, work_folder, options["python"], options["python2"]):
+        if options["benchmarks"] is not None and name not in options["benchmarks"]:
+            continue
+        if commands is None:
+            results[name] = {"status": "skipped", "error": "no python 2 interpreter (profile_prism.py only runs under python 2) - give one with -2"}
+            print("%s skipped : %s" % (name, results[name]["error"]), file=sys.stderr)
+            continue
+        timings = []
+        for repeat in range(options["repeats"]):
+            timing = time_commands(commands, env)
+            timings.append(timing)
+            if timing[0] != "ok":
+                break
+
+        if timings[-1][0] != "ok":
+            results[name] = {"status": "failed", "error": timings[-1][4]}
+            print("%s failed : %s" % (name, timings[-1][4].strip().split("\n")[-1] if timings[-1][4] else ""), file=sys.stderr)
+            continue
+
+        walls = sorted(timing[1] for timing in timings)
+        result = {
+            "status": "ok",
+            "repeats": len(timings),
+            "median_seconds": walls[len(walls) // 2],
+            "min_seconds": walls[0],
+            "cpu_seconds": sorted(timing[2] for timing in timings)[len(timings) // 2],
+            "max_rss_mb": max(timing[3] for timing in timings),
+            "items": None,
+            "items_per_second": None
+        }
+        if items_field is not None:
+            result["items"] = manifest["totals"][items_field]
+            result["items_per_second"] = result["items"] / result["median_seconds"] if result["median_seconds"] > 0 else None
+        results[name] = result
+        print("%s : %.2fs (median of %d)" % (name, result["median_seconds"], result["repeats"]), file=sys.stderr)
+
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "python": options["python"],
+        "python2": options["python2"],
+        "python_version": subprocess.check_output([options["python"], "-c", "import sys; print(sys.version.split()[0])"]).decode().strip(),
+        "data": manifest,
+        "benchmarks": results
+    }
+    if options["output_file"] is None:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        with open(options["output_file"], "w") as output_stream:
+            json.dump(report, output_stream, indent=2, sort_keys=True)
+
+
+def compare(options):
+    """
+    compare benchmark results with a baseline - returns the number of regressions (benchmarks slower than the baseline by
+    more than the threshold ratio, or which now fail)
+    """
+    (baseline_file, results_file) = options["results_files"]
+    with open(baseline_file, "r") as baseline_stream:
+        baseline = json.load(baseline_stream)
+    with open(results_file, "r") as results_stream:
+        results = json.load(results_stream)
+
+    if baseline["data"]["totals"] != results["data"]["totals"]:
+        print("warning - the benchmark data differ (%s vs %s), so times are not comparable" % (json.dumps(baseline["data"]["totals"], sort_keys=True), json.dumps(results["data"]["totals"], sort_keys=True)), file=sys.stderr)
+
+    regressions = 0
+    print("\t".join(["benchmark", "baseline_seconds", "seconds", "ratio", "baseline_max_rss_mb", "max_rss_mb", "flag"]))
+    for name in sorted(set(baseline["benchmarks"]) | set(results["benchmarks"])):
+        before = baseline["benchmarks"].get(name, {"status": "missing"})
+        after = results["benchmarks"].get(name, {"status": "missing"})
+        if before["status"] != "ok" or after["status"] != "ok":
+            flag = ""
+            if after["status"] == "skipped":
+                flag = "skipped"
+            elif before["status"] == "ok":
+                flag = "REGRESSION (%s)" % after["status"]
+                regressions += 1
+            print("\t".join([name, "%s" % before.get("median_seconds", before["status"]), "%s" % after.get("median_seconds", after["status"]), "-", "-", "-", flag]))
+            continue
+        ratio = after["median_seconds"] / before["median_seconds"] if before["median_seconds"] > 0 else 1.0
+        flag = ""
+        if ratio > options["threshold"]:
+            flag = "REGRESSION"
+            regressions += 1
+        elif ratio < 1.0 / options["threshold"]:
+            flag = "faster"
+        print("\t".join([name, "%.3f" % before["median_seconds"], "%.3f" % after["median_seconds"], "%.2f" % ratio, "%.1f" % before["max_rss_mb"], "%.1f" % after["max_rss_mb"], flag]))
+    return regressions
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+generates synthetic melseq data, and benchmarks the python and summarise hot paths on it
+
+examples :
+
+# a laptop-sized data set (the defaults), and a larger one
+./melseq_benchmark.py -t generate -D /tmp/melseq_bench
+./melseq_benchmark.py -t generate -D /tmp/melseq_bench_large -n 48 -r 500000 -u 100000 -g 20000
+
+# run the benchmarks, keeping the results as a baseline (profile_prism.py needs seq_prisms, and python 2)
+./melseq_benchmark.py -t run -D /tmp/melseq_bench -S /dataset/gseq_processing/active/bin/melseq_prism/seq_prisms -2 /usr/bin/python2 -o baseline.json
+
+# just some of them, with another python
+./melseq_benchmark.py -t run -D /tmp/melseq_bench -p pypy -b dereplicate_fastq,summarize_counts_index -o pypy.json
+
+# compare with the baseline (exits with status 1 if anything is slower by more than the threshold ratio)
+./melseq_benchmark.py -t compare baseline.json current.json
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('results_files', type=str, nargs="*", help='baseline and current results files (compare)')
+    parser.add_argument('-t', '--task', dest='task', type=str, default="run", choices=["generate", "run", "compare"], help="what you want to do")
+    parser.add_argument('-D', '--data_folder', dest='data_folder', type=str, default=None, help='folder for the benchmark data (generate, run)')
+    parser.add_argument('-W', '--work_folder', dest='work_folder', type=str, default=None, help='folder for benchmark outputs (run) (default work/ in the data folder)')
+    parser.add_argument('-o', '--output_file', dest='output_file', type=str, default=None, help='results file to write (run) (default stdout)')
+    parser.add_argument('-n', '--num_samples', dest='num_samples', type=int, default=8, help='number of samples (generate) (default 8)')
+    parser.add_argument('-r', '--reads_per_sample', dest='reads_per_sample', type=int, default=100000, help='reads per sample (generate) (default 100000)')
+    parser.add_argument('-u', '--num_tags', dest='num_tags', type=int, default=20000, help='number of distinct tags (generate) (default 20000)')
+    parser.add_argument('-g', '--num_genomes', dest='num_genomes', type=int, default=2000, help='number of genomes in the taxonomy (generate) (default 2000)')
+    parser.add_argument('--error_rate', dest='error_rate', type=float, default=0.02, help='proportion of reads with a sequencing error (generate) (default 0.02)')
+    parser.add_argument('--zipf_exponent', dest='zipf_exponent', type=float, default=1.1, help='skew of the tag abundance (generate) (default 1.1)')
+    parser.add_argument('--seed', dest='seed', type=int, default=1, help='random seed (generate) (default 1)')
+    parser.add_argument('-p', '--python', dest='python', type=str, default=sys.executable, help='python to run the scripts with (run) (default this python)')
+    parser.add_argument('-2', '--python2', dest='python2', type=str, default=get_default_python2(), help='python 2 to run profile_prism.py with (run) - its benchmarks are skipped if there is none (default the first of %s on the path)' % ",".join(PYTHON2_NAMES))
+    parser.add_argument('-S', '--seq_prisms', dest='seq_prisms', type=str, default=os.environ.get("SEQ_PRISMS_BIN"), help='seq_prisms folder, for profile_prism.py (run) (default $SEQ_PRISMS_BIN)')
+    parser.add_argument('-b', '--benchmarks', dest='benchmarks', type=str, default=None, help='comma separated list of benchmarks to run (run) (default all)')
+    parser.add_argument('-R', '--repeats', dest='repeats', type=int, default=3, help='number of times to run each benchmark (run) (default 3)')
+    parser.add_argument('--threshold', dest='threshold', type=float, default=1.25, help='flag benchmarks slower than the baseline by more than this ratio (compare) (default 1.25)')
+
+    args = vars(parser.parse_args())
+
+    if args["task"] in ("generate", "run"):
+        if args["data_folder"] is None:
+            raise benchmark_exception("%(task)s requires a data folder (-D)" % args)
+        if args["task"] == "generate" and not os.path.isdir(args["data_folder"]):
+            os.makedirs(args["data_folder"])
+    if args["task"] == "compare":
+        if len(args["results_files"]) != 2:
+            raise benchmark_exception("compare requires a baseline and a results file")
+        for filename in args["results_files"]:
+            if not os.path.isfile(filename):
+                raise benchmark_exception("%s is not a file" % filename)
+    if args["benchmarks"] is not None:
+        args["benchmarks"] = args["benchmarks"].split(",")
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    if options["task"] == "generate":
+        generate(options)
+    elif options["task"] == "run":
+        run(options)
+    elif options["task"] == "compare":
+        if compare(options) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+   main()
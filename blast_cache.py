@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import glob
+import gzip
+import zlib
+import hashlib
+import sqlite3
+import time
+import argparse
+import contextlib
+import seq_io
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "gtdb"))    # for summarize_counts, when run from the source folder
+
+#
+# persistent (cross-run) cache of blast results, so that sequences that have been blasted before against the same
+# database, with the same parameters, are not blasted again.
+#
+# The cache is a sqlite database, with one row per search (database, database version, blast parameters) and one
+# row per (search, sequence) containing the (zlib compressed) tabular blast hits for the sequence (with the query
+# id removed, as this differs from sample to sample). The database version is a digest of the names, sizes and
+# modification times of the blast database files, so that rebuilding the database invalidates the cache, and searches
+# against old versions of a database are evicted when it is updated. With a taxonomy (-T, and -d for a deduplicated
+# database), the LCA assignment of each sequence, as made by gtdb/summarize_counts.py, is cached as well (one row per
+# (search, taxonomy version, sequence)), and update writes the assignments of each input next to its results, for
+# summarize_counts.py -A - so that the LCA is only worked out once for each sequence.
+#
+# lookup writes a fasta file of the sequences that are not in the cache (with the same name as the input, in the
+# misses folder) - these are blasted as usual - and update then adds the new results to the cache, and writes
+# the complete results file for each input (cached and new hits, in the order of the input fasta)
+#
+# A cache may be shared by concurrent runs. Each input is updated, and old searches evicted, in a single
+# "begin immediate" transaction, so an update sees either all or none of another's changes. There is no lock held
+# from lookup to update (this would serialise the blasting of the runs), so sequences found to be cached by lookup may
+# have been evicted by another run (after the database was rebuilt) before update reads them - update then still caches
+# the new hits, but does not write the results of those inputs, and exits with status EVICTED_EXIT_STATUS, so that
+# lookup, blast and update can be run again (as by melseq_prism.sh) to blast the evicted sequences.
+#
+
+ZLIB_LEVEL = 6
+EVICTED_EXIT_STATUS = 3      # update exits with this if any cached sequences were evicted by another run before they could be used
+LOCK_TIMEOUT_SECONDS = 3600  # how long to wait for another run's transaction (e.g. the update of a large input) to finish
+
+
+class blast_cache_exception(Exception):
+    def __init__(self,args=None):
+        super(blast_cache_exception, self).__init__(args)
+
+
+def get_database_version(blast_database):
+    """
+    digest of the names, sizes and modification times of the files making up a blast database
+    """
+    database_files = sorted(glob.glob("%s.*" % blast_database))
+    if len(database_files) == 0:
+        raise blast_cache_exception("could not find any files for blast database %s" % blast_database)
+    version = hashlib.md5()
+    for database_file in database_files:
+        stat = os.stat(database_file)
+        version.update(("%s\t%d\t%d\n" % (os.path.basename(database_file), stat.st_size, int(stat.st_mtime))).encode())
+    return version.hexdigest()
+
+
+def get_digest(seq):
+    return sqlite3.Binary(hashlib.sha1(seq).digest())
+
+
+def open_cache(cache_file):
+    # (no implicit transactions - changes are made in explicit "begin immediate" transactions, see immediate_transaction)
+    connection = sqlite3.connect(cache_file, timeout=LOCK_TIMEOUT_SECONDS, isolation_level=None)
+    with immediate_transaction(connection):
+        connection.execute("create table if not exists searches (search_id integer primary key, database text, database_version text, params text, results_suffix text, created real, unique(database, database_version, params))")
+        connection.execute("create table if not exists hits (search_id integer, digest blob, hit_count integer, hits blob, primary key(search_id, digest)) without rowid")
+        connection.execute("create table if not exists assignments (search_id integer, taxonomy_version text, digest blob, lca text, primary key(search_id, taxonomy_version, digest)) without rowid")
+    return connection
+
+
+@contextlib.contextmanager
+def immediate_transaction(connection):
+    """
+    run the enclosed statements in a transaction which takes the write lock at the start (so that a concurrent run
+    cannot change the rows read, before the transaction writes)
+    """
+    connection.execute("begin immediate")
+    try:
+        yield connection
+    except:
+        connection.execute("rollback")
+        raise
+    connection.execute("commit")
+
+
+def get_search_id(connection, blast_database, blast_params, create=False):
+    """
+    returns (search_id, results_suffix) for this database (version) and parameters, or (None, None) if
+    there is no such search (and create is False)
+    """
+    database = os.path.realpath(blast_database)
+    key = (database, get_database_version(blast_database), blast_params)
+    row = connection.execute("select search_id, results_suffix from searches where database = ? and database_version = ? and params = ?", key).fetchone()
+    if row is None and create:
+        # (or ignore, in case another run has just created it)
+        with immediate_transaction(connection):
+            connection.execute("insert or ignore into searches (database, database_version, params, created) values (?, ?, ?, ?)", key + (time.time(),))
+        row = connection.execute("select search_id, results_suffix from searches where database = ? and database_version = ? and params = ?", key).fetchone()
+    if row is None:
+        return (None, None)
+    return row
+
+
+def get_cached_hits(connection, search_id, seq):
+    """
+    returns the list of hit records (without the query id) for seq, or None if seq is not in the cache
+    """
+    if search_id is None:
+        return None
+    row = connection.execute("select hits from hits where search_id = ? and digest = ?", (search_id, get_digest(seq))).fetchone()
+    if row is None:
+        return None
+    hits = zlib.decompress(bytes(row[0]))
+    return [record for record in hits.split(b"\n") if len(record) > 0]
+
+
+def fasta_record_iter(filename):
+    """
+    yield (qseqid, seq) from a non-redundant fasta file
+    """
+    with seq_io.open_input(filename) as fasta:
+        for (name, seq) in seq_io.fasta_iter(fasta):
+            yield (name.strip().split()[0], seq)
+
+
+def lookup(options):
+    """
+    write the sequences of each input fasta which are not in the cache, to a file of the same name in the misses folder
+    """
+    connection = open_cache(options["cache_file"])
+    (search_id, results_suffix) = get_search_id(connection, options["blast_database"], options["blast_params"])
+
+    (total_hits, total_misses) = (0, 0)
+    for fasta_file in options["filenames"]:
+        (cache_hits, cache_misses) = (0, 0)
+        with open(os.path.join(options["output_folder"], os.path.basename(fasta_file)), "wb") as misses_stream:
+            for (qseqid, seq) in fasta_record_iter(fasta_file):
+                if get_cached_hits(connection, search_id, seq) is None:
+                    cache_misses += 1
+                    misses_stream.write(b">" + qseqid + b"\n" + seq + b"\n")
+                else:
+                    cache_hits += 1
+        print("%s : %d cached, %d to blast" % (fasta_file, cache_hits, cache_misses), file=sys.stderr)
+        total_hits += cache_hits
+        total_misses += cache_misses
+
+    print("blast cache lookup : %d cached, %d to blast (%.1f%% cached)" % (total_hits, total_misses, 100.0 * total_hits / max(1, total_hits + total_misses)), file=sys.stderr)
+    connection.close()
+
+
+def read_results(results_file):
+    """
+    read the blast results for the cache misses into a dictionary of qseqid => [hit records without the query id]
+    """
+    results = {}
+    if results_file is None:
+        return results
+    with gzip.open(results_file, "rb") as results_stream:
+        for record in results_stream:
+            (qseqid, hit) = record.rstrip(b"\r\n").split(b"\t", 1)
+            results.setdefault(qseqid, []).append(hit)
+    return results
+
+
+def get_lca_assigner(taxonomy_file, duplicates_file):
+    """
+    returns the version of the taxonomy, and a function which gives the LCA assignment (as summarize_counts.py) of a
+    list of hit records (without the query id), as a tab-delimited string (empty if unassigned)
+    """
+    import summarize_counts
+    if taxonomy_file == "default":
+        taxonomy_file = summarize_counts.get_default_taxonomy_file()
+    taxonomy = summarize_counts.load_taxonomy(taxonomy_file)
+    duplicates = None
+    if duplicates_file is not None:
+        duplicates = summarize_counts.load_duplicates(duplicates_file)
+
+    def assign(hit_records):
+        hits = []
+        for record in hit_records:
+            fields = record.decode().split("\t")
+            if len(fields) >= 11:
+                hits.append((None, fields[0], float(fields[10])))
+        if len(hits) == 0:
+            return ""
+        lca = summarize_counts.get_lca(hits, taxonomy, duplicates)
+        if lca is None:
+            return ""
+        lca = "\t".join(lca)
+        return lca.decode("utf-8") if isinstance(lca, bytes) else lca     # (text, under python 2 as well, for sqlite)
+    return (summarize_counts.get_taxonomy_version(taxonomy_file, duplicates_file), assign)
+
+
+def get_cached_lca(connection, search_id, taxonomy_version, seq):
+    row = connection.execute("select lca from assignments where search_id = ? and taxonomy_version = ? and digest = ?", (search_id, taxonomy_version, get_digest(seq))).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def update(options):
+    """
+    add the blast results of the misses to the cache, and write the full results file (and, with a taxonomy, the
+    LCA assignments) for each input fasta
+    """
+    connection = open_cache(options["cache_file"])
+    (search_id, results_suffix) = get_search_id(connection, options["blast_database"], options["blast_params"], create=True)
+
+    (taxonomy_version, assign_lca) = (None, None)
+    if options["taxonomy_file"] is not None:
+        (taxonomy_version, assign_lca) = get_lca_assigner(options["taxonomy_file"], options["duplicates_file"])
+
+    evicted_inputs = []
+    for fasta_file in options["filenames"]:
+        base = os.path.basename(fasta_file)
+        misses_results = glob.glob(os.path.join(options["results_folder"], "%s.*.results.gz" % base))
+        if len(misses_results) > 1:
+            raise blast_cache_exception("found more than one results file for %s in %s" % (base, options["results_folder"]))
+        if len(misses_results) == 1:
+            results_file = misses_results[0]
+            # note the file naming used for this search, for runs where everything is cached
+            if results_suffix is None:
+                results_suffix = os.path.basename(results_file)[len(base):]
+                with immediate_transaction(connection):
+                    connection.execute("update searches set results_suffix = ? where search_id = ?", (results_suffix, search_id))
+        else:
+            results_file = None
+            if results_suffix is None:
+                raise blast_cache_exception("no blast results found for %s, and the naming of the results for this search is not known" % base)
+
+        results = read_results(results_file)
+        misses = set()
+        misses_fasta = os.path.join(options["misses_folder"], base)
+        if os.path.isfile(misses_fasta):
+            misses = set(qseqid for (qseqid, seq) in fasta_record_iter(misses_fasta))
+
+        (added, evicted, assigned) = (0, 0, 0)
+        output_file = os.path.join(options["output_folder"], base + results_suffix)
+        lca_file = re.sub("\.results\.gz$", "", output_file) + ".lca.txt"
+        # (the cached hits are read, and the new ones added, in one transaction, so another run cannot evict them part way through)
+        with immediate_transaction(connection), gzip.open("%s.part" % output_file, "wb") as results_stream, \
+                open("%s.part" % lca_file, "wb") as lca_stream:
+            if assign_lca is not None:
+                lca_stream.write(("#taxonomy_version\t%s\n" % taxonomy_version).encode())
+            for (qseqid, seq) in fasta_record_iter(fasta_file):
+                lca = None
+                if qseqid in misses:
+                    hits = results.get(qseqid, [])   # (sequences with no hits are cached too, so they are not blasted again)
+                    connection.execute("insert or replace into hits (search_id, digest, hit_count, hits) values (?, ?, ?, ?)",
+                                       (search_id, get_digest(seq), len(hits), sqlite3.Binary(zlib.compress(b"".join(hit + b"\n" for hit in hits), ZLIB_LEVEL))))
+                    added += 1
+                else:
+                    hits = get_cached_hits(connection, search_id, seq)
+                    if hits is None:
+                        # evicted by another run since the lookup - this input is looked up and blasted again
+                        evicted += 1
+                        continue
+                    if assign_lca is not None:
+                        lca = get_cached_lca(connection, search_id, taxonomy_version, seq)
+                if assign_lca is not None and lca is None:
+                    lca = assign_lca(hits)
+                    connection.execute("insert or replace into assignments (search_id, taxonomy_version, digest, lca) values (?, ?, ?, ?)", (search_id, taxonomy_version, get_digest(seq), lca))
+                    assigned += 1
+                for hit in hits:
+                    results_stream.write(qseqid + b"\t" + hit + b"\n")
+                if assign_lca is not None and len(hits) > 0:
+                    lca_stream.write(qseqid + (b"\t" + lca.encode("utf-8") if len(lca) > 0 else b"") + b"\n")
+
+        if evicted > 0:
+            os.remove("%s.part" % output_file)
+            os.remove("%s.part" % lca_file)
+            evicted_inputs.append(fasta_file)
+            print("%s : added %d sequences to the cache, but %d sequences found by the lookup have since been evicted by another run - not writing results" % (fasta_file, added, evicted), file=sys.stderr)
+            continue
+        os.rename("%s.part" % output_file, output_file)
+        # (the assignments are written after the results, as summarize_counts.py ignores assignments older than the results)
+        if assign_lca is not None:
+            os.rename("%s.part" % lca_file, lca_file)
+        else:
+            os.remove("%s.part" % lca_file)
+            if os.path.exists(lca_file):
+                os.remove(lca_file)
+        print("%s : added %d sequences to the cache (made %d LCA assignments), results written to %s" % (fasta_file, added, assigned, output_file), file=sys.stderr)
+
+    connection.close()
+    evict(options)
+    if len(evicted_inputs) > 0:
+        print("%d inputs had cached sequences evicted by another run - look these up, blast and update again" % len(evicted_inputs), file=sys.stderr)
+        sys.exit(EVICTED_EXIT_STATUS)
+
+
+def evict(options):
+    """
+    remove searches of older versions of the database (i.e. any search of the same database, with a different version)
+    """
+    connection = open_cache(options["cache_file"])
+    database = os.path.realpath(options["blast_database"])
+    current_version = get_database_version(options["blast_database"])
+    with immediate_transaction(connection):
+        old_searches = [row[0] for row in connection.execute("select search_id from searches where database = ? and database_version != ?", (database, current_version))]
+        for search_id in old_searches:
+            (count,) = connection.execute("select count(*) from hits where search_id = ?", (search_id,)).fetchone()
+            connection.execute("delete from hits where search_id = ?", (search_id,))
+            connection.execute("delete from assignments where search_id = ?", (search_id,))
+            connection.execute("delete from searches where search_id = ?", (search_id,))
+            print("evicted %d cached sequences for an old version of %s (search %d)" % (count, database, search_id), file=sys.stderr)
+    if len(old_searches) > 0:
+        # (reclaiming the space needs the cache to itself, so is skipped if another run is using it)
+        try:
+            connection.execute("vacuum")
+        except sqlite3.OperationalError as e:
+            print("warning - could not vacuum %s (%s)" % (options["cache_file"], e), file=sys.stderr)
+    connection.close()
+
+
+def stats(options):
+    connection = open_cache(options["cache_file"])
+    print("\t".join(("search_id", "database", "database_version", "params", "sequences", "with_hits", "assignments")))
+    for (search_id, database, database_version, params) in connection.execute("select search_id, database, database_version, params from searches order by search_id").fetchall():
+        (count, with_hits) = connection.execute("select count(*), sum(hit_count > 0) from hits where search_id = ?", (search_id,)).fetchone()
+        (assignment_count,) = connection.execute("select count(*) from assignments where search_id = ?", (search_id,)).fetchone()
+        print("\t".join(str(item) for item in (search_id, database, database_version, params, count, with_hits or 0, assignment_count)))
+    connection.close()
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+persistent cache of blast results, keyed by sequence digest, blast database version and blast parameters
+(update exits with status 3 if another run evicted sequences that lookup found cached - run lookup, blast and update again)
+
+examples :
+
+# write the sequences that are not already cached to blast_cache_misses/
+./blast_cache.py -t lookup -c /dataset/gseq_processing/scratch/melseq/blast_cache.db -b /dataset/gseq_processing/scratch/melseq/gtdb/GTDB1 --blast_params="-num_threads 8 -task blastn -word_size 16 -outfmt '6 std qlen' -evalue 0.02" -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast_cache_misses /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/*.non-redundant.fasta
+
+# (blast the misses, writing results to blast_cache_misses_results/), then cache them and write the full results (and LCA assignments) to blast/
+./blast_cache.py -t update -c /dataset/gseq_processing/scratch/melseq/blast_cache.db -b /dataset/gseq_processing/scratch/melseq/gtdb/GTDB1 --blast_params="-num_threads 8 -task blastn -word_size 16 -outfmt '6 std qlen' -evalue 0.02" -T default -M /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast_cache_misses -R /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast_cache_misses_results -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/*.non-redundant.fasta
+
+./blast_cache.py -t stats -c /dataset/gseq_processing/scratch/melseq/blast_cache.db
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames', type=str, nargs="*", help='non-redundant fasta files')
+    parser.add_argument('-t', '--task', dest='task', type=str, default="lookup", choices=["lookup", "update", "evict", "stats"], help="what you want to do")
+    parser.add_argument('-c', '--cache_file', dest='cache_file', type=str, required=True, help='sqlite cache file (created if necessary)')
+    parser.add_argument('-b', '--blast_database', dest='blast_database', type=str, default=None, help='blast database')
+    parser.add_argument('-p', '--blast_params', dest='blast_params', type=str, default=None, help='blast parameters (as passed to align_prism) - as these start with -, use the form --blast_params="..."')
+    parser.add_argument('-O', '--output_folder', dest='output_folder', type=str, default=None, help='folder for the misses fasta (lookup) or full results (update)')
+    parser.add_argument('-M', '--misses_folder', dest='misses_folder', type=str, default=None, help='folder containing the misses fasta written by lookup (update)')
+    parser.add_argument('-R', '--results_folder', dest='results_folder', type=str, default=None, help='folder containing the blast results for the misses (update)')
+    parser.add_argument('-T', '--taxonomy_file', dest='taxonomy_file', type=str, default=None, help='optional taxonomy (as used by gtdb/summarize_counts.py, or "default" for its default) - if given, the LCA assignment of each sequence is cached, and written next to the results, for summarize_counts.py -A (update)')
+    parser.add_argument('-d', '--duplicates_file', dest='duplicates_file', type=str, default=None, help='duplicates file of a deduplicated blast database, as for summarize_counts.py -d (with -T) (update)')
+
+    args = vars(parser.parse_args())
+
+    if args["task"] in ("lookup", "update", "evict"):
+        if args["blast_database"] is None:
+            raise blast_cache_exception("%(task)s requires a blast database (-b)" % args)
+    if args["task"] in ("lookup", "update"):
+        if args["blast_params"] is None:
+            raise blast_cache_exception("%(task)s requires the blast parameters (-p)" % args)
+        if args["output_folder"] is None or not os.path.isdir(args["output_folder"]):
+            raise blast_cache_exception("%(task)s requires an existing output folder (-O)" % args)
+        for filename in args["filenames"]:
+            if not os.path.isfile(filename):
+                raise blast_cache_exception("%s is not a file" % filename)
+    if args["task"] == "update":
+        for folder in ("misses_folder", "results_folder"):
+            if args[folder] is None or not os.path.isdir(args[folder]):
+                raise blast_cache_exception("update requires an existing %s" % folder)
+        if args["taxonomy_file"] not in (None, "default") and not os.path.isfile(args["taxonomy_file"]):
+            raise blast_cache_exception("%(taxonomy_file)s is not a file" % args)
+        if args["duplicates_file"] is not None:
+            if args["taxonomy_file"] is None:
+                raise blast_cache_exception("a duplicates file (-d) is only used with a taxonomy (-T)")
+            if not os.path.isfile(args["duplicates_file"]):
+                raise blast_cache_exception("%(duplicates_file)s is not a file" % args)
+
+    # normalise whitespace in the parameters, so that trivial differences do not cause cache misses
+    if args["blast_params"] is not None:
+        args["blast_params"] = re.sub("\s+", " ", args["blast_params"]).strip()
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    if options["task"] == "lookup":
+        lookup(options)
+    elif options["task"] == "update":
+        update(options)
+    elif options["task"] == "evict":
+        evict(options)
+    elif options["task"] == "stats":
+        stats(options)
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import gzip
+import json
+import glob
+import argparse
+import multiprocessing
+import seq_io
+
+#
+# get counts of numbers of reads / sequences in and out of each processing step, for audit. This writes the same
+# tables as check_processing.sh used to, i.e.
+#
+# demultiplex_counts.txt, trimming_counts.txt, fasta_counts.txt, blast_counts.txt, summary_counts.txt
+#
+# and these pasted together as processing_counts.txt. Each stage folder is listed once, and files are matched to the
+# demultiplexed fastq by sample key (e.g. 966045_CAACTGACTG_psti.R1), rather than globbing for each sample. Counting is done
+# by a pool of processes, and counts are cached (keyed by path, size and modification time) in processing_counts.cache.json,
+# so that re-running only counts files that have changed
+#
+
+CACHE_FILENAME = "processing_counts.cache.json"
+SAMPLE_KEY_REGEXP = "demultiplexed_([^.]+\.R\d)"
+
+
+class check_processing_exception(Exception):
+    def __init__(self,args=None):
+        super(check_processing_exception, self).__init__(args)
+
+
+def get_text_stream(filename):
+    if re.search("\.gz$", filename) is not None:
+        return gzip.open(filename, "rt") if sys.version_info[0] >= 3 else gzip.open(filename, "r")
+    return open(filename, "r")
+
+
+def get_tag_count(name):
+    """
+    e.g. Sequence59_count=2 => 2
+    """
+    return int(name.split("=")[1])
+
+
+def count_fastq(filename):
+    """
+    number of reads in a (gzipped) fastq file
+    """
+    with seq_io.open_input(filename, parallel=False) as fastq:
+        return seq_io.count_lines(fastq) // 4
+
+
+def count_trimming(filename):
+    """
+    reads processed and written, from a cutadapt trim report (as parse_trim.py)
+    """
+    in_out = [None, None]
+    with open(filename, "r") as report:
+        for record in report:
+            match = re.search("^Total reads processed:\s+(\S+)$", record.strip())
+            if match is not None:
+                in_out[0] = match.groups()[0].replace(",", "")
+            match = re.search("^Reads written \(passing filters\):\s+(\S+)\s\(", record.strip())
+            if match is not None:
+                in_out[1] = match.groups()[0].replace(",", "")
+                break
+    return "%s\t%s" % tuple(in_out)
+
+
+def count_fasta(filename):
+    """
+    total number of reads represented in a non-redundant fasta file (as count_non_redundant_fasta.py)
+    """
+    total = 0
+    with open(filename, "r") as fasta:
+        for record in fasta:
+            if record[0:1] == ">":
+                total += get_tag_count(record.strip())
+    return total
+
+
+def count_blast(filename):
+    """
+    total number of reads represented by the queries with a blast hit (as count_blast.py on the unique query ids)
+    """
+    queries = set()
+    with get_text_stream(filename) as results:
+        for record in results:
+            queries.add(record.split("\t", 1)[0].strip())
+    return sum(get_tag_count(query) for query in queries if len(query) > 0)
+
+
+def count_summary(filename):
+    """
+    number of reads summarised - expanded summaries have one record per read ; collapsed summaries have one per
+    sequence, with the count in a 9th column
+    """
+    total = 0
+    with open(filename, "r") as summary:
+        for record in summary:
+            fields = record.rstrip("\n").split("\t")
+            if len(fields) > 8:
+                total += int(fields[-1])
+            else:
+                total += 1
+    return total
+
+
+COUNTERS = {
+    "demultiplex": count_fastq,
+    "trimming": count_trimming,
+    "fasta": count_fasta,
+    "blast": count_blast,
+    "summary": count_summary
+}
+
+
+def count_file(args):
+    (stage, filename) = args
+    return (stage, filename, COUNTERS[stage](filename))
+
+
+def get_sample_key(filename):
+    match = re.search(SAMPLE_KEY_REGEXP, os.path.basename(filename))
+    if match is None:
+        return None
+    return match.groups()[0]
+
+
+def index_stage(stage_files):
+    """
+    index the files of a stage by sample key. (As with the shell version, a sample with more than one file at a
+    stage is not counted at that stage)
+    """
+    index = {}
+    for filename in stage_files:
+        key = get_sample_key(filename)
+        if key is not None:
+            index.setdefault(key, []).append(filename)
+    return dict((key, files[0]) for (key, files) in index.items() if len(files) == 1)
+
+
+def get_file_signature(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def load_cache(cache_file):
+    if not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file, "r") as cache_stream:
+            return json.load(cache_stream)
+    except ValueError:
+        return {}      # e.g. an interrupted write - just recount
+
+
+def save_cache(cache, cache_file):
+    with open("%s.part" % cache_file, "w") as cache_stream:
+        json.dump(cache, cache_stream)
+    os.rename("%s.part" % cache_file, cache_file)
+
+
+def check_processing(options):
+    folder = options["processing_folder"]
+
+    demultiplexed_files = sorted(glob.glob(os.path.join(folder, "demultiplex", "*.demultiplexed", "*.fastq.gz")))
+    stage_indexes = {
+        "trimming": index_stage(glob.glob(os.path.join(folder, "trimming", "*.trimReport"))),
+        "fasta": index_stage(glob.glob(os.path.join(folder, "fasta", "*.non-redundant.fasta"))),
+        "blast": index_stage(glob.glob(os.path.join(folder, "blast", "*.results.gz"))),
+        "summary": index_stage(glob.glob(os.path.join(folder, "summary", "*.summary")))
+    }
+
+    # the files to count at each stage, in demultiplexed file order
+    stage_files = {"demultiplex": demultiplexed_files}
+    for stage in ("trimming", "fasta", "blast", "summary"):
+        stage_files[stage] = []
+        for filename in demultiplexed_files:
+            key = os.path.basename(filename)[:-len(".fastq.gz")]
+            if key in stage_indexes[stage]:
+                stage_files[stage].append(stage_indexes[stage][key])
+
+    cache_file = os.path.join(folder, CACHE_FILENAME)
+    cache = {}
+    if options["use_cache"]:
+        cache = load_cache(cache_file)
+
+    counts = {}
+    to_count = []
+    for (stage, filenames) in stage_files.items():
+        for filename in filenames:
+            cached = cache.get(stage, {}).get(filename)
+            if cached is not None and cached[0:2] == get_file_signature(filename):
+                counts[(stage, filename)] = cached[2]
+            else:
+                to_count.append((stage, filename))
+
+    print("%d files to count (%d counts cached)" % (len(to_count), len(counts)), file=sys.stderr)
+    if len(to_count) > 0:
+        pool = multiprocessing.Pool(processes=max(1, min(options["num_processes"], len(to_count))))
+        for (stage, filename, count) in pool.imap_unordered(count_file, to_count):
+            counts[(stage, filename)] = count
+            cache.setdefault(stage, {})[filename] = get_file_signature(filename) + [count]
+        pool.close()
+        pool.join()
+        if options["use_cache"]:
+            save_cache(cache, cache_file)
+
+    # write the tables, as the shell version
+    headings = {
+        "demultiplex": "file\tdemultiplex_count",
+        "trimming": "trim_processed\ttrim_written",
+        "fasta": "fastafile\tfasta_count",
+        "blast": "blastfile\tblast_count",
+        "summary": "summaryfile\tsummary_count"
+    }
+    tables = []
+    for stage in ("demultiplex", "trimming", "fasta", "blast", "summary"):
+        table = [headings[stage]]
+        for filename in stage_files[stage]:
+            if stage == "trimming":
+                table.append(counts[(stage, filename)])
+            else:
+                table.append("%s\t%d" % (filename, counts[(stage, filename)]))
+        with open(os.path.join(folder, "%s_counts.txt" % stage), "w") as table_stream:
+            for record in table:
+                print(record, file=table_stream)
+        tables.append(table)
+
+    # (equivalent to paste - i.e. the tables are not aligned by sample, if a stage is missing for some samples)
+    with open(os.path.join(folder, "processing_counts.txt"), "w") as counts_stream:
+        for row in range(max(len(table) for table in tables)):
+            print("\t".join(table[row] if row < len(table) else "" for table in tables), file=counts_stream)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+counts the reads in and out of each processing step, and writes processing_counts.txt in the processing folder
+
+examples :
+
+./check_processing.py /dataset/gseq_processing/scratch/melseq/SQ1324_CE9U7ANXX
+
+./check_processing.py -j 16 --no_cache /dataset/gseq_processing/scratch/melseq/SQ1324_CE9U7ANXX
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('processing_folder', type=str, help='processing folder')
+    parser.add_argument('-j', '--num_processes', dest='num_processes', type=int, default=8, help='number of processes to use for counting (default 8)')
+    parser.add_argument('--no_cache', dest='use_cache', action='store_false', default=True, help='count all files, and do not update the cache of counts')
+
+    args = vars(parser.parse_args())
+
+    if not os.path.isdir(args["processing_folder"]):
+        raise check_processing_exception("processing folder %(processing_folder)s not found" % args)
+
+    return args
+
+
+def main():
+    options = get_options()
+    check_processing(options)
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import argparse
+import multiprocessing
+import numpy
+
+#
+# alpha diversity of each sample, and distances between all pairs of samples, of a cohort - from a taxonomy
+# frequency table written by profile_prism.py --summary_type summary_table (a row per taxon and a column per sample,
+# e.g. html/taxonomy_genus_frequency_table.txt), or from the .npz matrix file it writes with --matrix_file.
+#
+# (tax_summary_heatmap.r only shows the first num_profiles samples - this covers the whole cohort, e.g. thousands
+# of samples)
+#
+# The distance matrix is computed in square blocks of samples, spread over a pool of processes - each process
+# computes the distances between two blocks of samples at a time, and writes them straight into the (memory-mapped)
+# .npy file of the distance matrix, so the memory used is bounded by the block size (-B) rather than the number of
+# samples. Only the blocks on and above the diagonal are computed, and each is mirrored.
+#
+# * braycurtis : sum(|x - y|) / sum(x + y) of the counts (or of the relative frequencies, with --relative) - computed
+#                as 1 - 2 * sum(min(x, y)) / (sum(x) + sum(y)), a block at a time, in slices of taxa
+# * jaccard    : 1 - |x & y| / |x | y| of the taxa present - the intersections are a matrix product of the
+#                presence/absence blocks
+#
+# Writes to the output folder
+#
+# alpha_diversity.txt         sample, richness (taxa present), shannon (natural log), simpson (1 - sum p^2),
+#                             inverse_simpson, pielou evenness, and chao1 (when the table is of counts)
+# <metric>_distances.npy      samples x samples float64 matrix (numpy.load(..., mmap_mode="r") to read it lazily)
+# <metric>_distances.txt      the same, tab-delimited, with the sample names (unless --no_tsv)
+# samples.txt                 the samples, in the order of the rows and columns of the .npy matrices
+#
+
+DEFAULT_BLOCK_SIZE = 256
+TAXON_SLICE_ELEMENTS = 4 * 1024 * 1024     # most elements of the (block x block x taxa) array of minimums at once
+
+matrix = None    # samples x taxa, set in each process of the pool
+
+
+class cohort_diversity_exception(Exception):
+    def __init__(self,args=None):
+        super(cohort_diversity_exception, self).__init__(args)
+
+
+def read_frequency_table(table_file):
+    """
+    (samples, taxa, samples x taxa matrix) from a profile_prism.py summary table, or its .npz matrix file
+    """
+    if table_file.endswith(".npz"):
+        arrays = numpy.load(table_file)
+        return ([str(sample) for sample in arrays["samples"]], [str(taxon) for taxon in arrays["taxa"]], arrays["matrix"].astype(numpy.float64))
+
+    with open(table_file, "r") as table_stream:
+        header = table_stream.readline().rstrip("\r\n").split("\t")
+        (taxa, rows) = ([], [])
+        for record in table_stream:
+            fields = record.rstrip("\r\n").split("\t")
+            if len(fields) < 2:
+                continue
+            if len(fields) != len(header):
+                raise cohort_diversity_exception("expected %d columns for %s in %s" % (len(header), fields[0], table_file))
+            taxa.append(fields[0])
+            rows.append([float(value) for value in fields[1:]])
+    if len(rows) == 0:
+        return (header[1:], taxa, numpy.zeros((len(header) - 1, 0), dtype=numpy.float64))
+    return (header[1:], taxa, numpy.array(rows, dtype=numpy.float64).T.copy())
+
+
+def get_alpha_diversity(counts):
+    """
+    dict of measure => array of the alpha diversity of each sample (row) of the matrix
+    """
+    totals = counts.sum(axis=1)
+    safe_totals = numpy.where(totals > 0, totals, 1)
+    proportions = counts / safe_totals[:, numpy.newaxis]
+    richness = (counts > 0).sum(axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        logs = numpy.where(proportions > 0, numpy.log(numpy.where(proportions > 0, proportions, 1)), 0)
+    shannon = 0.0 - (proportions * logs).sum(axis=1)
+    sum_squares = (proportions * proportions).sum(axis=1)
+    measures = {
+        "richness" : richness,
+        "shannon" : shannon,
+        "simpson" : numpy.where(totals > 0, 1 - sum_squares, 0),
+        "inverse_simpson" : numpy.where(sum_squares > 0, 1 / numpy.where(sum_squares > 0, sum_squares, 1), 0),
+        "pielou" : numpy.where(richness > 1, shannon / numpy.log(numpy.maximum(richness, 2)), 0)
+    }
+    if numpy.all(counts == numpy.round(counts)):
+        # bias-corrected chao1, from the singletons and doubletons
+        singletons = (counts == 1).sum(axis=1)
+        doubletons = (counts == 2).sum(axis=1)
+        measures["chao1"] = richness + singletons * (singletons - 1) / (2.0 * (doubletons + 1))
+    return measures
+
+
+def init_worker(shared_matrix):
+    global matrix
+    matrix = shared_matrix
+
+
+def get_block_distances(block_args):
+    """
+    compute the distances between two blocks of samples, and write them (and their mirror) to the distance matrix file
+    """
+    (metric, distance_file, (i0, i1), (j0, j1)) = block_args
+    (block_i, block_j) = (matrix[i0:i1], matrix[j0:j1])
+
+    if metric == "braycurtis":
+        shared = numpy.zeros((i1 - i0, j1 - j0), dtype=numpy.float64)
+        taxon_slice = max(1, TAXON_SLICE_ELEMENTS // max(1, (i1 - i0) * (j1 - j0)))
+        for t0 in range(0, matrix.shape[1], taxon_slice):
+            shared += numpy.minimum(block_i[:, numpy.newaxis, t0:t0 + taxon_slice], block_j[numpy.newaxis, :, t0:t0 + taxon_slice]).sum(axis=2)
+        totals = block_i.sum(axis=1)[:, numpy.newaxis] + block_j.sum(axis=1)[numpy.newaxis, :]
+        distances = numpy.where(totals > 0, 1 - 2 * shared / numpy.where(totals > 0, totals, 1), 0)
+    else:
+        (present_i, present_j) = ((block_i > 0).astype(numpy.float64), (block_j > 0).astype(numpy.float64))
+        intersections = numpy.dot(present_i, present_j.T)
+        unions = present_i.sum(axis=1)[:, numpy.newaxis] + present_j.sum(axis=1)[numpy.newaxis, :] - intersections
+        distances = numpy.where(unions > 0, 1 - intersections / numpy.where(unions > 0, unions, 1), 0)
+
+    distances = numpy.maximum(distances, 0)     # (rounding)
+    distance_matrix = numpy.load(distance_file, mmap_mode="r+")
+    distance_matrix[i0:i1, j0:j1] = distances
+    distance_matrix[j0:j1, i0:i1] = distances.T
+    if i0 == j0:
+        distance_matrix[range(i0, i1), range(i0, i1)] = 0
+    distance_matrix.flush()
+    del distance_matrix
+    return (i1 - i0) * (j1 - j0)
+
+
+def write_distances(metric, samples, counts, options):
+    distance_file = os.path.join(options["output_folder"], "%s_distances.npy" % metric)
+    distance_matrix = numpy.lib.format.open_memmap(distance_file, mode="w+", dtype=numpy.float64, shape=(len(samples), len(samples)))
+    del distance_matrix
+
+    blocks = [(start, min(start + options["block_size"], len(samples))) for start in range(0, len(samples), options["block_size"])]
+    block_args = [(metric, distance_file, blocks[i], blocks[j]) for i in range(len(blocks)) for j in range(i, len(blocks))]
+    pool = multiprocessing.Pool(processes=max(1, min(options["num_processes"], len(block_args))), initializer=init_worker, initargs=(counts,))
+    for pairs in pool.imap_unordered(get_block_distances, block_args):
+        pass
+    pool.close()
+    pool.join()
+    print("wrote %s distances of %d samples to %s" % (metric, len(samples), distance_file), file=sys.stderr)
+
+    if options["tsv"]:
+        distance_matrix = numpy.load(distance_file, mmap_mode="r")
+        tsv_file = os.path.join(options["output_folder"], "%s_distances.txt" % metric)
+        with open(tsv_file, "w") as tsv_stream:
+            print("\t".join(["sample"] + samples), file=tsv_stream)
+            for (sample, row) in zip(samples, distance_matrix):
+                print("\t".join([sample] + ["%.6g" % value for value in row.tolist()]), file=tsv_stream)
+        print("wrote %s" % tsv_file, file=sys.stderr)
+
+
+def analyse(options):
+    (samples, taxa, counts) = read_frequency_table(options["table_file"])
+    print("read %d samples x %d taxa from %s" % (len(samples), len(taxa), options["table_file"]), file=sys.stderr)
+
+    measures = get_alpha_diversity(counts)
+    measure_names = [name for name in ("richness", "shannon", "simpson", "inverse_simpson", "pielou", "chao1") if name in measures]
+    with open(os.path.join(options["output_folder"], "alpha_diversity.txt"), "w") as alpha_stream:
+        print("\t".join(["sample"] + measure_names), file=alpha_stream)
+        for (i, sample) in enumerate(samples):
+            print("\t".join([sample] + ["%.6g" % measures[name][i] for name in measure_names]), file=alpha_stream)
+    with open(os.path.join(options["output_folder"], "samples.txt"), "w") as samples_stream:
+        for sample in samples:
+            print(sample, file=samples_stream)
+
+    if options["relative"]:
+        totals = counts.sum(axis=1)
+        counts = counts / numpy.where(totals > 0, totals, 1)[:, numpy.newaxis]
+    for metric in options["metrics"]:
+        write_distances(metric, samples, counts, options)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+alpha diversity of each sample, and distances between all pairs of samples, from a taxonomy frequency table (profile_prism.py --summary_type summary_table)
+
+examples :
+
+./cohort_diversity.py -j 16 -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/html/diversity /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/html/taxonomy_genus_frequency_table_plot.txt
+
+# just bray-curtis, of the relative frequencies, without the (large) tab-delimited distance matrix
+./cohort_diversity.py -j 16 -m braycurtis --relative --no_tsv -O /dataset/gseq_processing/scratch/melseq/cohort/diversity /dataset/gseq_processing/scratch/melseq/cohort/taxonomy_genus_frequency_table.npz
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('table_file', type=str, help='taxonomy frequency table (taxa x samples), or .npz matrix file, from profile_prism.py')
+    parser.add_argument('-O', '--output_folder', dest='output_folder', type=str, required=True, help='folder to write the diversity and distances to')
+    parser.add_argument('-m', '--metrics', dest='metrics', type=str, default="braycurtis,jaccard", help='comma separated distance metrics - braycurtis, jaccard (default both)')
+    parser.add_argument('-j', '--num_processes', dest='num_processes', type=int, default=4, help='number of processes to compute the blocks of distances (default 4)')
+    parser.add_argument('-B', '--block_size', dest='block_size', type=int, default=DEFAULT_BLOCK_SIZE, help='number of samples per block of the distance matrix (default %d)' % DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--relative', dest='relative', action='store_const', default=False, const=True, help='compute bray-curtis distances of the relative frequencies, rather than of the counts')
+    parser.add_argument('--no_tsv', dest='tsv', action='store_const', default=True, const=False, help='do not write the tab-delimited distance matrices (only the .npy)')
+
+    args = vars(parser.parse_args())
+
+    if not os.path.isfile(args["table_file"]):
+        raise cohort_diversity_exception("%s is not a file" % args["table_file"])
+    if not os.path.isdir(args["output_folder"]):
+        raise cohort_diversity_exception("%s is not a folder" % args["output_folder"])
+    args["metrics"] = [metric for metric in args["metrics"].split(",") if len(metric) > 0]
+    for metric in args["metrics"]:
+        if metric not in ("braycurtis", "jaccard"):
+            raise cohort_diversity_exception("unknown distance metric %s - should be braycurtis or jaccard" % metric)
+    if args["block_size"] < 1:
+        raise cohort_diversity_exception("block size must be at least 1")
+
+    return args
+
+
+def main():
+    options = get_options()
+    analyse(options)
+
+
+if __name__ == "__main__":
+   main()
@@ -1,11 +1,12 @@
 #!/bin/env pypy
 from __future__ import print_function
-import re, sys
-import itertools
+import seq_io
 
 def count_iter():
-    tuple_iter = (tuple(re.split("\s+", record.strip())) for record in sys.stdin  if len(record.strip()) > 0)
-    for my_tuple in tuple_iter:
-        yield int(re.split("=", my_tuple[0])[1])
+    # the count is parsed from the first (whitespace delimited) field of each non-empty record - e.g. Sequence59_count=2
+    for record in seq_io.line_iter(seq_io.open_input("-")):
+        fields = record.split(None, 1)
+        if len(fields) > 0:
+            yield int(fields[0].split(b"=")[1])
 
 print(sum(count_iter()))
@@ -1,14 +1,17 @@
 #!/bin/env pypy
 from __future__ import print_function
-import re, sys
-import itertools
+import seq_io
 
 def fasta_iter():
-    record_iter = (record.strip() for record in sys.stdin  if len(record.strip()) > 0)
-    seq_group_iter = itertools.groupby(record_iter, lambda record:{True:"name", False:"seq"}[record[0] == ">"])
-    name = None
-    for (group, records) in seq_group_iter:
-        if group == "name":
-            yield int(re.split("=", records.next())[1])
+    # (a run of consecutive name lines is counted once, by its first name)
+    previous_was_name = False
+    for record in seq_io.line_iter(seq_io.open_input("-")):
+        record = record.strip()
+        if len(record) == 0:
+            continue
+        is_name = record[0:1] == b">"
+        if is_name and not previous_was_name:
+            yield int(record.split(b"=")[1])
+        previous_was_name = is_name
 
 print(sum(fasta_iter()))
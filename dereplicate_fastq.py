@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import heapq
+import itertools
+import tempfile
+import argparse
+import seq_io
+
+#
+# one-pass replacement for
+#
+# cat _condition_fastq2fasta_input_sample.fastq | add_sample_name.py sample > sample.fasta
+# cat sample.fasta | countUniqueReads.sh TEMP > sample.non-redundant.fasta
+#
+# i.e. the trimmed fastq (plain or gzipped) is read once, the unique sequences are counted in a hash table,
+# and the non-redundant fasta is written directly, in the same format as countUniqueReads.sh - i.e. sorted by
+# sequence, and named by sequence number and count - e.g.
+#
+#>Sequence1_count=3
+#AAAAAAAAAAGGTCTTCAGCAAAAAGCCGCTG
+#>Sequence2_count=1
+#AAAAAAAAAATCTGCAGCCTGCGCTTCAAACAGCTCCC
+#
+# If the table of unique sequences grows beyond the memory budget, it is written to a sorted
+# partition on disk, and the partitions are merged at the end - at most MAX_MERGE_FAN_IN at a time (if
+# there are more, they are first merged in passes into fewer, larger partitions), so that the number of
+# open files is bounded.
+#
+
+ESTIMATED_ENTRY_OVERHEAD = 100    # approximate bytes used by the hash table per unique sequence, in addition to the sequence
+MAX_MERGE_FAN_IN = 64             # maximum number of sorted streams merged at once
+
+
+class dereplicate_exception(Exception):
+    def __init__(self,args=None):
+        super(dereplicate_exception, self).__init__(args)
+
+
+def write_partition(count_iter, temp_folder):
+    """
+    write an iterator of (sequence, count), sorted by sequence, to a temporary file, and return its name
+    """
+    (handle, partition_filename) = tempfile.mkstemp(prefix="dereplicate_", suffix=".partition", dir=temp_folder)
+    with os.fdopen(handle, "wb") as partition:
+        for (seq, count) in count_iter:
+            partition.write(b"%s\t%d\n" % (seq, count) if sys.version_info[0] >= 3 else "%s\t%d\n" % (seq, count))
+    return partition_filename
+
+
+def partition_iter(partition_filename):
+    with open(partition_filename, "rb") as partition:
+        for record in partition:
+            (seq, count) = record.rstrip(b"\n").split(b"\t")
+            yield (seq, int(count))
+
+
+def merge_counts(count_iters):
+    """
+    merge iterators of (sequence, count) sorted by sequence, summing the counts of each sequence
+    """
+    merged = heapq.merge(*count_iters)
+    return ((seq, sum(count for (seq2, count) in group)) for (seq, group) in itertools.groupby(merged, lambda item: item[0]))
+
+
+def reduce_partitions(partitions, max_partitions, temp_folder):
+    """
+    merge the partitions, MAX_MERGE_FAN_IN at a time, into new partitions until there are no more than
+    max_partitions, removing each merged partition as soon as it has been merged (the list is updated in place, so
+    that it always names the partitions to be cleaned up)
+    """
+    while len(partitions) > max_partitions:
+        group = partitions[:MAX_MERGE_FAN_IN]
+        partitions.append(write_partition(merge_counts([partition_iter(partition) for partition in group]), temp_folder))
+        del partitions[:MAX_MERGE_FAN_IN]
+        for partition in group:
+            os.remove(partition)
+
+
+def count_sequences(seq_iter, memory_budget, temp_folder):
+    """
+    count the unique sequences, spilling sorted partitions to disk if the memory budget is exceeded. Returns
+    an iterator of (sequence, count) sorted by sequence, and the list of partition files (to be cleaned up)
+    """
+    counts = {}
+    memory_used = 0
+    partitions = []
+    for seq in seq_iter:
+        if seq in counts:
+            counts[seq] += 1
+        else:
+            counts[seq] = 1
+            memory_used += len(seq) + ESTIMATED_ENTRY_OVERHEAD
+            if memory_used > memory_budget:
+                partitions.append(write_partition(((seq, counts[seq]) for seq in sorted(counts)), temp_folder))
+                counts = {}
+                memory_used = 0
+
+    in_memory = ((seq, counts[seq]) for seq in sorted(counts))
+    if len(partitions) == 0:
+        return (in_memory, partitions)
+
+    # merge the partitions (and the table still in memory), summing the counts of each sequence
+    try:
+        reduce_partitions(partitions, MAX_MERGE_FAN_IN - 1, temp_folder)
+    except:
+        for partition in partitions:
+            if os.path.exists(partition):
+                os.remove(partition)
+        raise
+    return (merge_counts([in_memory] + [partition_iter(partition) for partition in partitions]), partitions)
+
+
+def write_non_redundant_fasta(count_iter, out_stream):
+    number = 0
+    for (seq, count) in count_iter:
+        number += 1
+        out_stream.write(b">Sequence%d_count=%d\n%s\n" % (number, count, seq) if sys.version_info[0] >= 3 else ">Sequence%d_count=%d\n%s\n" % (number, count, seq))
+    return number
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+Writes a non-redundant fasta file (as would be written by add_sample_name.py and countUniqueReads.sh) directly from
+a trimmed fastq file (plain or gzipped)
+
+examples :
+
+./dereplicate_fastq.py -T /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/TEMP -o /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/fasta/SQ1738_HWFLWDRXY_s_merged_fastq.txt.gz.demultiplexed_978876_CTTAGTTGCA_psti.R1_trimmed.fastq.non-redundant.fasta /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/trimming/SQ1738_HWFLWDRXY_s_merged_fastq.txt.gz.demultiplexed_978876_CTTAGTTGCA_psti.R1_trimmed.fastq
+
+gunzip -c 978876_CTTAGTTGCA_psti.R1_trimmed.fastq.gz | ./dereplicate_fastq.py - > 978876_CTTAGTTGCA_psti.R1_trimmed.fastq.non-redundant.fasta
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputfile', type=str, help='trimmed fastq (or fasta) file, optionally compressed with gzip ( - for stdin)')
+    parser.add_argument('-o', '--output_file', dest='output_file', type=str, default=None, help='non-redundant fasta file to write (default stdout)')
+    parser.add_argument('-T', '--temp_folder', dest='temp_folder', type=str, default=None, help='folder for sorted partitions, if the memory budget is exceeded')
+    parser.add_argument('-M', '--memory_mb', dest='memory_mb', type=int, default=4000, help='approximate memory budget (Mb) for the table of unique sequences (default 4000)')
+
+    args = vars(parser.parse_args())
+
+    if args["inputfile"] != "-" and not os.path.isfile(args["inputfile"]):
+        raise dereplicate_exception("%(inputfile)s is not a file" % args)
+    if args["temp_folder"] is not None and not os.path.isdir(args["temp_folder"]):
+        raise dereplicate_exception("%(temp_folder)s is not a folder" % args)
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    seq_stream = seq_io.open_input(options["inputfile"])
+    (count_iter, partitions) = count_sequences(seq_io.sequence_iter(seq_stream), options["memory_mb"] * 1024 * 1024, options["temp_folder"])
+
+    try:
+        if options["output_file"] is None:
+            unique_count = write_non_redundant_fasta(count_iter, seq_io.open_output())
+        else:
+            # write to a temporary name and rename when complete, so an interrupted run does not leave a plausible-looking output
+            temp_output = "%s.part" % options["output_file"]
+            with seq_io.open_output(temp_output) as out_stream:
+                unique_count = write_non_redundant_fasta(count_iter, out_stream)
+            os.rename(temp_output, options["output_file"])
+    finally:
+        for partition in partitions:
+            os.remove(partition)
+
+    print("wrote %d unique sequences from %s (%d partitions)" % (unique_count, options["inputfile"], len(partitions)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import heapq
+import itertools
+import argparse
+from merge_lanes import non_redundant_fasta_iter
+
+#
+# run-wide dereplication, so that each unique sequence is blasted once per run, rather than once per sample.
+#
+# build_catalogue merges the (sorted) per-sample non-redundant fasta files into a single catalogue of the unique
+# sequences across all samples - in the same format as the per-sample files, with the total count e.g.
+#
+#>Sequence1_count=3512
+#AAAAAAAAAAGGTCTTCAGCAAAAAGCCGCTG
+#
+# and writes a sample x sequence count table, listing for each catalogue sequence the (zero based) sample numbers
+# and counts of the samples it occurs in, e.g.
+#
+#1       0:12    3:3400  17:100
+#
+# (the samples are listed, in order, in catalogue.samples.txt)
+#
+# The catalogue is then blasted and summarised, and expand_summaries rebuilds a summary for each sample from
+# the catalogue summary. As the catalogue and each sample are sorted by sequence, the position of a sequence among
+# those present in a sample gives its original per-sample sequence number, so the rebuilt summaries are the same as
+# summarising each sample's own blast results. The catalogue summary is written collapsed (melseq_prism.sh summarises
+# the catalogue with -F collapsed), as each catalogue sequence carries its run-wide count
+#
+
+CATALOGUE_FASTA = "catalogue.non-redundant.fasta"
+CATALOGUE_COUNTS = "catalogue.counts.txt"
+CATALOGUE_SAMPLES = "catalogue.samples.txt"
+RANK_COUNT = 7
+EXPANDED_CHUNK_RECORDS = 4096
+
+
+class global_dereplicate_exception(Exception):
+    def __init__(self,args=None):
+        super(global_dereplicate_exception, self).__init__(args)
+
+
+def sample_sequence_iter(filename, sample_number):
+    for (seq, count) in non_redundant_fasta_iter(filename):
+        yield (seq, sample_number, count)
+
+
+def build_catalogue(options):
+    """
+    k-way merge of the sample non-redundant fasta files, writing the catalogue fasta, count table and sample list
+    """
+    sample_files = options["filenames"]
+    merged = heapq.merge(*[sample_sequence_iter(filename, sample_number) for (sample_number, filename) in enumerate(sample_files)])
+
+    catalogue_fasta = os.path.join(options["output_folder"], CATALOGUE_FASTA)
+    catalogue_counts = os.path.join(options["output_folder"], CATALOGUE_COUNTS)
+    number = 0
+    total = 0
+    with open("%s.part" % catalogue_fasta, "wb") as fasta_stream, open("%s.part" % catalogue_counts, "w") as count_stream:
+        for (seq, group) in itertools.groupby(merged, lambda item: item[0]):
+            number += 1
+            sample_counts = [(item[1], item[2]) for item in group]
+            count = sum(item[1] for item in sample_counts)
+            total += count
+            fasta_stream.write(b">Sequence" + str(number).encode() + b"_count=" + str(count).encode() + b"\n" + seq + b"\n")
+            count_stream.write("%d\t%s\n" % (number, "\t".join("%d:%d" % item for item in sample_counts)))
+    os.rename("%s.part" % catalogue_fasta, catalogue_fasta)
+    os.rename("%s.part" % catalogue_counts, catalogue_counts)
+
+    with open(os.path.join(options["output_folder"], CATALOGUE_SAMPLES), "w") as sample_stream:
+        for filename in sample_files:
+            print(os.path.realpath(filename), file=sample_stream)
+
+    print("catalogued %d unique sequences (%d sequences in total) from %d samples to %s" % (number, total, len(sample_files), catalogue_fasta), file=sys.stderr)
+
+
+def count_table_iter(catalogue_folder):
+    """
+    yield (catalogue sequence number, [(sample number, count),...]) from the count table
+    """
+    with open(os.path.join(catalogue_folder, CATALOGUE_COUNTS), "r") as count_stream:
+        for record in count_stream:
+            fields = record.rstrip("\n").split("\t")
+            yield (int(fields[0]), [tuple(int(token) for token in field.split(":")) for field in fields[1:]])
+
+
+def load_catalogue_summary(summary_file):
+    """
+    read a summary of the catalogue (expanded or collapsed) into a dictionary of catalogue sequence number => rank names
+    (as a tab-delimited string). Records for the same sequence (expanded summaries) are only stored once, and identical
+    lineages share a string
+    """
+    lineages = {}
+    assignments = {}
+    with open(summary_file, "r") as summary_stream:
+        for record in summary_stream:
+            fields = record.rstrip("\r\n").split("\t")
+            match = re.match("^Sequence(\d+)_", fields[0])
+            if match is None:
+                raise global_dereplicate_exception("could not parse sequence number from %s in %s" % (fields[0], summary_file))
+            lineage = "\t".join(fields[1:1 + RANK_COUNT])
+            assignments[int(match.groups()[0])] = lineages.setdefault(lineage, lineage)
+    return assignments
+
+
+def get_sample_summary_filename(catalogue_summary_file, sample_file, output_folder):
+    """
+    e.g. catalogue.non-redundant.fasta.blastn.GTDB1.num_threads4taskblastnword_size16outfmt6stdqlenevalue0.02.summary and
+    fasta/X.non-redundant.fasta yields output_folder/X.non-redundant.fasta.blastn.GTDB1.num_threads4taskblastnword_size16outfmt6stdqlenevalue0.02.summary
+    """
+    summary_base = os.path.basename(catalogue_summary_file)
+    if not summary_base.startswith(CATALOGUE_FASTA):
+        raise global_dereplicate_exception("%s does not look like a summary of %s" % (catalogue_summary_file, CATALOGUE_FASTA))
+    return os.path.join(output_folder, os.path.basename(sample_file) + summary_base[len(CATALOGUE_FASTA):])
+
+
+def expand_summaries(options):
+    """
+    rebuild the per-sample summaries from the catalogue summary, numbering each sequence as in the sample's own
+    non-redundant fasta. (Samples are written in batches, to limit the number of open files)
+    """
+    with open(os.path.join(options["catalogue_folder"], CATALOGUE_SAMPLES), "r") as sample_stream:
+        sample_files = [record.strip() for record in sample_stream if len(record.strip()) > 0]
+
+    for catalogue_summary_file in options["filenames"]:
+        assignments = load_catalogue_summary(catalogue_summary_file)
+        print("loaded %d assigned sequences from %s" % (len(assignments), catalogue_summary_file), file=sys.stderr)
+
+        for batch_start in range(0, len(sample_files), options["batch_size"]):
+            batch = range(batch_start, min(batch_start + options["batch_size"], len(sample_files)))
+            summary_streams = dict((sample_number, open(get_sample_summary_filename(catalogue_summary_file, sample_files[sample_number], options["output_folder"]), "w")) for sample_number in batch)
+            sequence_numbers = dict((sample_number, 0) for sample_number in batch)
+
+            for (catalogue_number, sample_counts) in count_table_iter(options["catalogue_folder"]):
+                lineage = assignments.get(catalogue_number)
+                for (sample_number, count) in sample_counts:
+                    if sample_number not in summary_streams:
+                        continue
+                    sequence_numbers[sample_number] += 1
+                    if lineage is None:
+                        continue
+                    if options["summary_format"] == "collapsed":
+                        summary_streams[sample_number].write("Sequence%d_count=%d\t%s\t%d\n" % (sequence_numbers[sample_number], count, lineage, count))
+                    else:
+                        # (cloned in bounded chunks, so a very abundant sequence is not built as one huge string)
+                        record = "Sequence%d_count=%d\t%s\n" % (sequence_numbers[sample_number], count, lineage)
+                        for chunk_start in range(0, count, EXPANDED_CHUNK_RECORDS):
+                            summary_streams[sample_number].write(record * min(EXPANDED_CHUNK_RECORDS, count - chunk_start))
+
+            for summary_stream in summary_streams.values():
+                summary_stream.close()
+
+        print("wrote summaries for %d samples from %s" % (len(sample_files), catalogue_summary_file), file=sys.stderr)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+builds a run-wide catalogue of the unique sequences in the per-sample non-redundant fasta files (so that each is
+only blasted once), and rebuilds per-sample summaries from the summary of the catalogue
+
+examples :
+
+./global_dereplicate.py -t build_catalogue -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/catalogue /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/*.non-redundant.fasta
+
+./global_dereplicate.py -t expand_summaries -C /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/catalogue -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summary /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summary/catalogue.non-redundant.fasta.blastn.GTDB1.num_threads4taskblastnword_size16outfmt6stdqlenevalue0.02.summary
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames', type=str, nargs="+", help='sample non-redundant fasta files (build_catalogue) or catalogue summary files (expand_summaries)')
+    parser.add_argument('-t', '--task', dest='task', type=str, default="build_catalogue", choices=["build_catalogue", "expand_summaries"], help="what you want to do")
+    parser.add_argument('-O', '--output_folder', dest='output_folder', type=str, required=True, help='folder for the catalogue (build_catalogue) or per-sample summaries (expand_summaries)')
+    parser.add_argument('-C', '--catalogue_folder', dest='catalogue_folder', type=str, default=None, help='folder containing the catalogue (expand_summaries)')
+    parser.add_argument('-F', '--summary_format', dest='summary_format', type=str, default="expanded", choices=["expanded", "collapsed"], help="format of the per-sample summaries (default expanded)")
+    parser.add_argument('-B', '--batch_size', dest='batch_size', type=int, default=500, help='maximum number of sample summaries to write at once (default 500)')
+
+    args = vars(parser.parse_args())
+
+    for filename in args["filenames"]:
+        if not os.path.isfile(filename):
+            raise global_dereplicate_exception("%s is not a file" % filename)
+    if not os.path.isdir(args["output_folder"]):
+        raise global_dereplicate_exception("%(output_folder)s is not a folder" % args)
+    if args["task"] == "expand_summaries":
+        if args["catalogue_folder"] is None or not os.path.isfile(os.path.join(args["catalogue_folder"], CATALOGUE_COUNTS)):
+            raise global_dereplicate_exception("expand_summaries requires a catalogue folder (-C) containing %s" % CATALOGUE_COUNTS)
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    if options["task"] == "build_catalogue":
+        build_catalogue(options)
+    elif options["task"] == "expand_summaries":
+        expand_summaries(options)
+
+
+if __name__ == "__main__":
+   main()
@@ -58,8 +58,12 @@ nohup find gtdb_genomes_reps_r207/GCF -name ".fna.gz" -exec gunzip -c {} ; >> GC
 function collate_fasta() {
    rm $BUILD_DIR/GCA.fna
    rm $BUILD_DIR/GCF.fna
-   nohup find $BUILD_DIR/gtdb_genomes_reps_r207/GCA -name "*.fna.gz" -exec pypy format_database.py -t format_fasta {} \; >> $BUILD_DIR/GCA.fna &
-   nohup find $BUILD_DIR/gtdb_genomes_reps_r207/GCF -name "*.fna.gz" -exec pypy format_database.py -t format_fasta {} \; >> $BUILD_DIR/GCF.fna &
+   # each collection is formatted by a single invocation, using a pool of workers (rather than one process per genome), 
+   # which also writes a manifest of the accession, contig and length of each sequence
+   find $BUILD_DIR/gtdb_genomes_reps_r207/GCA -name "*.fna.gz" | sort > $BUILD_DIR/GCA_genomes.txt
+   find $BUILD_DIR/gtdb_genomes_reps_r207/GCF -name "*.fna.gz" | sort > $BUILD_DIR/GCF_genomes.txt
+   nohup pypy format_database.py -t format_fasta -j 8 -F $BUILD_DIR/GCA_genomes.txt -O $BUILD_DIR/GCA.fna -M $BUILD_DIR/GCA.manifest.txt &
+   nohup pypy format_database.py -t format_fasta -j 8 -F $BUILD_DIR/GCF_genomes.txt -O $BUILD_DIR/GCF.fna -M $BUILD_DIR/GCF.manifest.txt &
    cd 
 
 }
@@ -71,8 +75,28 @@ function make_blast_db() {
    nohup makeblastdb -in GCF.fna -dbtype nucl &
 }
 
+function make_dedup_blast_db() {
+   # merge GCA.fna and GCF.fna (see collate_fasta) into a single blast database with each distinct contig sequence only once,
+   # so that queries are not searched against (and summarised over) many identical copies. The duplicates file lists the 
+   # accessions of the copies of each contig kept - melseq_prism.sh passes it to summarize_counts.py -d when it sits alongside 
+   # the database (i.e. melseq_prism.sh -b $BUILD_DIR/GTDB1_dedup)
+   # conda activate /dataset/bioinformatics_dev/active/conda-env/blast2.9 before running this
+   cd $BUILD_DIR
+   pypy format_database.py -t dedupe_fasta -O $BUILD_DIR/GTDB1_dedup.fna -d $BUILD_DIR/GTDB1_dedup.duplicates.txt $BUILD_DIR/GCA.fna $BUILD_DIR/GCF.fna > $BUILD_DIR/GTDB1_dedup.log 2>&1
+   makeblastdb -in GTDB1_dedup.fna -dbtype nucl -out GTDB1_dedup -max_file_sz 4GB >> $BUILD_DIR/GTDB1_dedup.log 2>&1
+}
+
 function format_taxonomy() {
     ./format_database.py -t format_taxonomy bac120_taxonomy_r207.tsv.gz ar53_taxonomy_r207.tsv.gz > $BUILD_DIR/GTDB1_taxonomy.csv
+    # compile the binary index memory-mapped by summarize_counts.py
+    ./format_database.py -t build_index -O $BUILD_DIR/GTDB1_taxonomy.idx $BUILD_DIR/GTDB1_taxonomy.csv
+}
+
+function make_tag_index() {
+   # digest the reference genomes in silico, and index the LCA of each PstI tag, so that reads which exactly match a 
+   # reference tag can be assigned without being blasted (melseq_prism.sh -X). Needs the taxonomy index (see format_taxonomy)
+   cd $BUILD_DIR
+   nohup pypy format_database.py -t build_tag_index -j 16 -T $BUILD_DIR/GTDB1_taxonomy.idx -O $BUILD_DIR/GTDB1_PstI.tags -F $BUILD_DIR/GCA_genomes.txt -F $BUILD_DIR/GCF_genomes.txt > $BUILD_DIR/GTDB1_PstI.tags.log 2>&1 &
 }
 
 function test_summary() {
@@ -84,5 +108,7 @@ function test_summary() {
 
 #collate_fasta
 #make_blast_db
+#make_dedup_blast_db
 #format_taxonomy 
+#make_tag_index
 test_summary
@@ -4,8 +4,15 @@ import sys
 import os
 import re
 import argparse
-sys.path.append('/dataset/bioinformatics_dev/active/data_prism') 
-from data_prism import  get_text_stream
+import hashlib
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))    # for seq_io
+import seq_io
+import taxonomy_index
+import tag_index
+import summarize_counts
+
+OUTPUT_BUFFER_SIZE = 16 * 1024 * 1024
 
 class format_database_exception(Exception):
     def __init__(self,args=None):
@@ -18,16 +25,51 @@ def get_options():
 examples :
 
 ./format_database.py -t format_fasta /dataset/gseq_processing/scratch/melseq/gtdb/gtdb_genomes_reps_r207/GCA/001/775/355/GCA_001775355.1_genomic.fna.gz
+./format_database.py -t format_fasta -j 16 -F GCA_genomes.txt -O GCA.fna -M GCA.manifest.txt
 ./format_database.py -t format_taxonomy bac120_taxonomy_r207.tsv.gz ar53_taxonomy_r207.tsv.gz
+./format_database.py -t build_index -O GTDB1_taxonomy.idx GTDB1_taxonomy.csv
+./format_database.py -t build_tag_index -j 16 -T GTDB1_taxonomy.idx -O GTDB1_PstI.tags -F GCA_genomes.txt -F GCF_genomes.txt
+./format_database.py -t build_tag_index -T GTDB1_taxonomy.idx -O GTDB1_PstI.tags GCA.fna GCF.fna
+./format_database.py -t dedupe_fasta -O GTDB1_dedup.fna -d GTDB1_dedup.duplicates.txt GCA.fna GCF.fna
 
     """
     parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
     parser.add_argument('inputfiles', type=str, nargs="*",help='input filename')
     parser.add_argument('-t', '--task' , dest='task', required=False, default="format_taxonomy" , type=str,
-                        choices=["format_fasta", "format_taxonomy"], help="what you want to do")
+                        choices=["format_fasta", "format_taxonomy", "build_index", "build_tag_index", "dedupe_fasta"], help="what you want to do")
+    parser.add_argument('-O', '--output_file', dest='output_file', type=str, default=None, help='output file (required for build_index, build_tag_index and dedupe_fasta - for format_fasta, default is stdout)')
+    parser.add_argument('-F', '--input_fof', dest='input_fof', type=str, action='append', default=[], help='file of input filenames (format_fasta, build_tag_index, dedupe_fasta - in addition to any listed on the command line) (may be repeated)')
+    parser.add_argument('-M', '--manifest_file', dest='manifest_file', type=str, default=None, help='optional manifest of accession, contig and length to write (format_fasta)')
+    parser.add_argument('-j', '--num_processes', dest='num_processes', type=int, default=1, help='number of processes to use (format_fasta, build_tag_index) (default 1)')
+    parser.add_argument('-T', '--taxonomy_index', dest='taxonomy_index', type=str, default=summarize_counts.DEFAULT_TAXONOMY_INDEX, help='taxonomy index compiled by build_index (build_tag_index) (default %s)' % summarize_counts.DEFAULT_TAXONOMY_INDEX)
+    parser.add_argument('-e', '--site', dest='site', type=str, default=tag_index.DEFAULT_SITE, help='restriction site (build_tag_index) (default %s)' % tag_index.DEFAULT_SITE)
+    parser.add_argument('-c', '--cut_offset', dest='cut_offset', type=int, default=tag_index.DEFAULT_CUT_OFFSET, help='offset of the start of the reads from the start of the site (build_tag_index) (default %d)' % tag_index.DEFAULT_CUT_OFFSET)
+    parser.add_argument('-k', '--tag_length', dest='tag_length', type=int, default=tag_index.DEFAULT_TAG_LENGTH, help='number of bases of each tag to index (build_tag_index) (default %d)' % tag_index.DEFAULT_TAG_LENGTH)
+    parser.add_argument('-m', '--min_tag_length', dest='min_tag_length', type=int, default=tag_index.DEFAULT_MIN_TAG_LENGTH, help='shortest (whole fragment) tag to index (build_tag_index) (default %d)' % tag_index.DEFAULT_MIN_TAG_LENGTH)
+    parser.add_argument('-d', '--duplicates_file', dest='duplicates_file', type=str, default=None, help='mapping of each contig kept to the accessions of its duplicates, to write (required for dedupe_fasta)')
+    parser.add_argument('-D', '--temp_folder', dest='temp_folder', type=str, default=None, help='folder for temporary sort files (build_tag_index) (default the folder of the output file)')
     
     args = vars(parser.parse_args())
 
+    for input_fof in args["input_fof"]:
+        with open(input_fof, "r") as input_fof_stream:
+            args["inputfiles"] += [record.strip() for record in input_fof_stream if len(record.strip()) > 0]
+
+    if args["task"] in ("build_index", "build_tag_index", "dedupe_fasta") and args["output_file"] is None:
+        raise format_database_exception("%(task)s requires an output file (-O)" % args)
+    if args["task"] == "dedupe_fasta":
+        if args["duplicates_file"] is None:
+            raise format_database_exception("dedupe_fasta requires a duplicates file (-d)")
+        if os.path.realpath(args["output_file"]) in [os.path.realpath(filename) for filename in args["inputfiles"]]:
+            raise format_database_exception("%(output_file)s is an input file - it would be overwritten" % args)
+    if args["task"] == "build_tag_index":
+        if not os.path.isfile(args["taxonomy_index"]) or not taxonomy_index.is_index_file(args["taxonomy_index"]):
+            raise format_database_exception("%(taxonomy_index)s is not a taxonomy index (see -t build_index)" % args)
+        if args["cut_offset"] < 0 or args["cut_offset"] > len(args["site"]):
+            raise format_database_exception("cut offset must be within the site")
+        if args["temp_folder"] is None:
+            args["temp_folder"] = os.path.dirname(os.path.realpath(args["output_file"]))
+
     return args
 
 def format_fasta_entries(args):
@@ -46,20 +88,81 @@ def format_fasta_entries(args):
      example :
      ./format_fasta_entries.py /dataset/gseq_processing/scratch/melseq/gtdb/gtdb_genomes_reps_r207/GCA/001/775/355/GCA_001775355.1_genomic.fna.gz 
     
+    Many genomes can be formatted in one invocation - these are formatted by a pool of worker processes, and written
+    in the order given to the output file, along with an optional manifest listing the accession, contig and length of
+    each sequence
+    """
+    if args["output_file"] is None:
+        out_stream = getattr(sys.stdout, "buffer", sys.stdout)
+    else:
+        out_stream = open(args["output_file"], "wb", OUTPUT_BUFFER_SIZE)
+    manifest_stream = None
+    if args["manifest_file"] is not None:
+        manifest_stream = open(args["manifest_file"], "w")
+        print("accession\tcontig\tlength", file=manifest_stream)
+
+    if args["num_processes"] > 1 and len(args["inputfiles"]) > 1:
+        pool = multiprocessing.Pool(processes=args["num_processes"])
+        formatted_iter = pool.imap(format_genome, args["inputfiles"], chunksize=8)    # (imap keeps the input order)
+    else:
+        pool = None
+        formatted_iter = (format_genome(seq_file) for seq_file in args["inputfiles"])
+
+    genome_count = 0
+    for (formatted, manifest) in formatted_iter:
+        genome_count += 1
+        out_stream.write(formatted)
+        if manifest_stream is not None:
+            manifest_stream.write("".join("%s\t%s\t%d\n"%item for item in manifest))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if args["output_file"] is not None:
+        out_stream.close()
+    if manifest_stream is not None:
+        manifest_stream.close()
+    print("formatted %d genomes"%genome_count, file=sys.stderr)
+
+def get_file_accession(seq_file):
+    """
+    e.g. GCF_012927245.1_genomic.fna.gz => GCF_012927245.1 (or None)
     """
-    seq_file = args["inputfiles"][0]
-    
     match = re.match("^([^\.]+\.\d*)_", os.path.basename(seq_file))
     if match is None:
+        return None
+    return match.groups()[0]
+
+def format_genome(seq_file):
+    """
+    format a single genome - returns the formatted fasta (bytes), and a list of (accession, contig, length)
+    """
+    accession = get_file_accession(seq_file)
+    if accession is None:
         raise Exception("unable to parse seq filename from %s"%os.path.basename(seq_file))
-    accession = match.groups()[0]
- 
-    for record in get_text_stream(seq_file):
-        match = re.match("^>(\S+)", record )
-        if match is not None:
-            sys.stdout.write(">GTDB1:%s_%s\n"%(accession, record.strip()[1:]))
+    name_prefix = (">GTDB1:%s_"%accession).encode()
+
+    # (genomes are formatted in parallel by the pool, so each is decompressed in-process)
+    seq_stream = seq_io.open_input(seq_file, parallel=False)
+
+    formatted = []
+    manifest = []
+    (contig, length) = (None, 0)
+    for record in seq_io.line_iter(seq_stream):
+        if record[0:1] == b">" and len(record) > 1 and not record[1:2].isspace():
+            if contig is not None:
+                manifest.append((accession, contig, length))
+            (contig, length) = (record[1:].split()[0].decode(), 0)
+            formatted.append(name_prefix + record.strip()[1:])
         else:
-            sys.stdout.write(record)
+            formatted.append(record)
+            length += len(record)
+    if contig is not None:
+        manifest.append((accession, contig, length))
+    seq_stream.close()
+    formatted.append(b"")
+
+    return (b"\n".join(formatted), manifest)
 
 def format_taxonomy(args):
     """
@@ -87,12 +190,161 @@ Actinomyces_denticolens_PA,Actinomyces denticolens,Actinomyces,Bacteria,Actinoba
     print("ID,Species,Genus,T_Kingdom,T_Phylum,T_Class,T_Order,T_Family,T_Genus,T_Species")
     
     for tax_file in args["inputfiles"]:
-        for record in get_text_stream(tax_file):
-            (accession,taxonomy) = re.split("\t",record.strip())
+        for record in seq_io.line_iter(seq_io.open_input(tax_file)):
+            (accession,taxonomy) = re.split("\t",record.decode().strip())
             (division,phylum,clas,order,family,genus,species) = (item[3:] for item in re.split(";",taxonomy))
             print(",".join((accession[3:], species,genus,division,phylum,clas,order,family,genus,species)))
             
 
+def build_index(args):
+    """
+compile the taxonomy csv written by format_taxonomy, e.g.
+
+ID,Species,Genus,T_Kingdom,T_Phylum,T_Class,T_Order,T_Family,T_Genus,T_Species
+GCF_000566285.1,Escherichia coli,Escherichia,Bacteria,Proteobacteria,Gammaproteobacteria,Enterobacterales,Enterobacteriaceae,Escherichia,Escherichia coli
+
+into the binary index described in taxonomy_index.py, so that summary tasks can memory map it
+rather than each parse the csv. As in the summarizeR_counts.code taxonomiser, the redundant
+columns 2 and 3 are dropped, and NA means NA
+    """
+    def accession_lineage_iter():
+        for tax_file in args["inputfiles"]:
+            tax_stream = seq_io.line_iter(seq_io.open_input(tax_file))
+            next(tax_stream)   # heading
+            for record in tax_stream:
+                fields = record.decode("utf-8").strip().split(",")
+                if len(fields) < 10:
+                    continue
+                yield (fields[0], tuple(None if field == "NA" else field for field in fields[3:10]))
+
+    (accession_count, lineage_count, string_count) = taxonomy_index.write_index(accession_lineage_iter(), 7, args["output_file"])
+    print("wrote %d accessions, %d distinct lineages, %d distinct names to %s"%(accession_count, lineage_count, string_count, args["output_file"]), file=sys.stderr)
+
+
+def genome_tags_iter(seq_file, site, cut_offset, tag_length, min_tag_length):
+    """
+    yield (accession, [tag hashes]) for each genome in a fasta file - either a formatted file (e.g. GCA.fna, with
+    names like >GTDB1:GCF_012927245.1_JAFARC010000014.1), which may contain many genomes, or a single genome
+    named as in the GTDB release (e.g. GCF_012927245.1_genomic.fna.gz)
+    """
+    file_accession = get_file_accession(seq_file)
+    (accession, tag_hashes) = (None, set())
+    with seq_io.open_input(seq_file, parallel=False) as seq_stream:
+        for (name, seq) in seq_io.fasta_iter(seq_stream):
+            contig_accession = file_accession
+            if name.startswith(b"GTDB1:"):
+                contig_accession = summarize_counts.get_accession(name.split()[0].decode())
+            if contig_accession is None:
+                raise format_database_exception("unable to parse accession from %s in %s" % (name[0:80], seq_file))
+            if contig_accession != accession:
+                if accession is not None:
+                    yield (accession, list(tag_hashes))
+                (accession, tag_hashes) = (contig_accession, set())
+            tag_hashes.update(tag_index.get_tag_hash(tag) for tag in tag_index.tag_iter(seq, site, cut_offset, tag_length, min_tag_length))
+    if accession is not None:
+        yield (accession, list(tag_hashes))
+
+def digest_genome_file(digest_args):
+    return list(genome_tags_iter(*digest_args))
+
+def build_tag_index(args):
+    """
+digest the reference genomes in silico, and compile the tag -> LCA lineage index described in tag_index.py.
+Each tag is assigned the LCA (as in summarize_counts.py) of the lineages of all the genomes it occurs in (genomes
+which are not in the taxonomy are skipped). Single-genome files can be digested by a pool of worker processes (-j) -
+a formatted file containing many genomes (e.g. GCA.fna) is better digested by itself, as each worker holds the tags
+of a whole file
+    """
+    taxonomy = taxonomy_index.taxonomy_index(args["taxonomy_index"])
+    digest_args = [(seq_file, args["site"].upper().encode("ascii"), args["cut_offset"], args["tag_length"], args["min_tag_length"]) for seq_file in args["inputfiles"]]
+
+    if args["num_processes"] > 1 and len(digest_args) > 1:
+        pool = multiprocessing.Pool(processes=args["num_processes"])
+        genome_iter = (genome for genomes in pool.imap(digest_genome_file, digest_args, chunksize=8) for genome in genomes)
+    else:
+        pool = None
+        genome_iter = (genome for digest_arg in digest_args for genome in genome_tags_iter(*digest_arg))
+
+    sorter = tag_index.tag_sorter(args["temp_folder"])
+    (genome_count, skipped_count, tag_count) = (0, 0, 0)
+    for (accession, tag_hashes) in genome_iter:
+        lineage_number = taxonomy.get_lineage_number(accession)
+        if lineage_number is None:
+            skipped_count += 1
+            continue
+        genome_count += 1
+        tag_count += len(tag_hashes)
+        sorter.add(tag_hashes, lineage_number)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("digested %d genomes (%d tags) - skipped %d genomes which are not in the taxonomy" % (genome_count, tag_count, skipped_count), file=sys.stderr)
+
+    lca_cache = {}
+    def tag_lineage_iter():
+        for (tag_hash, lineage_numbers) in sorter.merged_iter():
+            key = tuple(lineage_numbers)
+            if key not in lca_cache:
+                lca_cache[key] = summarize_counts.get_lineage_lca([taxonomy.get_lineage(lineage_number) for lineage_number in lineage_numbers])
+            yield (tag_hash, lca_cache[key])
+
+    try:
+        (tag_count, lineage_count, string_count) = tag_index.write_index(tag_lineage_iter(), summarize_counts.RANK_COUNT, args["site"].upper(),
+                                                                         args["cut_offset"], args["tag_length"], args["output_file"])
+    finally:
+        sorter.close()
+    print("wrote %d distinct tags, %d distinct lineages, %d distinct names to %s"%(tag_count, lineage_count, string_count, args["output_file"]), file=sys.stderr)
+
+def dedupe_fasta(args):
+    """
+merge formatted fasta files (e.g. GCA.fna and GCF.fna, from format_fasta) into a single fasta for makeblastdb, with
+each distinct sequence only once. Sequences are compared by a hash (sha1) of the sequence or its reverse complement,
+whichever is first in sort order (blastn searches both strands, so either would be hit equally), ignoring case. The
+first contig with each sequence is kept, and the others are collapsed into it - the duplicates file lists, for each
+contig kept which has duplicates, the distinct accessions of it and its duplicates, and the duplicate contigs - e.g.
+
+contig  accessions      duplicates
+GTDB1:GCA_000008085.1_AE017199.1        GCA_000008085.1,GCF_000008085.1 GTDB1:GCF_000008085.1_NC_005213.1
+
+so that summarize_counts.py -d can expand a hit on a contig kept to the accessions of all its copies. The inputs
+are streamed, and only the hashes and names of the contigs kept are held
+    """
+    kept = {}             # sequence hash => name of the contig kept
+    duplicates = {}       # name of the contig kept => [names of its duplicates]
+    (contig_count, kept_count, kept_length, total_length) = (0, 0, 0, 0)
+    with open(args["output_file"], "wb", OUTPUT_BUFFER_SIZE) as out_stream:
+        for seq_file in args["inputfiles"]:
+            with seq_io.open_input(seq_file) as seq_stream:
+                for (name, seq) in seq_io.fasta_iter(seq_stream):
+                    contig_count += 1
+                    total_length += len(seq)
+                    contig = name.split()[0]
+                    upper_seq = seq.upper()
+                    seq_hash = hashlib.sha1(min(upper_seq, tag_index.reverse_complement(upper_seq))).digest()
+                    kept_contig = kept.get(seq_hash)
+                    if kept_contig is None:
+                        kept[seq_hash] = contig
+                        kept_count += 1
+                        kept_length += len(seq)
+                        seq_io.write_fasta(out_stream, name, seq)
+                    else:
+                        duplicates.setdefault(kept_contig, []).append(contig)
+            print("%s : %d contigs so far, %d kept" % (seq_file, contig_count, kept_count), file=sys.stderr)
+
+    with open(args["duplicates_file"], "w") as duplicates_stream:
+        print("contig\taccessions\tduplicates", file=duplicates_stream)
+        for kept_contig in sorted(duplicates.keys()):
+            contigs = [contig.decode() for contig in [kept_contig] + duplicates[kept_contig]]
+            accessions = []
+            for accession in (summarize_counts.get_accession(contig) for contig in contigs):
+                if accession not in accessions:
+                    accessions.append(accession)
+            print("%s\t%s\t%s" % (contigs[0], ",".join(accessions), ",".join(contigs[1:])), file=duplicates_stream)
+
+    print("kept %d of %d contigs (%d of %d bases) - %d contigs have duplicates - wrote %s and %s" % (kept_count, contig_count, kept_length, total_length,
+          len(duplicates), args["output_file"], args["duplicates_file"]), file=sys.stderr)
+
+
 def main():
     options = get_options()
     #print("using %s"%str(options), file=sys.stderr)
@@ -101,8 +353,14 @@ def main():
         format_fasta_entries(options)
     elif options["task"] == "format_taxonomy":
         format_taxonomy(options)
+    elif options["task"] == "build_index":
+        build_index(options)
+    elif options["task"] == "build_tag_index":
+        build_tag_index(options)
+    elif options["task"] == "dedupe_fasta":
+        dedupe_fasta(options)
     else:
-        raise misc_task_exception("unsupported task %(task)s"%options)
+        raise format_database_exception("unsupported task %(task)s"%options)
     
 
 
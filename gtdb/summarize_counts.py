@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import gzip
+import math
+import hashlib
+import itertools
+import argparse
+import taxonomy_index
+
+#
+# This is a python port of gtdb/summarizeR_counts.code - it assigns each query sequence to the lowest common
+# ancestor (LCA) of the set of taxa that it hit in the blast run, as per the MEGAN algorithm (minimum bitscore of 50,
+# and only considering hits within 10% of the maximum bitscore for a query). (See the R script for the algorithm
+# references)
+#
+# Differences from the R script :
+#
+# * the blast results are streamed directly from the (gzipped) results file - there is no need to unzip
+#   to a temporary .resultsNucl file
+# * the taxonomy is loaded once into a dictionary keyed by accession (or memory mapped from the index
+#   compiled by format_database.py -t build_index), rather than merging each query against the whole taxonomy table
+# * all the output records for a query are written in one go
+#
+# The .summary output is intended to be identical to that written by the R script, for example
+#
+#Sequence59_count=2      Bacteria        Firmicutes_A    Clostridia      Christensenellales      CAG-74  GCA-900199385   GCA-900199385 sp902764875
+#Sequence59_count=2      Bacteria        Firmicutes_A    Clostridia      Christensenellales      CAG-74  GCA-900199385   GCA-900199385 sp902764875
+#
+# Optionally (-F collapsed) a collapsed summary is written instead, with one record per sequence, and the count as an extra
+# (last) column, so that the rank columns are numbered as before - e.g.
+#
+#Sequence59_count=2      Bacteria        Firmicutes_A    Clostridia      Christensenellales      CAG-74  GCA-900199385   GCA-900199385 sp902764875      2
+#
+# (profile_prism.py --weighting_method column reads these)
+#
+# If the blast database was built from the deduplicated reference (format_database.py -t dedupe_fasta), in which each
+# distinct sequence is only included once, the duplicates file written with it is given with -d, so that a hit on a
+# contig which was kept is counted as a hit on each accession which has a copy of it, as if every copy had been hit
+# (when the blast database is named GTDB1_dedup, the duplicates file is GTDB1_dedup.duplicates.txt)
+#
+# If the results were written by blast_cache.py (melseq_prism.sh -K), the LCA assignments it cached (or made) for the
+# queries can be given with -A - the hits of those queries are then not parsed, and their cached assignment is used
+# rather than re-running the LCA. The assignments file records the version of the taxonomy (and duplicates) files
+# they were made with, and is ignored if this differs, or if the results file is newer than it
+#
+
+BIT_SCORE_CUTOFF = 50          # remove matches less than this
+BIT_SCORE_THRESHOLD = 0.1      # keep matches with bitscores within x proportion of max bitscore
+RANK_COUNT = 7                 # kingdom, phylum, class, order, family, genus, species
+NA = "NA"
+
+DEFAULT_TAXONOMY_FILE = "/dataset/gseq_processing/scratch/melseq/gtdb/GTDB1_taxonomy.csv"
+DEFAULT_TAXONOMY_INDEX = "/dataset/gseq_processing/scratch/melseq/gtdb/GTDB1_taxonomy.idx"   # see format_database.py -t build_index
+
+
+class summarize_counts_exception(Exception):
+    def __init__(self,args=None):
+        super(summarize_counts_exception, self).__init__(args)
+
+
+def get_text_stream(filename):
+    if re.search("\.gz$", filename) is not None:
+        return gzip.open(filename, "rt") if sys.version_info[0] >= 3 else gzip.open(filename, "r")
+    return open(filename, "r")
+
+
+def r_round(x):
+    """
+    R's round() rounds half to even (e.g. round(49.5) is 50, round(48.5) is 48), which python2 does not
+    """
+    floor = math.floor(x)
+    fraction = x - floor
+    if fraction > 0.5 or (fraction == 0.5 and floor % 2 == 1):
+        return floor + 1
+    return floor
+
+
+def get_accession(sseqid):
+    """
+    parse the genome accession from a hit id - e.g.
+
+    GTDB1:GCF_018854495.1_NZ_JABBDR010000079.1
+
+    yields
+
+    GCF_018854495.1
+
+    (this follows getID in summarizeR_counts.code, including yielding NA_NA for an unparseable id)
+    """
+    tokens = sseqid.split(":")
+    if len(tokens) < 2:
+        return "NA_NA"
+    tokens = tokens[1].split("_")
+    return "_".join((tokens + [NA])[0:2])
+
+
+def get_default_taxonomy_file():
+    if os.path.isfile(DEFAULT_TAXONOMY_INDEX):
+        return DEFAULT_TAXONOMY_INDEX
+    return DEFAULT_TAXONOMY_FILE
+
+
+def load_taxonomy(taxonomy_file):
+    """
+    if taxonomy_file is a binary index compiled by format_database.py -t build_index, memory map it - otherwise
+    read the accession-to-taxonomy csv written by format_database.py -t format_taxonomy - e.g.
+
+ID,Species,Genus,T_Kingdom,T_Phylum,T_Class,T_Order,T_Family,T_Genus,T_Species
+GCF_000566285.1,Escherichia coli,Escherichia,Bacteria,Proteobacteria,Gammaproteobacteria,Enterobacterales,Enterobacteriaceae,Escherichia,Escherichia coli
+
+    into a dictionary of accession => (kingdom, phylum, class, order, family, genus, species). As in the R script,
+    the redundant columns 2 and 3 are dropped, and NA values are represented by None
+    """
+    if taxonomy_index.is_index_file(taxonomy_file):
+        return taxonomy_index.taxonomy_index(taxonomy_file)
+
+    taxonomy = {}
+    with get_text_stream(taxonomy_file) as tax_stream:
+        tax_stream.readline()  # heading
+        for record in tax_stream:
+            fields = record.rstrip("\r\n").split(",")
+            if len(fields) < 3 + RANK_COUNT:
+                continue
+            taxonomy[fields[0]] = tuple(None if field == NA else field for field in fields[3:3 + RANK_COUNT])
+    return taxonomy
+
+
+def load_duplicates(duplicates_file):
+    """
+    read the duplicates file written by format_database.py -t dedupe_fasta - e.g.
+
+contig  accessions      duplicates
+GTDB1:GCA_000008085.1_AE017199.1        GCA_000008085.1,GCF_000008085.1 GTDB1:GCF_000008085.1_NC_005213.1
+
+    into a dictionary of contig kept => [accessions of it and its duplicates]
+    """
+    duplicates = {}
+    with get_text_stream(duplicates_file) as duplicates_stream:
+        duplicates_stream.readline()  # heading
+        for record in duplicates_stream:
+            fields = record.rstrip("\r\n").split("\t")
+            if len(fields) < 2:
+                continue
+            duplicates[fields[0]] = fields[1].split(",")
+    return duplicates
+
+
+def get_taxonomy_version(taxonomy_file, duplicates_file=None):
+    """
+    digest of the names, sizes and modification times of the taxonomy (and duplicates) files, so that cached LCA
+    assignments are only used with the taxonomy they were made with
+    """
+    version = hashlib.md5()
+    for filename in (taxonomy_file, duplicates_file):
+        if filename is not None:
+            stat = os.stat(filename)
+            version.update(("%s\t%d\t%d\n" % (os.path.realpath(filename), stat.st_size, int(stat.st_mtime))).encode())
+    return version.hexdigest()
+
+
+def load_assignments(assignments_file, taxonomy_version, results_file):
+    """
+    read the LCA assignments written by blast_cache.py -t update - e.g.
+
+#taxonomy_version       0f343b0931126a20f133d67c83b2fcf2
+Sequence59_count=2      Bacteria        Firmicutes_A    Clostridia      Christensenellales      CAG-74  GCA-900199385   GCA-900199385 sp902764875
+Sequence60_count=1
+
+    (a query with no ranks has hits, but is not assigned) into a dictionary of qseqid => lca tuple (or None) - or
+    returns None if the assignments were made with another version of the taxonomy, or are older than the results
+    """
+    if os.path.getmtime(assignments_file) < os.path.getmtime(results_file):
+        print("warning - ignoring %s as it is older than %s" % (assignments_file, results_file), file=sys.stderr)
+        return None
+    assignments = {}
+    with get_text_stream(assignments_file) as assignments_stream:
+        header = assignments_stream.readline().rstrip("\r\n").split("\t")
+        if header != ["#taxonomy_version", taxonomy_version]:
+            print("warning - ignoring %s as it was made with another version of the taxonomy" % assignments_file, file=sys.stderr)
+            return None
+        for record in assignments_stream:
+            fields = record.rstrip("\r\n").split("\t")
+            assignments[fields[0]] = tuple(fields[1:1 + RANK_COUNT]) if len(fields) > RANK_COUNT else None
+    return assignments
+
+
+def hit_iter(results_stream, assignments=None):
+    """
+    yield (qseqid, sseqid, bitscore) from tabular blast results (-outfmt '6 std qlen') - the hits of queries with an
+    assignment are not parsed, and are yielded as (qseqid, None, None)
+    """
+    for record in results_stream:
+        if assignments:
+            qseqid = record.split("\t", 1)[0]
+            if qseqid in assignments:
+                yield (qseqid, None, None)
+                continue
+        fields = record.rstrip("\r\n").split("\t")
+        if len(fields) < 12:
+            continue
+        yield (fields[0], fields[1], float(fields[11]))
+
+
+def get_lca(hits, taxonomy, duplicates=None):
+    """
+    apply the LCA algorithm to all the hits of a given query sequence - returns a tuple of rank values, with
+    ranks below the LCA set to NA, or None if the query cannot be assigned. (If duplicates are given, a hit on a
+    contig which has duplicates is expanded to the accessions of all its copies)
+    """
+    max_bitscore = max(hit[2] for hit in hits)
+    if max_bitscore < BIT_SCORE_CUTOFF:
+        return None   # so there will be some queries for which there will be no output
+    bit_thresh = max(BIT_SCORE_CUTOFF, r_round(max_bitscore * (1 - BIT_SCORE_THRESHOLD)))
+
+    if duplicates:
+        accessions = [accession for hit in hits if hit[2] >= bit_thresh for accession in duplicates.get(hit[1], (get_accession(hit[1]),))]
+    else:
+        accessions = [get_accession(hit[1]) for hit in hits if hit[2] >= bit_thresh]
+    lineages = [taxonomy.get(accession) for accession in accessions]
+    lineages = [lineage for lineage in lineages if lineage is not None]      # inner join to the taxonomy
+    if len(lineages) == 0:
+        return None
+    return get_lineage_lca(lineages)
+
+
+def get_lineage_lca(lineages):
+    """
+    the guts of the LCA algorithm - we only assign at a given rank if all the lineages agree on a (non-NA) value
+    at that rank, and every rank below the first disagreement is NA
+    """
+    lca = []
+    first = lineages[0]
+    for rank in range(RANK_COUNT):
+        value = first[rank]
+        if value is None or any(lineage[rank] != value for lineage in lineages[1:]):
+            break
+        lca.append(value)
+    return tuple(lca + [NA] * (RANK_COUNT - len(lca)))
+
+
+def get_count(qseqid):
+    """
+    parse the count from a query name like Sequence59_count=2
+    """
+    tokens = qseqid.split("count=")
+    if len(tokens) < 2:
+        raise summarize_counts_exception("unable to parse count from %s" % qseqid)
+    return int(float(tokens[1]))
+
+
+def summarize(results_stream, taxonomy, summary_stream, summary_format="expanded", duplicates=None, assignments=None):
+    """
+    read the blast hits grouping by query, assign each query to the LCA of its hits (or its assignment, if given),
+    and write the summary record - either cloned to match the count in the query name, or once with the count appended
+    """
+    query_count = 0
+    assigned_count = 0
+    for (qseqid, hits) in itertools.groupby(hit_iter(results_stream, assignments), lambda hit: hit[0]):
+        query_count += 1
+        if assignments and qseqid in assignments:
+            lca = assignments[qseqid]
+        else:
+            lca = get_lca(list(hits), taxonomy, duplicates)
+        if lca is None:
+            continue
+        assigned_count += 1
+        if summary_format == "collapsed":
+            summary_stream.write("%s\t%s\t%d\n" % (qseqid, "\t".join(lca), get_count(qseqid)))
+        else:
+            summary_stream.write(("%s\t%s\n" % (qseqid, "\t".join(lca))) * get_count(qseqid))
+    return (query_count, assigned_count)
+
+
+def get_summary_filename(results_file, output_folder):
+    """
+    e.g. blast/X.non-redundant.fasta.blastn.GTDB1.results.gz  -> output_folder/X.non-redundant.fasta.blastn.GTDB1.summary
+    (also accepts the .resultsNucl files used by the R script)
+    """
+    base = re.sub("\.(results\.gz|results|resultsNucl)$", "", os.path.basename(results_file))
+    if output_folder is None:
+        output_folder = os.path.dirname(results_file)
+    return os.path.join(output_folder, "%s.summary" % base)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+assigns each query in a blast results file to the lowest common ancestor of its hits, writing a .summary file.
+This can be used as the taxonomiser (-t) for melseq_prism.sh, in place of gtdb/summarizeR_counts.code
+
+examples :
+
+./summarize_counts.py -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summary /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast/SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.num_threads4taskblastnword_size16outfmt6stdqlenevalue0.02.results.gz
+
+./summarize_counts.py -T GTDB1_taxonomy.csv 968854_TGAAGCG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.results.gz
+
+./summarize_counts.py -T GTDB1_taxonomy.idx 968854_TGAAGCG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.results.gz
+
+./summarize_counts.py -F collapsed 968854_TGAAGCG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.results.gz
+
+./summarize_counts.py -d GTDB1_dedup.duplicates.txt 968854_TGAAGCG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1_dedup.results.gz
+
+# use the LCA assignments cached by blast_cache.py
+./summarize_counts.py -A 968854_TGAAGCG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.lca.txt 968854_TGAAGCG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.results.gz
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputfiles', type=str, nargs="+", help='blast results files (optionally compressed with gzip)')
+    parser.add_argument('-T', '--taxonomy_file', dest='taxonomy_file', type=str, default=None, help="accession to taxonomy csv file, or index compiled from it (default %s if it exists, else %s)" % (DEFAULT_TAXONOMY_INDEX, DEFAULT_TAXONOMY_FILE))
+    parser.add_argument('-O', '--output_folder', dest='output_folder', type=str, default=None, help='folder to write summaries to (default is the folder of each input file)')
+    parser.add_argument('-F', '--summary_format', dest='summary_format', type=str, default="expanded", choices=["expanded", "collapsed"],
+                        help="expanded (default) : one record per read, as the R taxonomisers; collapsed : one record per sequence, with a count column")
+    parser.add_argument('-d', '--duplicates_file', dest='duplicates_file', type=str, default=None, help='duplicates file of the deduplicated blast database (format_database.py -t dedupe_fasta), to expand hits on collapsed contigs')
+    parser.add_argument('-A', '--assignments_file', dest='assignments_file', type=str, default=None, help='optional LCA assignments of the queries, cached by blast_cache.py (only with a single results file)')
+
+    args = vars(parser.parse_args())
+
+    if args["taxonomy_file"] is None:
+        args["taxonomy_file"] = get_default_taxonomy_file()
+    if not os.path.isfile(args["taxonomy_file"]):
+        raise summarize_counts_exception("%(taxonomy_file)s is not a file" % args)
+    if args["output_folder"] is not None and not os.path.isdir(args["output_folder"]):
+        raise summarize_counts_exception("%(output_folder)s is not a folder" % args)
+    if args["duplicates_file"] is not None and not os.path.isfile(args["duplicates_file"]):
+        raise summarize_counts_exception("%(duplicates_file)s is not a file" % args)
+    if args["assignments_file"] is not None:
+        if not os.path.isfile(args["assignments_file"]):
+            raise summarize_counts_exception("%(assignments_file)s is not a file" % args)
+        if len(args["inputfiles"]) != 1:
+            raise summarize_counts_exception("an assignments file (-A) can only be given with a single results file")
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    taxonomy = load_taxonomy(options["taxonomy_file"])
+    print("loaded %d accessions from %s" % (len(taxonomy), options["taxonomy_file"]), file=sys.stderr)
+    duplicates = None
+    if options["duplicates_file"] is not None:
+        duplicates = load_duplicates(options["duplicates_file"])
+        print("loaded %d contigs with duplicates from %s" % (len(duplicates), options["duplicates_file"]), file=sys.stderr)
+
+    for results_file in options["inputfiles"]:
+        assignments = None
+        if options["assignments_file"] is not None:
+            assignments = load_assignments(options["assignments_file"], get_taxonomy_version(options["taxonomy_file"], options["duplicates_file"]), results_file)
+            if assignments is not None:
+                print("loaded %d cached assignments from %s" % (len(assignments), options["assignments_file"]), file=sys.stderr)
+        summary_file = get_summary_filename(results_file, options["output_folder"])
+        with get_text_stream(results_file) as results_stream:
+            with open(summary_file, "w") as summary_stream:
+                (query_count, assigned_count) = summarize(results_stream, taxonomy, summary_stream, options["summary_format"], duplicates, assignments)
+        print("%s : %d queries, %d assigned, summary written to %s" % (results_file, query_count, assigned_count, summary_file), file=sys.stderr)
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import mmap
+import struct
+import hashlib
+import heapq
+import itertools
+
+#
+# restriction tag -> LCA lineage index, compiled once from the reference genomes by
+#
+# format_database.py -t build_tag_index -T GTDB1_taxonomy.idx -O GTDB1_PstI.tags -F GCA_genomes.txt ...
+#
+# MelSeq reads are restriction (e.g. PstI) tags - each read starts at a cut site (TGCAG for PstI, i.e. the site CTGCAG
+# less the base before the cut), and is either the first tag_length bases of the fragment running from that site
+# (on either strand), or the whole fragment if it is shorter. Each such tag in the reference genomes is hashed, and
+# stored with the LCA of the lineages of all the genomes it occurs in, so that reads which exactly match a reference
+# tag can be assigned without being blasted (see tag_lookup.py). The index is memory mapped (read only), as for
+# taxonomy_index.py. Layout (all integers little-endian) :
+#
+# header           magic, site, cut offset, tag length, rank count, tag count, lineage count, string count, section offsets
+# buckets          BUCKET_COUNT + 1 uint64 - the number of the first tag whose hash starts with each BUCKET_BITS prefix
+# tags             tag count uint64 tag hashes, sorted
+# tag nodes        tag count uint32 lineage numbers (parallel to tags)
+# lineages         lineage count x rank count uint32 string numbers (one per rank - kingdom..species; NA_NODE for NA)
+# string offsets   string count + 1 uint32 offsets into the string pool
+# string pool      utf-8 rank names
+#
+# The hashes are the first 64 bits of the md5 of the tag - with a billion or so distinct tags, the chance of any two
+# colliding is a few percent, and a collision would at worst assign a read to the lineage of another tag
+#
+
+MAGIC = b"MSQTAGI1"
+HEADER_FORMAT = "<8s16sIIIQII6Q"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+NA_NODE = 0xFFFFFFFF
+NA = "NA"
+BUCKET_BITS = 16
+BUCKET_COUNT = 1 << BUCKET_BITS
+SORT_CHUNK_SIZE = 20000000      # (hash, lineage) pairs sorted in memory before spilling to a temporary file
+SORT_BLOCK_RECORDS = 65536
+PAIR_FORMAT = "<QI"
+PAIR_SIZE = struct.calcsize(PAIR_FORMAT)
+
+DEFAULT_SITE = "CTGCAG"         # PstI, cut CTGCA^G
+DEFAULT_CUT_OFFSET = 1          # reads start at TGCAG
+DEFAULT_TAG_LENGTH = 64
+DEFAULT_MIN_TAG_LENGTH = 40     # as the default minimum length after trimming
+
+try:
+    COMPLEMENT = bytes.maketrans(b"ACGTN", b"TGCAN")
+except AttributeError:   # python 2
+    import string
+    COMPLEMENT = string.maketrans("ACGTN", "TGCAN")
+
+
+class tag_index_exception(Exception):
+    def __init__(self,args=None):
+        super(tag_index_exception, self).__init__(args)
+
+
+def is_index_file(filename):
+    with open(filename, "rb") as index_file:
+        return index_file.read(len(MAGIC)) == MAGIC
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def get_tag_hash(tag):
+    return struct.unpack("<Q", hashlib.md5(tag).digest()[0:8])[0]
+
+
+def get_tag_key(seq, tag_length):
+    """
+    the part of a read that is looked up - the first tag_length bases, or the whole read if it is shorter
+    """
+    return seq.upper()[0:tag_length]
+
+
+def fragment_tag_iter(seq, site, cut_offset, tag_length, min_tag_length):
+    """
+    yield the tags of an (uppercase) sequence digested at site, on the given strand - each runs from the cut to the
+    end of the fragment (i.e. the next cut), or for at most tag_length bases. Fragments that run off the end of the
+    sequence before tag_length bases, or that contain anything other than ACGT, give no tag
+    """
+    end_offset = len(site) - cut_offset
+    position = seq.find(site)
+    while position >= 0:
+        start = position + cut_offset
+        next_position = seq.find(site, position + 1)
+        if next_position < 0:
+            end = start + tag_length
+            if end > len(seq):
+                break
+        else:
+            end = min(start + tag_length, next_position + end_offset)
+        tag = seq[start:end]
+        if len(tag) >= min_tag_length and len(tag.translate(None, b"ACGT")) == 0:
+            yield tag
+        position = next_position
+
+
+def tag_iter(seq, site=DEFAULT_SITE, cut_offset=DEFAULT_CUT_OFFSET, tag_length=DEFAULT_TAG_LENGTH, min_tag_length=DEFAULT_MIN_TAG_LENGTH):
+    """
+    yield the tags of a sequence, on both strands
+    """
+    seq = seq.upper()
+    site = site.upper().encode("ascii") if not isinstance(site, bytes) else site.upper()
+    for strand in (seq, reverse_complement(seq)):
+        for tag in fragment_tag_iter(strand, site, cut_offset, tag_length, min_tag_length):
+            yield tag
+
+
+class tag_sorter(object):
+    """
+    external sort of (tag hash, lineage number) pairs - pairs are sorted in memory in chunks, which are spilled to
+    temporary files and merged. merged_iter yields (tag hash, [lineage numbers]) in order of hash
+    """
+    def __init__(self, temp_folder, chunk_size=SORT_CHUNK_SIZE):
+        self.temp_folder = temp_folder
+        self.chunk_size = chunk_size
+        self.pairs = []
+        self.chunk_files = []
+
+    def add(self, tag_hashes, lineage_number):
+        self.pairs.extend((tag_hash << 32) | lineage_number for tag_hash in tag_hashes)
+        if len(self.pairs) >= self.chunk_size:
+            self.spill()
+
+    def spill(self):
+        self.pairs.sort()
+        chunk_file = os.path.join(self.temp_folder, "tag_index_chunk%d.%d.tmp" % (len(self.chunk_files), os.getpid()))
+        with open(chunk_file, "wb") as chunk_stream:
+            for start in range(0, len(self.pairs), SORT_BLOCK_RECORDS):
+                block = self.pairs[start:start + SORT_BLOCK_RECORDS]
+                chunk_stream.write(struct.pack("<" + "QI" * len(block), *[item for pair in block for item in (pair >> 32, pair & NA_NODE)]))
+        self.chunk_files.append(chunk_file)
+        self.pairs = []
+
+    def chunk_iter(self, chunk_file):
+        with open(chunk_file, "rb") as chunk_stream:
+            block = chunk_stream.read(SORT_BLOCK_RECORDS * PAIR_SIZE)
+            while len(block) > 0:
+                values = struct.unpack("<" + "QI" * (len(block) // PAIR_SIZE), block)
+                for i in range(0, len(values), 2):
+                    yield (values[i] << 32) | values[i + 1]
+                block = chunk_stream.read(SORT_BLOCK_RECORDS * PAIR_SIZE)
+
+    def merged_iter(self):
+        if len(self.chunk_files) == 0:
+            self.pairs.sort()
+            pair_iter = iter(self.pairs)
+        else:
+            if len(self.pairs) > 0:
+                self.spill()
+            pair_iter = heapq.merge(*[self.chunk_iter(chunk_file) for chunk_file in self.chunk_files])
+        for (tag_hash, pairs) in itertools.groupby(pair_iter, lambda pair: pair >> 32):
+            yield (tag_hash, sorted(set(pair & NA_NODE for pair in pairs)))
+
+    def close(self):
+        for chunk_file in self.chunk_files:
+            os.remove(chunk_file)
+        self.chunk_files = []
+        self.pairs = []
+
+
+def write_index(tag_lineages, rank_count, site, cut_offset, tag_length, index_filename):
+    """
+    tag_lineages is an iterable of (tag hash, (rank1_name,...)), in order of hash, with None or NA for NA ranks.
+    Lineages and rank names are each stored once, and referred to by number. The tags and their lineage numbers
+    are written to temporary files, and then copied into the index once the tag count is known
+    """
+    string_numbers = {}
+    strings = []
+    lineage_numbers = {}
+    lineages = []
+    buckets = [0] * (BUCKET_COUNT + 1)
+
+    tags_filename = "%s.tags.tmp" % index_filename
+    nodes_filename = "%s.nodes.tmp" % index_filename
+    tag_count = 0
+    previous_hash = None
+    with open(tags_filename, "wb") as tags_stream, open(nodes_filename, "wb") as nodes_stream:
+        for (tag_hash, lineage) in tag_lineages:
+            if previous_hash is not None and tag_hash <= previous_hash:
+                raise tag_index_exception("tags must be unique, and in order of hash")
+            previous_hash = tag_hash
+            if len(lineage) != rank_count:
+                raise tag_index_exception("expected %d ranks, got %s" % (rank_count, str(lineage)))
+            lineage = tuple(None if name == NA else name for name in lineage)
+            if lineage not in lineage_numbers:
+                nodes = []
+                for name in lineage:
+                    if name is None:
+                        nodes.append(NA_NODE)
+                        continue
+                    if name not in string_numbers:
+                        string_numbers[name] = len(strings)
+                        strings.append(name)
+                    nodes.append(string_numbers[name])
+                lineage_numbers[lineage] = len(lineages)
+                lineages.append(nodes)
+            tags_stream.write(struct.pack("<Q", tag_hash))
+            nodes_stream.write(struct.pack("<I", lineage_numbers[lineage]))
+            buckets[(tag_hash >> (64 - BUCKET_BITS)) + 1] += 1
+            tag_count += 1
+
+    for bucket in range(BUCKET_COUNT):
+        buckets[bucket + 1] += buckets[bucket]
+
+    encoded_strings = [name.encode("utf-8") for name in strings]
+    string_offsets = [0]
+    for encoded in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded))
+
+    buckets_offset = HEADER_SIZE
+    tags_offset = buckets_offset + 8 * len(buckets)
+    tag_nodes_offset = tags_offset + 8 * tag_count
+    lineages_offset = tag_nodes_offset + 4 * tag_count
+    string_offsets_offset = lineages_offset + 4 * rank_count * len(lineages)
+    string_pool_offset = string_offsets_offset + 4 * len(string_offsets)
+
+    if not isinstance(site, bytes):
+        site = site.encode("ascii")
+    with open(index_filename, "wb") as index_file:
+        index_file.write(struct.pack(HEADER_FORMAT, MAGIC, site, cut_offset, tag_length, rank_count, tag_count, len(lineages), len(strings),
+                                     buckets_offset, tags_offset, tag_nodes_offset, lineages_offset, string_offsets_offset, string_pool_offset))
+        index_file.write(struct.pack("<%dQ" % len(buckets), *buckets))
+        for section_filename in (tags_filename, nodes_filename):
+            with open(section_filename, "rb") as section_stream:
+                block = section_stream.read(16 * 1024 * 1024)
+                while len(block) > 0:
+                    index_file.write(block)
+                    block = section_stream.read(16 * 1024 * 1024)
+            os.remove(section_filename)
+        index_file.write(struct.pack("<%dI" % (rank_count * len(lineages)), *[node for lineage in lineages for node in lineage]))
+        index_file.write(struct.pack("<%dI" % len(string_offsets), *string_offsets))
+        index_file.write(b"".join(encoded_strings))
+
+    return (tag_count, len(lineages), len(strings))
+
+
+class tag_index(object):
+    """
+    read-only, memory mapped view of an index written by write_index. get(seq) returns the LCA lineage of the tag
+    of a read (a tuple of rank names, with NA below the LCA), or None if the tag is not in the index
+    """
+    def __init__(self, index_filename):
+        self.index_filename = index_filename
+        self.index_file = open(index_filename, "rb")
+        self.map = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, site, self.cut_offset, self.tag_length, self.rank_count, self.tag_count, self.lineage_count, self.string_count,
+         self.buckets_offset, self.tags_offset, self.tag_nodes_offset, self.lineages_offset, self.string_offsets_offset,
+         self.string_pool_offset) = struct.unpack_from(HEADER_FORMAT, self.map, 0)
+        if magic != MAGIC:
+            raise tag_index_exception("%s is not a tag index" % index_filename)
+        self.site = site.rstrip(b"\0").decode("ascii")
+        self.lineage_format = "<%dI" % self.rank_count
+        self.lineage_cache = {}
+
+    def __len__(self):
+        return self.tag_count
+
+    def close(self):
+        self.map.close()
+        self.index_file.close()
+
+    def find(self, tag_hash):
+        """
+        binary search of the sorted tag hashes (within the bucket of the hash) - returns the tag number, or None
+        """
+        (low, high) = struct.unpack_from("<2Q", self.map, self.buckets_offset + 8 * (tag_hash >> (64 - BUCKET_BITS)))
+        while low < high:
+            mid = (low + high) // 2
+            if struct.unpack_from("<Q", self.map, self.tags_offset + 8 * mid)[0] < tag_hash:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.tag_count and struct.unpack_from("<Q", self.map, self.tags_offset + 8 * low)[0] == tag_hash:
+            return low
+        return None
+
+    def get_string(self, node):
+        if node == NA_NODE:
+            return NA
+        (start, end) = struct.unpack_from("<2I", self.map, self.string_offsets_offset + 4 * node)
+        offset = self.string_pool_offset
+        name = self.map[offset + start:offset + end]
+        if str is bytes:    # python 2
+            return name
+        return name.decode("utf-8")
+
+    def get_lineage(self, lineage_number):
+        if lineage_number not in self.lineage_cache:
+            nodes = struct.unpack_from(self.lineage_format, self.map, self.lineages_offset + 4 * self.rank_count * lineage_number)
+            self.lineage_cache[lineage_number] = tuple(self.get_string(node) for node in nodes)
+        return self.lineage_cache[lineage_number]
+
+    def get(self, seq, default=None):
+        i = self.find(get_tag_hash(get_tag_key(seq, self.tag_length)))
+        if i is None:
+            return default
+        (lineage_number,) = struct.unpack_from("<I", self.map, self.tag_nodes_offset + 4 * i)
+        return self.get_lineage(lineage_number)
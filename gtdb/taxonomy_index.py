@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import mmap
+import struct
+
+#
+# compact binary accession -> lineage index, compiled once from GTDB1_taxonomy.csv by
+#
+# format_database.py -t build_index -O GTDB1_taxonomy.idx GTDB1_taxonomy.csv
+#
+# and then memory mapped (read only) by each summary task, so that the taxonomy is shared via the
+# page cache rather than each task parsing and holding its own copy. Layout (all integers little-endian) :
+#
+# header           magic, rank count, accession width, accession count, lineage count, string count, section offsets
+# accessions       accession count fixed-width (NUL padded) accessions, sorted
+# accession nodes  accession count uint32 lineage numbers (parallel to accessions)
+# lineages         lineage count x rank count uint32 string numbers (one per rank - kingdom..species; NA_NODE for NA)
+# string offsets   string count + 1 uint32 offsets into the string pool
+# string pool      utf-8 rank names
+#
+
+MAGIC = b"MSQTAXI1"
+HEADER_FORMAT = "<8sIIIII5Q"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+NA_NODE = 0xFFFFFFFF
+
+
+class taxonomy_index_exception(Exception):
+    def __init__(self,args=None):
+        super(taxonomy_index_exception, self).__init__(args)
+
+
+def is_index_file(filename):
+    with open(filename, "rb") as index_file:
+        return index_file.read(len(MAGIC)) == MAGIC
+
+
+def write_index(accession_lineages, rank_count, index_filename):
+    """
+    accession_lineages is an iterable of (accession, (rank1_name,...)) , with None for NA ranks.
+    Lineages and rank names are each stored once, and referred to by number
+    """
+    string_numbers = {}
+    strings = []
+    lineage_numbers = {}
+    lineages = []
+    accession_nodes = {}
+
+    for (accession, lineage) in accession_lineages:
+        if len(lineage) != rank_count:
+            raise taxonomy_index_exception("expected %d ranks for %s, got %s" % (rank_count, accession, str(lineage)))
+        nodes = []
+        for name in lineage:
+            if name is None:
+                nodes.append(NA_NODE)
+                continue
+            if name not in string_numbers:
+                string_numbers[name] = len(strings)
+                strings.append(name)
+            nodes.append(string_numbers[name])
+        nodes = tuple(nodes)
+        if nodes not in lineage_numbers:
+            lineage_numbers[nodes] = len(lineages)
+            lineages.append(nodes)
+        accession_nodes[accession.encode("ascii")] = lineage_numbers[nodes]
+
+    accessions = sorted(accession_nodes.keys())
+    accession_width = max([len(accession) for accession in accessions] + [1])
+
+    encoded_strings = [name.encode("utf-8") for name in strings]
+    string_offsets = [0]
+    for encoded in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded))
+
+    accessions_offset = HEADER_SIZE
+    accession_nodes_offset = accessions_offset + accession_width * len(accessions)
+    lineages_offset = accession_nodes_offset + 4 * len(accessions)
+    string_offsets_offset = lineages_offset + 4 * rank_count * len(lineages)
+    string_pool_offset = string_offsets_offset + 4 * len(string_offsets)
+
+    with open(index_filename, "wb") as index_file:
+        index_file.write(struct.pack(HEADER_FORMAT, MAGIC, rank_count, accession_width, len(accessions), len(lineages), len(strings),
+                                     accessions_offset, accession_nodes_offset, lineages_offset, string_offsets_offset, string_pool_offset))
+        index_file.write(b"".join(accession.ljust(accession_width, b"\0") for accession in accessions))
+        index_file.write(struct.pack("<%dI" % len(accessions), *[accession_nodes[accession] for accession in accessions]))
+        index_file.write(struct.pack("<%dI" % (rank_count * len(lineages)), *[node for lineage in lineages for node in lineage]))
+        index_file.write(struct.pack("<%dI" % len(string_offsets), *string_offsets))
+        index_file.write(b"".join(encoded_strings))
+
+    return (len(accessions), len(lineages), len(strings))
+
+
+class taxonomy_index(object):
+    """
+    read-only, memory mapped view of an index written by write_index. This behaves like the
+    accession => lineage dictionary returned by summarize_counts.load_taxonomy - i.e. get(accession)
+    returns a tuple of rank names (None for NA) or None if the accession is not in the index
+    """
+    def __init__(self, index_filename):
+        self.index_filename = index_filename
+        self.index_file = open(index_filename, "rb")
+        self.map = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.rank_count, self.accession_width, self.accession_count, self.lineage_count, self.string_count,
+         self.accessions_offset, self.accession_nodes_offset, self.lineages_offset, self.string_offsets_offset,
+         self.string_pool_offset) = struct.unpack_from(HEADER_FORMAT, self.map, 0)
+        if magic != MAGIC:
+            raise taxonomy_index_exception("%s is not a taxonomy index" % index_filename)
+        self.lineage_format = "<%dI" % self.rank_count
+        self.lineage_cache = {}
+        self.accession_cache = {}
+
+    def __len__(self):
+        return self.accession_count
+
+    def close(self):
+        self.map.close()
+        self.index_file.close()
+
+    def get_accession(self, i):
+        offset = self.accessions_offset + i * self.accession_width
+        return self.map[offset:offset + self.accession_width]
+
+    def find(self, accession):
+        """
+        binary search of the sorted accession table - returns the accession number, or None
+        """
+        key = accession.encode("ascii").ljust(self.accession_width, b"\0")
+        if len(key) > self.accession_width:
+            return None
+        (low, high) = (0, self.accession_count)
+        while low < high:
+            mid = (low + high) // 2
+            if self.get_accession(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.accession_count and self.get_accession(low) == key:
+            return low
+        return None
+
+    def get_string(self, node):
+        if node == NA_NODE:
+            return None
+        (start, end) = struct.unpack_from("<2I", self.map, self.string_offsets_offset + 4 * node)
+        offset = self.string_pool_offset
+        name = self.map[offset + start:offset + end]
+        if str is bytes:    # python 2
+            return name
+        return name.decode("utf-8")
+
+    def get_nodes(self, lineage_number):
+        return struct.unpack_from(self.lineage_format, self.map, self.lineages_offset + 4 * self.rank_count * lineage_number)
+
+    def get_lineage(self, lineage_number):
+        if lineage_number not in self.lineage_cache:
+            self.lineage_cache[lineage_number] = tuple(self.get_string(node) for node in self.get_nodes(lineage_number))
+        return self.lineage_cache[lineage_number]
+
+    def get_lineage_number(self, accession):
+        """
+        the number of the lineage of an accession (lineages are numbered from 0, and shared by accessions with the same
+        lineage), or None if the accession is not in the index
+        """
+        i = self.find(accession)
+        if i is None:
+            return None
+        (lineage_number,) = struct.unpack_from("<I", self.map, self.accession_nodes_offset + 4 * i)
+        return lineage_number
+
+    def get(self, accession, default=None):
+        if accession in self.accession_cache:
+            return self.accession_cache[accession]
+        lineage_number = self.get_lineage_number(accession)
+        if lineage_number is None:
+            lineage = default
+        else:
+            lineage = self.get_lineage(lineage_number)
+        self.accession_cache[accession] = lineage
+        return lineage
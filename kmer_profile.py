@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import argparse
+import multiprocessing
+import numpy
+import seq_io
+
+#
+# k-mer profiles of the non-redundant fasta files of a run, as a quick QC pass (e.g. to spot failed, contaminated or
+# mislabelled samples before blasting).
+#
+# Each file is read once, in batches of sequences - each batch is joined into one array of 2-bit base codes, and the
+# (canonical - i.e. the lesser of the k-mer and its reverse complement) k-mer code of every window is computed with
+# a few shifted array operations, and the k-mers then counted with numpy.bincount, weighted by the count of the
+# sequence (from the count= suffix of the sequence name - e.g. Sequence59_count=2 - as kmer_prism --weighting_method
+# tag_count). Windows including anything other than ACGT are not counted. Samples are profiled in parallel.
+#
+# The profiles are written as
+#
+# * a tab-delimited table, with a row per k-mer and a column per sample (as the profile_prism.py summary tables)
+# * optionally, a numpy .npz file with arrays matrix (samples x k-mers), kmers and samples
+# * optionally, a tab-delimited sample x sample distance matrix (of the k-mer frequencies)
+#
+
+BATCH_BASES = 8 * 1024 * 1024      # bases per batch of sequences
+MAX_KMER_SIZE = 12                 # (each sample is counted in a float64 array of 4^k - 128MB at k=12, 8GB at k=15)
+BASE_CODES = numpy.full(256, 4, dtype=numpy.uint8)
+for (base, code) in zip("ACGTacgt", (0, 1, 2, 3, 0, 1, 2, 3)):
+    BASE_CODES[ord(base)] = code
+INVALID_CODE = 4
+SEPARATOR = b"N"
+
+
+class kmer_profile_exception(Exception):
+    def __init__(self,args=None):
+        super(kmer_profile_exception, self).__init__(args)
+
+
+def get_reverse_complement_codes(codes, k):
+    """
+    the codes of the reverse complements of an array of k-mer codes
+    """
+    reverse = numpy.zeros(len(codes), dtype=numpy.int64)
+    for j in range(k):
+        reverse |= (3 - ((codes >> (2 * j)) & 3)) << (2 * (k - 1 - j))
+    return reverse
+
+
+def get_canonical_kmers(k):
+    """
+    the codes of the canonical k-mers, and the k-mers themselves
+    """
+    codes = numpy.arange(4 ** k, dtype=numpy.int64)
+    canonical = codes[codes <= get_reverse_complement_codes(codes, k)]
+    kmers = ["".join("ACGT"[(code >> (2 * (k - 1 - j))) & 3] for j in range(k)) for code in canonical.tolist()]
+    return (canonical, kmers)
+
+
+def count_batch(seqs, weights, k):
+    """
+    weighted counts of the canonical k-mers of a batch of sequences, indexed by k-mer code
+    """
+    joined = SEPARATOR.join(seqs)
+    codes = BASE_CODES[numpy.frombuffer(joined, dtype=numpy.uint8)]
+    window_count = len(codes) - k + 1
+    if window_count <= 0:
+        return numpy.zeros(4 ** k, dtype=numpy.float64)
+
+    # a window is valid if it has no invalid bases (which includes the separators between sequences)
+    invalid = numpy.concatenate(([0], numpy.cumsum(codes == INVALID_CODE, dtype=numpy.int64)))
+    valid = (invalid[k:] - invalid[:-k]) == 0
+
+    bases = (codes & 3).astype(numpy.int64)
+    forward = numpy.zeros(window_count, dtype=numpy.int64)
+    reverse = numpy.zeros(window_count, dtype=numpy.int64)
+    for j in range(k):
+        window_bases = bases[j:j + window_count]
+        forward = (forward << 2) | window_bases
+        reverse |= (3 - window_bases) << (2 * j)
+    canonical = numpy.minimum(forward, reverse)
+
+    # the weight of each window is the weight of the sequence it starts in (each sequence is followed by a separator)
+    window_weights = numpy.repeat(numpy.array(weights, dtype=numpy.float64), [len(seq) + 1 for seq in seqs])[:window_count]
+    return numpy.bincount(canonical[valid], weights=window_weights[valid], minlength=4 ** k)
+
+
+def profile_file(profile_args):
+    """
+    weighted counts of the canonical k-mers in a fasta file - returns (filename, counts indexed by k-mer code, sequence count, weight)
+    """
+    (filename, k, weighting_method) = profile_args
+    counts = numpy.zeros(4 ** k, dtype=numpy.float64)
+    (seqs, weights, batch_bases) = ([], [], 0)
+    (seq_count, total_weight) = (0, 0)
+    with seq_io.open_input(filename) as fasta_stream:
+        for (name, seq) in seq_io.fasta_iter(fasta_stream):
+            weight = 1
+            if weighting_method == "tag_count":
+                weight = seq_io.get_count(name.split()[0])
+            seqs.append(seq)
+            weights.append(weight)
+            batch_bases += len(seq) + 1
+            seq_count += 1
+            total_weight += weight
+            if batch_bases >= BATCH_BASES:
+                counts += count_batch(seqs, weights, k)
+                (seqs, weights, batch_bases) = ([], [], 0)
+    if len(seqs) > 0:
+        counts += count_batch(seqs, weights, k)
+    return (filename, counts, seq_count, total_weight)
+
+
+def get_distances(frequencies, distance_method):
+    """
+    sample x sample distance matrix of the rows of frequencies
+    """
+    sample_count = frequencies.shape[0]
+    distances = numpy.zeros((sample_count, sample_count), dtype=numpy.float64)
+    if distance_method == "cosine":
+        norms = numpy.sqrt((frequencies * frequencies).sum(axis=1))
+        norms[norms == 0] = 1
+        normalised = frequencies / norms[:, numpy.newaxis]
+    for i in range(sample_count):
+        if distance_method == "braycurtis":
+            denominator = (frequencies + frequencies[i]).sum(axis=1)
+            denominator[denominator == 0] = 1
+            distances[i] = numpy.abs(frequencies - frequencies[i]).sum(axis=1) / denominator
+        elif distance_method == "euclidean":
+            distances[i] = numpy.sqrt(((frequencies - frequencies[i]) ** 2).sum(axis=1))
+        else:
+            distances[i] = 1 - (normalised * normalised[i]).sum(axis=1)
+    numpy.fill_diagonal(distances, 0)
+    return distances
+
+
+def parse_sample_moniker(filename, sample_moniker_regexp):
+    match = re.search(sample_moniker_regexp, os.path.basename(filename))
+    if match is None:
+        return os.path.basename(filename)
+    return match.groups()[0]
+
+
+def write_table(out_stream, row_heading, row_names, column_names, matrix, value_format):
+    print("\t".join([row_heading] + column_names), file=out_stream)
+    for (row_name, values) in zip(row_names, matrix.tolist()):
+        print("\t".join([row_name] + [value_format % value for value in values]), file=out_stream)
+
+
+def profile(options):
+    (canonical, kmers) = get_canonical_kmers(options["kmer_size"])
+
+    pool = multiprocessing.Pool(processes=max(1, min(options["num_processes"], len(options["filenames"]))))
+    results = []
+    for (filename, counts, seq_count, total_weight) in pool.imap(profile_file, [(filename, options["kmer_size"], options["weighting_method"]) for filename in options["filenames"]]):
+        print("%s : %d sequences, weight %d" % (filename, seq_count, total_weight), file=sys.stderr)
+        results.append(counts[canonical])
+    pool.close()
+    pool.join()
+
+    samples = [parse_sample_moniker(filename, options["sample_moniker_regexp"]) for filename in options["filenames"]]
+    matrix = numpy.array(results).round().astype(numpy.int64)
+    totals = matrix.sum(axis=1).astype(numpy.float64)
+    totals[totals == 0] = 1
+    frequencies = matrix / totals[:, numpy.newaxis]
+
+    if options["matrix_file"] is not None:
+        numpy.savez(options["matrix_file"], matrix=matrix, kmers=numpy.array(kmers), samples=numpy.array(samples))
+
+    if options["output_file"] is None:
+        out_stream = sys.stdout
+    else:
+        out_stream = open(options["output_file"], "w")
+    if options["measure"] == "frequency":
+        write_table(out_stream, "kmer", kmers, samples, frequencies.T, "%.6g")
+    else:
+        write_table(out_stream, "kmer", kmers, samples, matrix.T, "%d")
+    if options["output_file"] is not None:
+        out_stream.close()
+
+    if options["distance_file"] is not None:
+        distances = get_distances(frequencies, options["distance_method"])
+        with open(options["distance_file"], "w") as distance_stream:
+            write_table(distance_stream, "sample", samples, samples, distances, "%.6g")
+
+    print("profiled %d samples (%d canonical %d-mers)" % (len(samples), len(kmers), options["kmer_size"]), file=sys.stderr)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+weighted canonical k-mer profiles of non-redundant fasta files, as a sample x k-mer matrix, and a sample x sample distance matrix
+
+examples :
+
+./kmer_profile.py -j 8 -o /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/kmer_analysis/kmer_frequency_table.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/*.non-redundant.fasta
+
+./kmer_profile.py -j 8 -k 6 --matrix_file /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/kmer_analysis/kmer_matrix.npz -D /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/kmer_analysis/kmer_distances.txt -o /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/kmer_analysis/kmer_frequency_table.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/*.non-redundant.fasta
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames', type=str, nargs="+", help='non-redundant fasta files (optionally compressed with gzip)')
+    parser.add_argument('-k', '--kmer_size', dest='kmer_size', type=int, default=6, help='k-mer size, at most %d (default 6)' % MAX_KMER_SIZE)
+    parser.add_argument('-j', '--num_processes', dest='num_processes', type=int, default=4, help='number of samples to profile in parallel (default 4)')
+    parser.add_argument('-o', '--output_file', dest='output_file', type=str, default=None, help='k-mer x sample table to write (default stdout)')
+    parser.add_argument('-D', '--distance_file', dest='distance_file', type=str, default=None, help='optional sample x sample distance matrix to write')
+    parser.add_argument('--distance_method', dest='distance_method', type=str, default="braycurtis", choices=["braycurtis", "euclidean", "cosine"], help='distance between the k-mer frequencies of samples (default braycurtis)')
+    parser.add_argument('--matrix_file', dest='matrix_file', type=str, default=None, help='optional file to save the sample x k-mer count matrix to (numpy .npz, with arrays matrix, kmers and samples)')
+    parser.add_argument('--measure', dest='measure', type=str, default="frequency", choices=["frequency", "count"], help='values to write to the table (default frequency)')
+    parser.add_argument('--weighting_method', dest='weighting_method', type=str, default="tag_count", choices=["tag_count", "sequence"],
+                        help='tag_count (default) : weight each sequence by the count in its name; sequence : count each sequence once')
+    parser.add_argument('--sample_moniker_regexp', dest='sample_moniker_regexp', type=str, default="\.demultiplexed_([^\.]+)\.R1_trimmed", help='regular expression to parse the sample moniker from the file name (default is the whole name, if this does not match)')
+
+    args = vars(parser.parse_args())
+
+    if args["kmer_size"] < 1 or args["kmer_size"] > MAX_KMER_SIZE:
+        raise kmer_profile_exception("k-mer size must be between 1 and %d" % MAX_KMER_SIZE)
+    for filename in args["filenames"]:
+        if not os.path.isfile(filename):
+            raise kmer_profile_exception("%s is not a file" % filename)
+
+    return args
+
+
+def main():
+    options = get_options()
+    profile(options)
+
+
+if __name__ == "__main__":
+   main()
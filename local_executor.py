@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+#
+# runs the commands of the command files generated by melseq_prism.sh (trim_commands.packed.txt, format_commands.packed.txt,
+# summary_commands.packed.txt, blast_commands.txt ...) on this machine, as many at once as its cores and memory allow - in
+# place of tardis, for -C local (e.g. on a large analysis node, or for offline testing without slurm).
+#
+# Each command is given a number of cores and an amount of memory, and a command is only started when there are enough
+# of both free (commands are started in the order of the command file - the packed command files are largest first -
+# and a command needing more than the whole machine is run on its own). The cores are taken from the command (the
+# number of threads asked of blast - e.g. -num_threads 8), or else from the slurm job template tardis would have used
+# (--cpus-per-task, given with -T, or named by jobtemplatefile in tardis.toml in the current folder, as tardis does),
+# or else 1. The memory is the most used by a command of the same stage in previous runs (from stage_metrics.jsonl,
+# given with -m and -S), or else from the job template (--mem-per-cpu x cores), or else 1G per core.
+#
+# As with tardis, the output of each command goes to run-<n>.stdout and run-<n>.stderr in a tardis_<moniker> folder
+# under the work folder (-d), and the exit code is written to run-<n>.exit. The exit code is 0 if all commands
+# succeeded, else 1
+#
+
+POLL_SECONDS = 1
+DEFAULT_MEMORY_MB_PER_CORE = 1024
+THREADS_REGEXP = "(?:^|\s)-{1,2}num_threads\s+(\d+)"
+
+
+class local_executor_exception(Exception):
+    def __init__(self,args=None):
+        super(local_executor_exception, self).__init__(args)
+
+
+def get_available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def get_available_memory_mb():
+    """
+    available memory of this machine (from /proc/meminfo - linux only, else None)
+    """
+    try:
+        with open("/proc/meminfo", "r") as meminfo_stream:
+            meminfo = dict(record.split(":", 1) for record in meminfo_stream if ":" in record)
+        return int(meminfo.get("MemAvailable", meminfo["MemFree"]).split()[0]) / 1024.0
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def get_memory_mb(text):
+    """
+    memory in MB from a slurm size e.g. 4G, 800M (default M)
+    """
+    match = re.match("^(\d+(?:\.\d+)?)([KMGT]?)", text.strip().upper())
+    if match is None:
+        raise local_executor_exception("could not parse memory size %s" % text)
+    (size, unit) = match.groups()
+    return float(size) * {"K": 1.0 / 1024, "": 1, "M": 1, "G": 1024, "T": 1024 * 1024}[unit]
+
+
+def get_job_template_filename():
+    """
+    the job template named in tardis.toml in the current folder (where tardis looks for it), if any
+    """
+    if not os.path.isfile("tardis.toml"):
+        return None
+    with open("tardis.toml", "r") as toml_stream:
+        for record in toml_stream:
+            match = re.match("^\s*jobtemplatefile\s*=\s*\"([^\"]+)\"", record)
+            if match is not None:
+                return match.groups()[0]
+    return None
+
+
+def read_job_template(template_file):
+    """
+    (cores, memory in MB) per job from the #SBATCH --cpus-per-task and --mem-per-cpu (or --mem) of a slurm job template
+    """
+    (cores, memory_per_core, memory) = (None, None, None)
+    with open(template_file, "r") as template_stream:
+        for record in template_stream:
+            match = re.match("^#SBATCH\s+--(cpus-per-task|mem-per-cpu|mem)=(\S+)", record)
+            if match is None:
+                continue
+            (name, value) = match.groups()
+            if name == "cpus-per-task":
+                cores = int(value)
+            elif name == "mem-per-cpu":
+                memory_per_core = get_memory_mb(value)
+            else:
+                memory = get_memory_mb(value)
+    if memory is None and memory_per_core is not None:
+        memory = memory_per_core * (cores or 1)
+    return (cores, memory)
+
+
+def get_stage_memory_mb(metrics_file, stage):
+    """
+    the most memory used by a command of the stage, in the metrics of previous runs (None if none)
+    """
+    if metrics_file is None or stage is None or not os.path.isfile(metrics_file):
+        return None
+    most = None
+    with open(metrics_file, "r") as metrics_stream:
+        for record in metrics_stream:
+            try:
+                metrics = json.loads(record)
+            except ValueError:
+                continue
+            if metrics.get("stage") == stage and metrics.get("sample") is not None and metrics.get("max_rss_mb") is not None:
+                most = max(most or 0, metrics["max_rss_mb"])
+    return most
+
+
+def get_command_resources(command, options):
+    """
+    (cores, memory in MB) for a command
+    """
+    cores = options["template_cores"] or 1
+    match = re.search(THREADS_REGEXP, command)
+    if match is not None:
+        cores = int(match.groups()[0])
+    memory = options["stage_memory"]
+    if memory is None:
+        if options["template_memory"] is not None:
+            memory = options["template_memory"] * cores / float(options["template_cores"] or 1)
+        else:
+            memory = DEFAULT_MEMORY_MB_PER_CORE * cores
+    return (min(cores, options["max_cores"]), min(memory, options["max_memory"]))
+
+
+def read_commands(command_files):
+    commands = []
+    for command_file in command_files:
+        with open(command_file, "r") as command_stream:
+            commands += [record.strip() for record in command_stream if len(record.strip()) > 0]
+    return commands
+
+
+def start_command(number, command, options):
+    run_base = os.path.join(options["hpc_folder"], "run-%d" % number)
+    if options["shell_include_file"] is not None:
+        command = "source %s\n%s" % (options["shell_include_file"], command)
+    with open(run_base + ".sh", "w") as script_stream:
+        print(command, file=script_stream)
+    stdout_stream = open(run_base + ".stdout", "w")
+    stderr_stream = open(run_base + ".stderr", "w")
+    process = subprocess.Popen(["/bin/bash", run_base + ".sh"], stdout=stdout_stream, stderr=stderr_stream)
+    return (process, stdout_stream, stderr_stream)
+
+
+def run_commands(options):
+    commands = read_commands(options["command_files"])
+    resources = [get_command_resources(command, options) for command in commands]
+    print("running %d commands with up to %d cores and %.0f MB (cores, MB per command %s)" % (len(commands), options["max_cores"], options["max_memory"],
+        ", ".join(sorted(set("%d, %.0f" % resource for resource in resources)))), file=sys.stderr)
+
+    (free_cores, free_memory) = (options["max_cores"], options["max_memory"])
+    running = {}
+    failed = 0
+    next_command = 0
+    while next_command < len(commands) or len(running) > 0:
+        while next_command < len(commands) and (len(running) == 0 or (resources[next_command][0] <= free_cores and resources[next_command][1] <= free_memory)):
+            (process, stdout_stream, stderr_stream) = start_command(next_command + 1, commands[next_command], options)
+            running[process] = (next_command, stdout_stream, stderr_stream, time.time())
+            free_cores -= resources[next_command][0]
+            free_memory -= resources[next_command][1]
+            next_command += 1
+
+        time.sleep(POLL_SECONDS)
+        for process in [process for process in running if process.poll() is not None]:
+            (number, stdout_stream, stderr_stream, started) = running.pop(process)
+            stdout_stream.close()
+            stderr_stream.close()
+            free_cores += resources[number][0]
+            free_memory += resources[number][1]
+            with open(os.path.join(options["hpc_folder"], "run-%d.exit" % (number + 1)), "w") as exit_stream:
+                print(process.returncode, file=exit_stream)
+            if process.returncode != 0:
+                failed += 1
+                print("command %d failed (%d) after %.0f seconds - see %s" % (number + 1, process.returncode, time.time() - started,
+                    os.path.join(options["hpc_folder"], "run-%d.stderr" % (number + 1))), file=sys.stderr)
+
+    print("%d of %d commands succeeded (logs in %s)" % (len(commands) - failed, len(commands), options["hpc_folder"]), file=sys.stderr)
+    return failed
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+runs the commands of melseq_prism command files on this machine, as many at once as its cores and memory allow (in place of tardis, for -C local)
+
+examples :
+
+./local_executor.py -d /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/trimming -s /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/configure_cutadapt_env.src -m /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stage_metrics.jsonl -S trim /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/trim_commands.packed.txt
+
+# blast (8 cores per command, from -num_threads 8 in the commands), using at most 48 cores and 200G
+./local_executor.py -j 48 -M 200G -d /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast -s /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast_env.inc -T /dataset/gseq_processing/active/bin/melseq_prism/etc/melseq_blast_slurm_array_job /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast_commands.txt
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command_files', type=str, nargs="+", help='command files (one command per line)')
+    parser.add_argument('-d', '--work_folder', dest='work_folder', type=str, default=".", help='folder to write the tardis_<moniker> folder of logs and exit codes to (default current folder)')
+    parser.add_argument('-s', '--shell_include_file', dest='shell_include_file', type=str, default=None, help='file to source before each command (e.g. to activate an environment)')
+    parser.add_argument('-j', '--max_cores', dest='max_cores', type=int, default=None, help='most cores to use (default all the cores available)')
+    parser.add_argument('-M', '--max_memory', dest='max_memory', type=str, default=None, help='most memory to use e.g. 200G (default 90%% of the available memory)')
+    parser.add_argument('-T', '--job_template', dest='job_template', type=str, default=None, help='slurm job template to take the cores and memory per command from (default the jobtemplatefile in tardis.toml in the current folder, if any)')
+    parser.add_argument('-m', '--metrics_file', dest='metrics_file', type=str, default=None, help='stage_metrics.jsonl of previous runs, to take the memory per command from')
+    parser.add_argument('-S', '--stage', dest='stage', type=str, default=None, help='stage of the commands, in the metrics file')
+
+    args = vars(parser.parse_args())
+
+    for filename in args["command_files"]:
+        if not os.path.isfile(filename):
+            raise local_executor_exception("%s is not a file" % filename)
+    if not os.path.isdir(args["work_folder"]):
+        raise local_executor_exception("%s is not a folder" % args["work_folder"])
+
+    if args["max_cores"] is None:
+        args["max_cores"] = get_available_cores()
+    if args["max_memory"] is None:
+        available = get_available_memory_mb()
+        args["max_memory"] = 0.9 * available if available is not None else float("inf")
+    else:
+        args["max_memory"] = get_memory_mb(args["max_memory"])
+
+    if args["job_template"] is None:
+        args["job_template"] = get_job_template_filename()
+    (args["template_cores"], args["template_memory"]) = (None, None)
+    if args["job_template"] is not None and os.path.isfile(args["job_template"]):
+        (args["template_cores"], args["template_memory"]) = read_job_template(args["job_template"])
+    args["stage_memory"] = get_stage_memory_mb(args["metrics_file"], args["stage"])
+
+    args["hpc_folder"] = os.path.join(args["work_folder"], "tardis_local_%s_%d" % (time.strftime("%Y%m%d%H%M%S"), os.getpid()))
+    os.makedirs(args["hpc_folder"])
+
+    return args
+
+
+def main():
+    options = get_options()
+    failed = run_commands(options)
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+   main()
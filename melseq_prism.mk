@@ -8,47 +8,60 @@
 
 
 ##############################################
-# how to make individual targets, but no dependency 
+# how to make individual targets, but no dependency
+# (each stage script is run by stage_metrics.py, which appends its time, memory and i/o to stage_metrics.jsonl -
+# see stage_metrics.py -t report)
 ##############################################
 %.html:
-	$@.sh > $@.mk.log 2>&1
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s html -- $@.sh > $@.mk.log 2>&1
 	date > $@
 
 %.demultiplex:
-	$@.sh > $@.mk.log 2>&1
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s demultiplex -- $@.sh > $@.mk.log 2>&1
 	date > $@
 
 %.trim:
-	$@.sh > $@.mk.log 2>&1
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s trim -- $@.sh > $@.mk.log 2>&1
 	date > $@
 
 %.format:
-	$@.sh > $@.mk.log 2>&1
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s format -- $@.sh > $@.mk.log 2>&1
 	date > $@
 
-#note that this merge_lanes target did a simple concatenation of the non-redundant fasta files. Although this worked and passed testing, it had a couple of bugs (
-#(1) resulting fasta file has different seqs with the same name, (2) resulting fasta file was no longer "non-redundant". So this target 
-#is deprecated , and no longer part of the pipeline. Merging of lanes now done as part of the trimming step, by piping both lanes to cutadapt  
+#note that this merge_lanes target originally did a simple concatenation of the non-redundant fasta files, which had a couple of bugs (
+#(1) resulting fasta file has different seqs with the same name, (2) resulting fasta file was no longer "non-redundant"). It now does 
+#a count-summing merge (merge_lanes.py -t merge_non_redundant) which fixes both. It is still not part of the default pipeline - merging of 
+#lanes is usually done as part of the trimming step, by piping both lanes to cutadapt  
 %.merge_lanes:
-	$@.sh > $@.mk.log 2>&1
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s merge_lanes -- $@.sh > $@.mk.log 2>&1
+	date > $@
+
+%.dereplicate:
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s dereplicate -- $@.sh > $@.mk.log 2>&1
 	date > $@
 
 %.blast:
-	$@.sh > $@.mk.log 2>&1
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s blast -- $@.sh > $@.mk.log 2>&1
 	date > $@
 
 %.kmer_analysis:
-	$@.sh > $@.mk.log 2>&1
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s kmer_analysis -- $@.sh > $@.mk.log 2>&1
 	date > $@
 
 %.summarise:
-	$@.sh > $@.mk.log 2>&1
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s summarise -- $@.sh > $@.mk.log 2>&1
+	date > $@
+
+# (runs trim, format, blast and summarise for each sample on its own - see sample_stream.py - writing the .trim, .format, 
+# .blast and .summarise markers as each stage is done for all the samples)
+%.stream:
+	$(@D)/stage_metrics.py -t run -m $(@D)/stage_metrics.jsonl -s stream -- $@.sh > $@.mk.log 2>&1
 	date > $@
 
 ##############################################
 # specify the intermediate files to keep 
 ##############################################
-.PRECIOUS:  %.demultiplex %.trim %.format %.blast %.kmer_analysis %.summarise
+.PRECIOUS:  %.demultiplex %.trim %.format %.dereplicate %.blast %.kmer_analysis %.summarise %.stream
 
 ##############################################
 # cleaning - not yet doing this using make  
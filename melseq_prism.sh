@@ -24,9 +24,26 @@ function get_opts() {
    blast_task=blastn
    adapter_to_trim=""
    blast_extra=""
+   summary_format=expanded
+   blast_cache=""
+   task_packing=""
+   tag_index=""
+   stream_jobs=50
+   rarefy_depth=""
+   rarefy_seed=1
    help_text="
 \n
-./melseq_prism.sh  [-h] [-n] [-d] -a analysis -b blast_database [-w wordsize (16)] [-T blastn|megablast (blastn)] -s similarity (.02)] [-m min_length (40)] [-q min_qual (20)]  [-C local|slurm (slurm)] -O outdir input_file_names\n
+./melseq_prism.sh  [-h] [-n] [-d] [-f] -a analysis -b blast_database [-w wordsize (16)] [-T blastn|megablast (blastn)] -s similarity (.02)] [-m min_length (40)] [-q min_qual (20)]  [-C local|slurm (slurm)] [-t taxonomiser] [-F expanded|collapsed (expanded)] [-K blast_cache] [-X tag_index] [-J jobs|seconds] [-j stream_jobs (50)] [-D rarefy_depth] [-R rarefy_seed (1)] -O outdir input_file_names\n
+\n
+(the taxonomiser is either an R script such as gtdb/summarizeR_counts.code, or a python script such as gtdb/summarize_counts.py)\n
+(-F collapsed writes summaries with one record per sequence plus a count column, rather than one record per read - python taxonomisers only)\n
+(if the blast database is deduplicated - gtdb/format_database.py -t dedupe_fasta - its duplicates file <blast_database>.duplicates.txt is used by the python taxonomisers to expand hits on collapsed contigs)\n
+(-K gives a (sqlite) cache of blast results from previous runs - only sequences not already in the cache are blasted. With a python taxonomiser, their LCA assignments are cached too. A cache can be shared by concurrent runs)\n
+(-X gives a restriction tag index built by gtdb/format_database.py -t build_tag_index - sequences which exactly match a reference tag are assigned from the index, and only the rest are blasted. Give it to both the blast and summarise steps)\n
+(the trim, format, blast and summarise stages only redo the samples whose inputs, parameters or outputs have changed since they were last done, as recorded in stage_manifest.jsonl - -f redoes all the samples)\n
+(-a stream runs the trim, format, blast and summarise stages for each sample on its own, given the demultiplexed fastq - each sample goes on to its next stage as soon as its previous stage is done, rather than waiting for all the samples. -j gives the most stage commands to run at once)\n
+(-D rarefies each sample to at most this many reads before blasting (sampling without replacement from the counts of the non-redundant fasta, with seed -R), so that the deepest samples do not dominate the blast and summarise - the sampling fraction of each sample is written to rarefied/rarefaction_fractions.txt. Not for use with a run-wide dereplicate)\n
+(-J packs the per-sample trim, format and summary commands into balanced jobs - either a number of jobs e.g. -J 100, or a target runtime per job in seconds e.g. -J 1800s)\n
 \n
 \n
 example:\n
@@ -43,7 +60,7 @@ example:\n
 "
 
    # defaults:
-   while getopts ":nhdfO:C:b:t:m:s:q:a:l:e:A:w:T:t:x:" opt; do
+   while getopts ":nhdfO:C:b:t:m:s:q:a:l:e:A:w:T:t:x:F:K:J:X:j:D:R:" opt; do
    case $opt in
        n)
          DRY_RUN=yes
@@ -100,6 +117,27 @@ example:\n
        x)
          blast_extra=$OPTARG
          ;;
+       F)
+         summary_format=$OPTARG
+         ;;
+       K)
+         blast_cache=$OPTARG
+         ;;
+       J)
+         task_packing=$OPTARG
+         ;;
+       X)
+         tag_index=$OPTARG
+         ;;
+       j)
+         stream_jobs=$OPTARG
+         ;;
+       D)
+         rarefy_depth=$OPTARG
+         ;;
+       R)
+         rarefy_seed=$OPTARG
+         ;;
 
        \?)
          echo "Invalid option: -$OPTARG" >&2
@@ -128,8 +166,8 @@ example:\n
 
 
 function check_opts() {
-   if [[ ( $ANALYSIS != "demultiplex" ) && ( $ANALYSIS != "trim" ) && ( $ANALYSIS != "format" ) && ( $ANALYSIS != "merge_lanes" ) && ( $ANALYSIS != "blast" ) && ( $ANALYSIS != "kmer_analysis" ) && ( $ANALYSIS != "summarise" )  && ( $ANALYSIS != "html" ) ]] ; then
-      echo "analysis must be one of demultiplex, trim , format, merge_lanes, blast, summarise , html, clean) "
+   if [[ ( $ANALYSIS != "demultiplex" ) && ( $ANALYSIS != "trim" ) && ( $ANALYSIS != "format" ) && ( $ANALYSIS != "merge_lanes" ) && ( $ANALYSIS != "dereplicate" ) && ( $ANALYSIS != "blast" ) && ( $ANALYSIS != "kmer_analysis" ) && ( $ANALYSIS != "summarise" )  && ( $ANALYSIS != "html" ) && ( $ANALYSIS != "stream" ) ]] ; then
+      echo "analysis must be one of demultiplex, trim , format, merge_lanes, dereplicate, blast, summarise , html, stream, clean) "
       exit 1
    fi
 
@@ -192,6 +230,69 @@ function check_opts() {
       exit 1
    fi
 
+   if [[ ( $summary_format != "expanded" ) && ( $summary_format != "collapsed" ) ]]; then
+      echo "summary format must be one of expanded, collapsed"
+      exit 1
+   fi
+   if [[ ( $summary_format == "collapsed" ) && ( $ANALYSIS == "summarise" ) && ( $taxonomiser != *.py ) ]]; then
+      echo "collapsed summaries are only supported by the python taxonomisers"
+      exit 1
+   fi
+   if [[ ( ! -z "$taxonomy_blast_database" ) && ( -f ${taxonomy_blast_database}.duplicates.txt ) && ( $taxonomiser != *.py ) ]]; then
+      echo "${taxonomy_blast_database} is deduplicated - its duplicates file ${taxonomy_blast_database}.duplicates.txt is only used by the python taxonomisers (-t) - e.g. gtdb/summarize_counts.py"
+      exit 1
+   fi
+   if [[ ( $ANALYSIS == "dereplicate" ) && ( $taxonomiser != *.py ) ]]; then
+      echo "a run-wide catalogue is summarised collapsed, so needs a python taxonomiser (-t) - e.g. gtdb/summarize_counts.py"
+      exit 1
+   fi
+   if [[ ( $ANALYSIS == "summarise" ) && ( $taxonomiser != *.py ) ]]; then
+      for ((i=0;$i<$NUM_FILES;i=$i+1)) do
+         if [[ `basename ${files_array[$i]}` == catalogue.non-redundant.fasta* ]]; then
+            echo "the run-wide catalogue is summarised collapsed, so needs a python taxonomiser (-t) - e.g. gtdb/summarize_counts.py"
+            exit 1
+         fi
+      done
+   fi
+   if [ ! -z "$blast_cache" ]; then
+      if [ ! -d `dirname $blast_cache` ]; then
+         echo "folder for blast cache $blast_cache does not exist"
+         exit 1
+      fi
+   fi
+   if [ ! -z "$tag_index" ]; then
+      if [ ! -f $tag_index ]; then
+         echo "tag index $tag_index does not exist"
+         exit 1
+      fi
+   fi
+   if [ $ANALYSIS == "stream" ]; then
+      if [ -z "$taxonomy_blast_database" ]; then
+         echo "stream requires a blast database (-b)"
+         exit 1
+      fi
+      if [[ ( ! -z "$blast_cache" ) || ( ! -z "$tag_index" ) || ( ! -z "$rarefy_depth" ) ]]; then
+         echo "stream does not support the blast cache (-K), tag index (-X) or rarefaction (-D) - run the stages one at a time to use these"
+         exit 1
+      fi
+      if [[ ! $stream_jobs =~ ^[0-9]+$ ]]; then
+         echo "number of stream jobs (-j) must be a number"
+         exit 1
+      fi
+   fi
+   if [ ! -z "$rarefy_depth" ]; then
+      if [[ ( ! $rarefy_depth =~ ^[0-9]+$ ) || ( ! $rarefy_seed =~ ^[0-9]+$ ) ]]; then
+         echo "rarefy depth (-D) and seed (-R) must be numbers"
+         exit 1
+      fi
+   fi
+   if [ ! -z "$task_packing" ]; then
+      if [[ ! $task_packing =~ ^[0-9]+s?$ ]]; then
+         echo "task packing (-J) must be a number of jobs (e.g. 100) or a target runtime per job in seconds (e.g. 1800s)"
+         exit 1
+      fi
+   fi
+
 }
 
 function echo_opts() {
@@ -207,6 +308,12 @@ function echo_opts() {
   echo seqlength_min=$seqlength_min
   echo wordsize=$wordsize
   echo blast_task=$blast_task
+  echo summary_format=$summary_format
+  echo blast_cache=$blast_cache
+  echo task_packing=$task_packing
+  echo tag_index=$tag_index
+  echo rarefy_depth=$rarefy_depth
+  echo rarefy_seed=$rarefy_seed
   echo SAMPLE_INFO=$SAMPLE_INFO
   echo ENZYME_INFO=$ENZYME_INFO
   echo ANALYSIS=$ANALYSIS
@@ -224,7 +331,24 @@ function configure_env() {
    cp ./melseq_prism.mk $OUT_DIR
    cp ./add_sample_name.py $OUT_DIR
    cp ./countUniqueReads.sh $OUT_DIR
+   cp ./dereplicate_fastq.py $OUT_DIR
+   cp ./seq_io.py $OUT_DIR
+   cp ./global_dereplicate.py $OUT_DIR
+   cp ./blast_cache.py $OUT_DIR
+   cp ./stage_metrics.py $OUT_DIR
+   cp ./pack_commands.py $OUT_DIR
+   cp ./stage_manifest.py $OUT_DIR
+   cp ./sample_stream.py $OUT_DIR
+   cp ./local_executor.py $OUT_DIR
+   cp ./tag_lookup.py $OUT_DIR
+   cp ./rarefy_fasta.py $OUT_DIR
+   cp ./cohort_diversity.py $OUT_DIR
+   cp ./kmer_profile.py $OUT_DIR
+   cp ./gtdb/tag_index.py $OUT_DIR
    cp $taxonomiser $OUT_DIR
+   if [[ $taxonomiser == *.py ]]; then
+      cp `dirname $taxonomiser`/taxonomy_index.py $OUT_DIR
+   fi
    cp $GBS_PRISM_BIN/demultiplex_prism.sh $OUT_DIR
    cp $GBS_PRISM_BIN/demultiplex_prism.mk $OUT_DIR
    cp profile_prism.py $OUT_DIR
@@ -270,6 +394,12 @@ max_tasks = 400
 jobtemplatefile = \"$MELSEQ_PRISM_BIN/etc/melseq_summary_slurm_array_job\"
 " > $OUT_DIR/tardis.toml.summary
 
+   # the python taxonomisers memory-map a shared taxonomy index, so need much less memory per task than the R ones
+   echo "
+max_tasks = 800
+jobtemplatefile = \"$MELSEQ_PRISM_BIN/etc/melseq_summary_py_slurm_array_job\"
+" > $OUT_DIR/tardis.toml.summary_py
+
    cp $OUT_DIR/tardis.toml.summary $OUT_DIR/tardis.toml  #default for other tasks as well 
 
    cd $OUT_DIR
@@ -289,6 +419,151 @@ function check_env() {
    fi
 }
 
+function pack_commands() {
+   # packs a command file (one command per sample) into balanced jobs, largest first, writing e.g. format_commands.packed.txt
+   # from format_commands.txt (with no -J, each command is still a job, but the largest are started first)
+   command_file=$1
+   stage=$2
+   packing_phrase=""
+   if [[ $task_packing == *s ]]; then
+      packing_phrase="-r ${task_packing%s} -m $OUT_DIR/stage_metrics.jsonl -s $stage"
+   elif [ ! -z "$task_packing" ]; then
+      packing_phrase="-n $task_packing"
+   fi
+   python $OUT_DIR/pack_commands.py $packing_phrase -O ${command_file%.txt}.packed.txt $command_file > ${command_file%.txt}.packed.log 2>&1
+   if [ $? != 0 ]; then
+      # fall back to the unpacked commands (one per job), rather than launching a missing or partial packed file
+      echo "warning - packing $command_file failed (see ${command_file%.txt}.packed.log), so running its commands unpacked"
+      cp $command_file ${command_file%.txt}.packed.txt
+   fi
+}
+
+function filter_units() {
+   # writes the commands (or with -L, the inputs) of the units (samples) of a stage which are not already current in the 
+   # stage manifest, so that a rerun only redoes the samples whose inputs, parameters or outputs have changed (see stage_manifest.py). 
+   # Each command is followed by a step to record it in the manifest. With -f (FORCE), all units are done
+   units_file=$1
+   output_file=$2
+   stage=$3
+   shift 3
+   force_phrase=""
+   if [ $FORCE == "yes" ]; then
+      force_phrase="-f"
+   fi
+   python $OUT_DIR/stage_manifest.py -t filter $force_phrase -m $OUT_DIR/stage_manifest.jsonl -s $stage "$@" -O $output_file $units_file > ${units_file%.txt}.log 2>&1
+   if [ $? != 0 ]; then
+      echo "error checking $stage units against the stage manifest - see ${units_file%.txt}.log"
+      exit 1
+   fi
+}
+
+function get_launcher() {
+   # sets launcher to run the commands in a command file - with tardis, or with -C local, with local_executor.py (which runs as many 
+   # at once as the cores and memory of this machine allow, writing the logs and exit codes to a tardis_ folder, as tardis does)
+   stage=$1
+   work_folder=$2
+   command_file=$3
+   include_file=$4
+   runner=${5:-source}
+   if [ $HPC_TYPE == "local" ]; then
+      include_phrase=""
+      if [ ! -z "$include_file" ]; then
+         include_phrase="-s $include_file"
+      fi
+      launcher="python $OUT_DIR/local_executor.py -d $work_folder $include_phrase -m $OUT_DIR/stage_metrics.jsonl -S $stage $command_file"
+   else
+      include_phrase=""
+      if [ ! -z "$include_file" ]; then
+         include_phrase="--shell-include-file $include_file"
+      fi
+      launcher="tardis -c 1 --hpctype $HPC_TYPE -d $work_folder $include_phrase $runner _condition_text_input_$command_file"
+   fi
+}
+
+function get_local_blast_command() {
+   # sets command to blast a query file with -C local (in place of align_prism, which runs blast with tardis), writing the results 
+   # to the results folder, named as align_prism would name them (an empty query gets empty results)
+   query=$1
+   results_folder=$2
+   blast_params="-num_threads 8 -task $blast_task -word_size $wordsize -outfmt '6 std qlen ' -evalue $similarity $blast_extra"
+   results="$results_folder/\$(basename $query).blastn.`basename $taxonomy_blast_database`.`echo $blast_params | sed 's/[^A-Za-z0-9_.]//g'`.results"
+   command="if [ -s $query ]; then blastn -query $query -db $taxonomy_blast_database $blast_params -out $results; else touch $results; fi && gzip -f $results"
+}
+
+function get_blast_step() {
+   # sets blast_step to the step of the blast script that blasts the query files (a shell expression, expanded when the script runs), 
+   # writing the results to the results folder - with align_prism, or with -C local, with local_executor.py (as many files at once 
+   # as the machine allows, each with the cores of a blast job)
+   queries=$1
+   results_folder=$2
+   if [ $HPC_TYPE == "local" ]; then
+      get_local_blast_command '$query' $results_folder
+      blast_step="rm -f $OUT_DIR/blast_commands.txt
+for query in $queries; do
+   echo \"$command\" >> $OUT_DIR/blast_commands.txt
+done
+python $OUT_DIR/local_executor.py -d $results_folder -s $OUT_DIR/blast_env.inc -T $MELSEQ_PRISM_BIN/etc/melseq_blast_slurm_array_job -m $OUT_DIR/stage_metrics.jsonl -S blast $OUT_DIR/blast_commands.txt > $OUT_DIR/blast.log 2>&1"
+   else
+      blast_step="$SEQ_PRISMS_BIN/align_prism.sh $dry_run_phrase -C $HPC_TYPE -j 8 -B 4 -m 80 -f -a blastn -e $OUT_DIR/blast_env.inc -r $taxonomy_blast_database -p \"-num_threads 8 -task $blast_task -word_size $wordsize -outfmt \\'6 std qlen \\' -evalue $similarity $blast_extra \"  -O $results_folder $queries > $OUT_DIR/blast.log 2>&1"
+   fi
+}
+
+function get_format_command() {
+   # sets command to the command to convert a trimmed fastq file to non-redundant fasta (format_output) - run by stage_metrics.py, 
+   # to record the time, memory and i/o in stage_metrics.jsonl
+   file=$1
+   file_base=`basename $file .fastq.gz`
+   format_output=$OUT_DIR/fasta/${file_base}.non-redundant.fasta
+   command="$OUT_DIR/dereplicate_fastq.py -T $OUT_DIR/TEMP -o $format_output $file 2>${format_output}.stderr"
+   command="$OUT_DIR/stage_metrics.py -t run -m $OUT_DIR/stage_metrics.jsonl -s format -i $file -o $format_output --count_records -- '$command'"
+}
+
+function get_summary_command() {
+   # sets command to the command to summarise a blast results file (with base name base - i.e. without .results.gz) to 
+   # summary/${base}.summary, and unit_inputs to the files the summary depends on - run by stage_metrics.py, to record the 
+   # time, memory and i/o in stage_metrics.jsonl
+   file=$1
+   base=$2
+   taxonomiser_base=`basename $taxonomiser`
+   unit_inputs=$file
+   base_summary_format=$summary_format
+   if [[ ( $base == catalogue.non-redundant.fasta* ) && ( -f $OUT_DIR/catalogue/catalogue.samples.txt ) ]]; then
+      # the catalogue summary is always collapsed (each catalogue sequence carries its run-wide count) - expand_summaries 
+      # only needs its rank columns, and writes the per-sample summaries in the format asked for
+      base_summary_format=collapsed
+   fi
+   if [[ $taxonomiser_base == *.py ]]; then
+      # python taxonomisers stream the compressed results directly, so no need for the uncompressed .resultsNucl copy
+      duplicates_phrase=""
+      if [[ ( ! -z "$taxonomy_blast_database" ) && ( -f ${taxonomy_blast_database}.duplicates.txt ) ]]; then
+         # deduplicated blast database (gtdb/format_database.py -t dedupe_fasta) - expand hits on collapsed contigs
+         duplicates_phrase="-d ${taxonomy_blast_database}.duplicates.txt"
+      fi
+      assignments_phrase=""
+      if [ -f $OUT_DIR/blast/${base}.lca.txt ]; then
+         # LCA assignments cached by the blast cache (-K) - used for the sequences they cover, rather than re-running the LCA 
+         # (summarize_counts.py ignores them if they were made with another taxonomy, or are older than the results)
+         assignments_phrase="-A $OUT_DIR/blast/${base}.lca.txt"
+         unit_inputs="$unit_inputs $OUT_DIR/blast/${base}.lca.txt"
+      fi
+      command="set -e; python $OUT_DIR/$taxonomiser_base -F $base_summary_format $duplicates_phrase $assignments_phrase -O $OUT_DIR/summary $file 1>$OUT_DIR/summary/${base}.summary.stdout 2>$OUT_DIR/summary/${base}.summary.stderr"
+   else
+      # (the R script appends to the summary, and writes nothing for results with no hits (e.g. all the sequences were assigned 
+      # from the tag index), so the summary is created empty first, and the script only run if there are results)
+      command="set -e; : > $OUT_DIR/summary/${base}.summary; gunzip -c $file  > $OUT_DIR/summary/${base}.resultsNucl ; if [ -s $OUT_DIR/summary/${base}.resultsNucl ]; then Rscript --vanilla $OUT_DIR/$taxonomiser_base $OUT_DIR/summary/${base}.resultsNucl 1>$OUT_DIR/summary/${base}.resultsNucl.stdout 2>$OUT_DIR/summary/${base}.resultsNucl.stderr; fi; /usr/bin/rm -f $OUT_DIR/summary/${base}.resultsNucl"
+   fi
+   if [ ! -z "$tag_index" ]; then
+      # add the sequences that were assigned from the tag index, rather than blasted (see blast), to the summary
+      command="$command; python $OUT_DIR/tag_lookup.py -t append_summary -F $base_summary_format -A $OUT_DIR/tag_index_assignments/${base%%.blastn.*}.tag_assignments.txt $OUT_DIR/summary/${base}.summary 2>$OUT_DIR/summary/${base}.tag_lookup.stderr"
+      unit_inputs="$unit_inputs $OUT_DIR/tag_index_assignments/${base%%.blastn.*}.tag_assignments.txt"
+   fi
+   if [[ ( $base == catalogue.non-redundant.fasta* ) && ( -f $OUT_DIR/catalogue/catalogue.samples.txt ) ]]; then
+      # results are for the run-wide catalogue (see dereplicate) - rebuild the per-sample summaries from the catalogue summary
+      command="$command; python $OUT_DIR/global_dereplicate.py -t expand_summaries -F $summary_format -C $OUT_DIR/catalogue -O $OUT_DIR/summary $OUT_DIR/summary/${base}.summary 2>$OUT_DIR/summary/${base}.expand.stderr"
+   fi
+   command="$OUT_DIR/stage_metrics.py -t run -m $OUT_DIR/stage_metrics.jsonl -s summarise -i $file -- '$command'"
+}
+
 function get_targets() {
 
    rm -f $OUT_DIR/melseq_targets.txt
@@ -303,7 +578,7 @@ function get_targets() {
 
 
    # for all processing, all files are part of a single make target 
-   for analysis_type in demultiplex trim format merge_lanes blast summarise kmer_analysis html; do
+   for analysis_type in demultiplex trim format merge_lanes dereplicate blast summarise kmer_analysis html stream; do
       echo $OUT_DIR/all.$analysis_type  > $OUT_DIR/${analysis_type}_targets.txt
    done
 
@@ -342,16 +617,31 @@ fi
    if [ ! -z "$adapter_to_trim" ]; then
       adapter_phrase="-a $adapter_to_trim "
    fi
-   python merge_lanes.py -t generate_merge_trim_commands -a "$adapter_phrase" -M $OUT_DIR/trimming -O $OUT_DIR/trim_commands.txt  $OUT_DIR/input_file_list.txt
+   python merge_lanes.py -t generate_merge_trim_commands -a "$adapter_phrase" -M $OUT_DIR/trimming -O $OUT_DIR/trim_commands.txt.unwrapped -U $OUT_DIR/trim_units.txt.unwrapped $OUT_DIR/input_file_list.txt
+   # each command is run by stage_metrics.py, to record its time, memory and i/o in stage_metrics.jsonl (the sample is parsed from the command), 
+   # and only the samples which are not already current in the stage manifest are trimmed 
+   rm -f $OUT_DIR/trim_units.txt
+   touch $OUT_DIR/trim_units.txt
+   while IFS=$'\t' read -r inputs outputs command; do
+      input_phrase=`echo $inputs | awk '{for(i=1;i<=NF;i++) printf("-i %s ", $i);}'`
+      printf "%s\t%s\t%s\n" "$inputs" "$outputs" "$OUT_DIR/stage_metrics.py -t run -m $OUT_DIR/stage_metrics.jsonl -s trim $input_phrase-- '$command'" >> $OUT_DIR/trim_units.txt
+   done < $OUT_DIR/trim_units.txt.unwrapped
+   filter_units $OUT_DIR/trim_units.txt $OUT_DIR/trim_commands.txt trim --params="$adapter_phrase" -P $MELSEQ_PRISM_BIN/merge_lanes.py
+   pack_commands $OUT_DIR/trim_commands.txt trim
 
    # the script that will be launched to launch those 
+   get_launcher trim $OUT_DIR/trimming $OUT_DIR/trim_commands.packed.txt $OUT_DIR/configure_cutadapt_env.src
 echo "#!/bin/bash
 export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
 export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN 
 
 cd $OUT_DIR
 mkdir -p trimming
-tardis -c 1 --hpctype $HPC_TYPE -d $OUT_DIR/trimming --shell-include-file $OUT_DIR/configure_cutadapt_env.src source _condition_text_input_$OUT_DIR/trim_commands.txt > $OUT_DIR/trimming.log 2>&1
+if [ ! -s $OUT_DIR/trim_commands.packed.txt ]; then
+   echo \"all trimming is current (see $OUT_DIR/stage_manifest.jsonl) - nothing to do\"
+   exit 0
+fi
+$launcher > $OUT_DIR/trimming.log 2>&1
 if [ \$? != 0 ]; then
    echo \"warning trimming returned an error code\"
    exit 1
@@ -368,45 +658,45 @@ fi
    #>B74231_CTACAGA_psti.000000002 D00390:318:CB6K1ANXX:5:2302:4605:2098
    #TGCAGCAGAAGAAAAAGCGCCTGAAGCAGAGAAAGCTCCTGAGGCAGCAAAACCTGAGCCTGCAAAGGAAGAAGAGTATGTAAATGCTCCGG
 
-   # the format  script will launch two command files that we also prepare here
+   # the format  script will launch a command file that we also prepare here. (This used to be two command files - 
+   # add_sample_name.py to write a fasta file, then countUniqueReads.sh to sort and count it. dereplicate_fastq.py
+   # now writes the same non-redundant fasta in one pass of the trimmed fastq). Each command is run by stage_metrics.py, to 
+   # record its time, memory and i/o in stage_metrics.jsonl. Only the samples which are not already current in the stage manifest 
+   # are formatted - a sample with no manifest record, whose non-redundant fasta is newer than its fastq, is taken to be current 
+   # (as this used to skip any sample whose non-redundant fasta existed)
    # generate format conversion command file:
-   rm -f $OUT_DIR/format_commands.txt
-   rm -f $OUT_DIR/count_commands.txt
-   touch $OUT_DIR/format_commands.txt
-   touch $OUT_DIR/count_commands.txt
+   rm -f $OUT_DIR/format_units.txt
+   touch $OUT_DIR/format_units.txt
    for file in `cat $OUT_DIR/input_file_list.txt`; do
-      file_base=`basename $file .fastq.gz`
-      if [ ! -f $OUT_DIR/fasta/${file_base}.non-redundant.fasta ]; then
-         # dont want any more than one or 2 chunks 
-         echo "tardis -d $OUT_DIR/fasta --hpctype $HPC_TYPE -c 999999999 cat _condition_fastq2fasta_input_$file \| $OUT_DIR/add_sample_name.py $file_base \> $OUT_DIR/fasta/${file_base}.fasta 2\>$OUT_DIR/fasta/${file_base}.fasta.stderr " >> $OUT_DIR/format_commands.txt
-         echo "tardis -d $OUT_DIR/fasta --hpctype $HPC_TYPE -c 999999999 cat $OUT_DIR/fasta/${file_base}.fasta \| $OUT_DIR/countUniqueReads.sh $OUT_DIR/TEMP  \> $OUT_DIR/fasta/${file_base}.non-redundant.fasta 2\>$OUT_DIR/fasta/${file_base}.non-redundant.fasta.stderr " >> $OUT_DIR/count_commands.txt
-      fi
+      get_format_command $file
+      printf "%s\t%s\t%s\n" "$file" "$format_output" "$command" >> $OUT_DIR/format_units.txt
    done
+   filter_units $OUT_DIR/format_units.txt $OUT_DIR/format_commands.txt format -a -P $MELSEQ_PRISM_BIN/dereplicate_fastq.py
+   pack_commands $OUT_DIR/format_commands.txt format
    # the script that will be launched to launch those 
+   get_launcher format $OUT_DIR/fasta $OUT_DIR/format_commands.packed.txt
 echo "#!/bin/bash
 export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
 export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
 
 cd $OUT_DIR
 mkdir -p fasta
-tardis --hpctype $HPC_TYPE  -c 1 -d $OUT_DIR/fasta source _condition_text_input_$OUT_DIR/format_commands.txt > $OUT_DIR/format.log 2>&1
-if [ \$? != 0 ]; then
-   echo \"warning fasta conversion returned an error code\"
-   exit 1
+if [ ! -s $OUT_DIR/format_commands.packed.txt ]; then
+   echo \"all fasta conversions are current (see $OUT_DIR/stage_manifest.jsonl) - nothing to do\"
+   exit 0
 fi
-tardis --hpctype $HPC_TYPE -c 1 -d $OUT_DIR/fasta source _condition_text_input_$OUT_DIR/count_commands.txt > $OUT_DIR/count.log 2>&1
+$launcher > $OUT_DIR/format.log 2>&1
 if [ \$? != 0 ]; then
-   echo \"warning count nonredundant returned an error code\"
+   echo \"warning fasta conversion returned an error code\"
    exit 1
 fi
      " >  $OUT_DIR/all.format.sh
    chmod +x $OUT_DIR/all.format.sh
 
    ################ merge_lanes script
-   # ***********************************************************************
-   # ******************* This target and script now deprecated *************
-   # ***********************************************************************
-   # merges fasta files from different lanes  - motivated by novaseq data which arrives split into lanes
+   # merges non-redundant fasta files from different lanes  - motivated by novaseq data which arrives split into lanes
+   # (lanes are usually merged as part of trimming, but this allows per-lane fasta - e.g. when a lane is added later - to be merged
+   # without re-trimming. The merge sums the counts of identical sequences so the merged file is still non-redundant)
    # e.g. 
    # iramohio-01$ grep 966045_AGGCTAGGAT /dataset/GBS_Microbiomes_Processing/itmp/melseq/SQ1635/blast_input_file_list.txt
    # /dataset/GBS_Microbiomes_Processing/itmp/melseq/SQ1635/fasta/SQ1635_HCH3GDRXY_s_1_fastq.txt.gz.demultiplexed_966045_AGGCTAGGAT_psti.R1_trimmed.fastq.non-redundant.fasta
@@ -415,15 +705,16 @@ fi
    # the merge script will launch a command files we prepare here
    # generate merge command file:
    rm -f $OUT_DIR/merge_lanes_commands.txt
-   $OUT_DIR/merge_lanes.py -M $OUT_DIR/merged_fasta -O $OUT_DIR/merge_lanes_commands.txt  $OUT_DIR/input_file_list.txt >  $OUT_DIR/merge_lanes.py.log 2>&1 
+   $OUT_DIR/merge_lanes.py -t generate_merge_non_redundant_commands -M $OUT_DIR/merged_fasta -O $OUT_DIR/merge_lanes_commands.txt  $OUT_DIR/input_file_list.txt >  $OUT_DIR/merge_lanes.py.log 2>&1 
    # the script that will be launched to launch those
+   get_launcher merge_lanes $OUT_DIR/merged_fasta $OUT_DIR/merge_lanes_commands.txt
 echo "#!/bin/bash
 export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
 export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
 
 cd $OUT_DIR
 mkdir -p merged_fasta
-tardis --hpctype $HPC_TYPE  -c 1 -d $OUT_DIR/merged_fasta source _condition_text_input_$OUT_DIR/merge_lanes_commands.txt  > $OUT_DIR/merge_lanes_commands.log 2>&1
+$launcher > $OUT_DIR/merge_lanes_commands.log 2>&1
 if [ \$? != 0 ]; then
    echo \"warning fasta merge returned an error code\"
    exit 1
@@ -432,27 +723,193 @@ fi
    chmod +x $OUT_DIR/all.merge_lanes.sh
 
 
+   ################ dereplicate script
+   # builds a run-wide catalogue of the unique sequences in the (per-sample) non-redundant fasta files, so that 
+   # each sequence only needs to be blasted once. The catalogue (catalogue/catalogue.non-redundant.fasta) is blasted and 
+   # summarised in place of the samples, and the summarise step then rebuilds the per-sample summaries from the catalogue 
+   # summary, using the sample x sequence count table (catalogue/catalogue.counts.txt)
+echo "#!/bin/bash
+export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
+export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
+
+cd $OUT_DIR
+mkdir -p catalogue
+python $OUT_DIR/global_dereplicate.py -t build_catalogue -O $OUT_DIR/catalogue \`cat $OUT_DIR/input_file_list.txt\` > $OUT_DIR/dereplicate.log 2>&1
+if [ \$? != 0 ]; then
+   echo \"warning dereplicate returned an error code\"
+   exit 1
+fi
+     " >  $OUT_DIR/all.dereplicate.sh
+   chmod +x $OUT_DIR/all.dereplicate.sh
+
+
    ################ blast script
    # blasts seqs
    if [ $HPC_TYPE == "local" ]; then
       NUM_THREADS=2
    fi
+   # with a tag index (-X), the sequences which exactly match a reference restriction tag are assigned from the index (written to 
+   # tag_index_assignments/ , and added to the summaries by the summarise step), and only the rest (written to tag_index_misses/ , with 
+   # the same names as the inputs) are blasted, or looked up in the blast cache - see tag_lookup.py
+   # Only the inputs which are not already current in the stage manifest (i.e. whose content, the search parameters, database and 
+   # tag index are unchanged since they were blasted, and whose results are still there) are blasted - these are listed in blast_file_list.txt, 
+   # and recorded in the manifest when the blast succeeds
+   # With -D, the inputs are first rarefied to the depth given (written to rarefied/ , with the same names as the inputs - see rarefy_fasta.py), 
+   # and the rarefied files are looked up in the tag index and blasted, in place of the inputs 
+   rm -f $OUT_DIR/blast_units.txt
+   touch $OUT_DIR/blast_units.txt
+   for file in `cat $OUT_DIR/input_file_list.txt`; do
+      printf "%s\t%s\n" "$file" "$OUT_DIR/blast/`basename $file`.*.results.gz" >> $OUT_DIR/blast_units.txt
+   done
+   blast_param_files_phrase=""
+   if [ ! -z "$tag_index" ]; then
+      blast_param_files_phrase="-P $tag_index"
+   fi
+   rarefy_params=""
+   if [ ! -z "$rarefy_depth" ]; then
+      rarefy_params="-rarefy_depth $rarefy_depth -rarefy_seed $rarefy_seed"
+   fi
+   filter_units $OUT_DIR/blast_units.txt $OUT_DIR/blast_file_list.txt blast -L --params="-task $blast_task -word_size $wordsize -evalue $similarity $blast_extra $rarefy_params" -P "${taxonomy_blast_database}.*" $blast_param_files_phrase
+   blast_files_check="
+if [ ! -s $OUT_DIR/blast_file_list.txt ]; then
+   echo \"all blast results are current (see $OUT_DIR/stage_manifest.jsonl) - nothing to blast\"
+   exit 0
+fi
+"
+   blast_record_step="
+python $OUT_DIR/stage_manifest.py -t record -m $OUT_DIR/stage_manifest.jsonl -s blast >> $OUT_DIR/blast_units.log 2>&1
+"
+   blast_input_list=$OUT_DIR/blast_file_list.txt
+   rarefy_step=""
+   if [ ! -z "$rarefy_depth" ]; then
+      blast_input_list=$OUT_DIR/rarefied_file_list.txt
+      rarefy_step="
+mkdir -p rarefied
+python $OUT_DIR/rarefy_fasta.py -d $rarefy_depth -s $rarefy_seed -O $OUT_DIR/rarefied -F $OUT_DIR/rarefied/rarefaction_fractions.txt \`cat $OUT_DIR/blast_file_list.txt\` > $OUT_DIR/rarefy.log 2>&1
+if [ \$? != 0 ]; then
+   echo \"warning rarefy returned an error code\"
+   exit 1
+fi
+cat $OUT_DIR/blast_file_list.txt | xargs -n 1 basename | awk '{printf(\"$OUT_DIR/rarefied/%s\\n\", \$1);}' - > $OUT_DIR/rarefied_file_list.txt
+"
+   fi
+   blast_input_files="\`cat $blast_input_list\`"
+   tag_index_step=""
+   if [ ! -z "$tag_index" ]; then
+      blast_input_files="\`cat $OUT_DIR/tag_index_misses.txt\`"
+      # (the assignments of the inputs which are not being blasted again are kept, for the summarise step)
+      # Inputs whose sequences were all assigned from the index are not blasted - they are given empty results (named as 
+      # align_prism names them), so that they are still summarised, with their tag assignments
+      get_local_blast_command '$misses_file' $OUT_DIR/blast
+      tag_index_step="
+mkdir -p blast tag_index_misses tag_index_assignments
+python $OUT_DIR/tag_lookup.py -t classify -X $tag_index -O $OUT_DIR/tag_index_misses -A $OUT_DIR/tag_index_assignments \`cat $blast_input_list\` > $OUT_DIR/tag_lookup.log 2>&1
+if [ \$? != 0 ]; then
+   echo \"warning tag lookup returned an error code\"
+   exit 1
+fi
+cat $OUT_DIR/tag_lookup.log
+rm -f $OUT_DIR/tag_index_misses.txt
+touch $OUT_DIR/tag_index_misses.txt
+for misses_file in \`cat $OUT_DIR/blast_file_list.txt | xargs -n 1 basename | awk '{printf(\"$OUT_DIR/tag_index_misses/%s\\n\", \$1);}' -\`; do
+   if [ -s \$misses_file ]; then
+      echo \$misses_file >> $OUT_DIR/tag_index_misses.txt
+   else
+      rm -f $OUT_DIR/blast/\`basename \$misses_file\`.*.results.gz
+      touch $results
+      gzip -f $results
+   fi
+done
+if [ ! -s $OUT_DIR/tag_index_misses.txt ]; then
+   echo \"all sequences were assigned from the tag index - nothing to blast\"
+   $blast_record_step
+   exit 0
+fi
+"
+   fi
+   get_blast_step "$blast_input_files" $OUT_DIR/blast
 echo "#!/bin/bash
 export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
 export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
 
 cd $OUT_DIR
+$blast_files_check
+$rarefy_step
+$tag_index_step
 mkdir -p blast
 cp $OUT_DIR/tardis.toml.blast blast/tardis.toml
 cd blast
 rm -f $OUT_DIR/blast/*.fasta # remove any existing shortcuts set up by align_prism (e.g. if restarting)  
-$SEQ_PRISMS_BIN/align_prism.sh $dry_run_phrase -C $HPC_TYPE -j 8 -B 4 -m 80 -f -a blastn -e $OUT_DIR/blast_env.inc -r $taxonomy_blast_database -p \"-num_threads 8 -task $blast_task -word_size $wordsize -outfmt \\'6 std qlen \\' -evalue $similarity $blast_extra \"  -O $OUT_DIR/blast \`cat $OUT_DIR/input_file_list.txt\` > $OUT_DIR/blast.log 2>&1 
+$blast_step
 
 if [ \$? != 0 ]; then
    echo \"warning blast returned an error code\"
    exit 1
 fi
+$blast_record_step
+     " >  $OUT_DIR/all.blast.sh
+
+   if [ ! -z "$blast_cache" ]; then
+      # only blast the sequences which are not in the cache (written to blast_cache_misses/ by the lookup), then add the new 
+      # results to the cache and write the full results for each input to blast/ . The cache is keyed by the search parameters (other than 
+      # the number of threads), and the version of the blast database. With a python taxonomiser, the LCA assignments are cached too, 
+      # and written to blast/ for the summarise step (summarize_counts.py -A). If another run sharing the cache evicts sequences between 
+      # the lookup and the update (update exits with status 3), the lookup, blast and update are run again 
+      blast_cache_params="-task $blast_task -word_size $wordsize -outfmt '6 std qlen' -evalue $similarity $blast_extra"
+      blast_cache_lca=""
+      if [[ $taxonomiser == *.py ]]; then
+         blast_cache_lca="-T default"
+         if [ -f ${taxonomy_blast_database}.duplicates.txt ]; then
+            blast_cache_lca="$blast_cache_lca -d ${taxonomy_blast_database}.duplicates.txt"
+         fi
+      fi
+      get_blast_step "\$misses" $OUT_DIR/blast_cache_misses_results
+echo "#!/bin/bash
+export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
+export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
+
+cd $OUT_DIR
+$blast_files_check
+$rarefy_step
+$tag_index_step
+mkdir -p blast blast_cache_misses blast_cache_misses_results
+rm -f $OUT_DIR/blast_cache.log
+for attempt in 1 2 3; do
+   rm -f $OUT_DIR/blast_cache_misses/*.fasta $OUT_DIR/blast_cache_misses_results/*.fasta $OUT_DIR/blast_cache_misses_results/*.results.gz
+   python $OUT_DIR/blast_cache.py -t lookup -c $blast_cache -b $taxonomy_blast_database --blast_params=\"$blast_cache_params\" -O $OUT_DIR/blast_cache_misses $blast_input_files >> $OUT_DIR/blast_cache.log 2>&1
+   if [ \$? != 0 ]; then
+      echo \"warning blast cache lookup returned an error code\"
+      exit 1
+   fi
+
+   # (align_prism is only run if there is something to blast)
+   misses=\`find $OUT_DIR/blast_cache_misses -name \"*.fasta\" -size +0\`
+   if [ ! -z \"\$misses\" ]; then
+      cp $OUT_DIR/tardis.toml.blast blast_cache_misses_results/tardis.toml
+      cd blast_cache_misses_results
+      $blast_step
+      if [ \$? != 0 ]; then
+         echo \"warning blast returned an error code\"
+         exit 1
+      fi
+      cd $OUT_DIR
+   fi
+
+   python $OUT_DIR/blast_cache.py -t update -c $blast_cache -b $taxonomy_blast_database --blast_params=\"$blast_cache_params\" $blast_cache_lca -M $OUT_DIR/blast_cache_misses -R $OUT_DIR/blast_cache_misses_results -O $OUT_DIR/blast $blast_input_files >> $OUT_DIR/blast_cache.log 2>&1
+   update_status=\$?
+   if [ \$update_status != 3 ]; then
+      break
+   fi
+   echo \"cached sequences were evicted by another run before they were used - looking up and blasting again\"
+done
+if [ \$update_status != 0 ]; then
+   echo \"warning blast cache update returned an error code\"
+   exit 1
+fi
+cat $OUT_DIR/blast_cache.log
+$blast_record_step
      " >  $OUT_DIR/all.blast.sh
+   fi
    chmod +x $OUT_DIR/all.blast.sh
 
    ################ summarise script
@@ -460,23 +917,41 @@ fi
    # the summary  script will launch a command file that we also prepare here
    # generate command file:
    taxonomiser_base=`basename $taxonomiser`
-   rm -f $OUT_DIR/summary_commands.txt
-   touch $OUT_DIR/summary_commands.txt
-   # generate command file
+   summary_toml=tardis.toml.summary
+   if [[ $taxonomiser_base == *.py ]]; then
+      summary_toml=tardis.toml.summary_py
+   fi
+   rm -f $OUT_DIR/summary_units.txt
+   touch $OUT_DIR/summary_units.txt
+   # generate command file (of the samples which are not already current in the stage manifest)
    for file in `cat $OUT_DIR/input_file_list.txt`; do
-      base=`basename $file .results.gz`
-      echo "set -e; gunzip -c $file  > $OUT_DIR/summary/${base}.resultsNucl ; Rscript --vanilla $OUT_DIR/$taxonomiser_base $OUT_DIR/summary/${base}.resultsNucl 1>$OUT_DIR/summary/${base}.resultsNucl.stdout 2>$OUT_DIR/summary/${base}.resultsNucl.stderr; /usr/bin/rm -f $OUT_DIR/summary/${base}.resultsNucl" >> $OUT_DIR/summary_commands.txt
+      get_summary_command $file `basename $file .results.gz`
+      printf "%s\t%s\t%s\n" "$unit_inputs" "$OUT_DIR/summary/${base}.summary" "$command" >> $OUT_DIR/summary_units.txt
    done
+   summary_param_files_phrase="-P $taxonomiser"
+   if [[ ( $taxonomiser_base == *.py ) && ( ! -z "$taxonomy_blast_database" ) && ( -f ${taxonomy_blast_database}.duplicates.txt ) ]]; then
+      summary_param_files_phrase="$summary_param_files_phrase -P ${taxonomy_blast_database}.duplicates.txt"
+   fi
+   if [ ! -z "$tag_index" ]; then
+      summary_param_files_phrase="$summary_param_files_phrase -P $tag_index"
+   fi
+   filter_units $OUT_DIR/summary_units.txt $OUT_DIR/summary_commands.txt summarise $summary_param_files_phrase
+   pack_commands $OUT_DIR/summary_commands.txt summarise
 
    # the script that will be launched to launch those 
+   get_launcher summarise $OUT_DIR/summary $OUT_DIR/summary_commands.packed.txt $OUT_DIR/configure_summary_env.src /bin/sh
 echo "#!/bin/bash
 export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
 export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
 
 cd $OUT_DIR
 mkdir -p summary
-cp $OUT_DIR/tardis.toml.summary tardis.toml
-tardis --hpctype $HPC_TYPE -c 1 -d $OUT_DIR/summary  --shell-include-file $OUT_DIR/configure_summary_env.src /bin/sh _condition_text_input_$OUT_DIR/summary_commands.txt > $OUT_DIR/summary.log 2>&1
+cp $OUT_DIR/$summary_toml tardis.toml
+if [ ! -s $OUT_DIR/summary_commands.packed.txt ]; then
+   echo \"all summaries are current (see $OUT_DIR/stage_manifest.jsonl) - nothing to do\"
+   exit 0
+fi
+$launcher > $OUT_DIR/summary.log 2>&1
 if [ \$? != 0 ]; then
    echo \"warning summary returned an error code\"
    exit 1
@@ -485,15 +960,70 @@ fi
    chmod +x $OUT_DIR/all.summarise.sh
 
 
+   ################ stream script
+   # runs trim, format, blast and summarise for each sample on its own (given the demultiplexed fastq, as trim), so that each sample 
+   # goes on to its next stage as soon as its own previous stage is done, rather than each stage waiting for the slowest sample of the 
+   # previous stage - see sample_stream.py. The commands are the same as those of the stage scripts (but all the samples are run, 
+   # regardless of the stage manifest), each sample blasts in its own folder under stream/blast (as align_prism expects its output 
+   # folder to itself), and the summary command is bound to the blast results once they are there. all.trim, all.format, all.blast 
+   # and all.summarise are written as each stage is done for all the samples, as when the stages are run one at a time
+   rm -f $OUT_DIR/stream_units.txt
+   touch $OUT_DIR/stream_units.txt
+   while IFS=$'\t' read -r inputs outputs trim_command; do
+      trimmed=`echo $outputs | awk '{print $1}' -`
+      sample=`basename $trimmed .fastq`
+      printf "%s\ttrim\t\t%s\n" "$sample" "$trim_command" >> $OUT_DIR/stream_units.txt
+      get_format_command $trimmed
+      printf "%s\tformat\t\t%s\n" "$sample" "$command" >> $OUT_DIR/stream_units.txt
+      fasta=$format_output
+      if [ $HPC_TYPE == "local" ]; then
+         get_local_blast_command $fasta $OUT_DIR/blast
+      else
+         command="set -e; mkdir -p $OUT_DIR/stream/blast/$sample; cd $OUT_DIR/stream/blast/$sample; cp $OUT_DIR/tardis.toml.blast tardis.toml; rm -f $OUT_DIR/stream/blast/$sample/*.fasta; $SEQ_PRISMS_BIN/align_prism.sh -C $HPC_TYPE -j 8 -B 4 -m 80 -f -a blastn -e $OUT_DIR/blast_env.inc -r $taxonomy_blast_database -p \"-num_threads 8 -task $blast_task -word_size $wordsize -outfmt \\'6 std qlen \\' -evalue $similarity $blast_extra \" -O $OUT_DIR/stream/blast/$sample $fasta > $OUT_DIR/stream/blast/$sample/blast.log 2>&1; mv $OUT_DIR/stream/blast/$sample/*.results.gz $OUT_DIR/blast"
+      fi
+      printf "%s\tblast\t\t%s\n" "$sample" "$command" >> $OUT_DIR/stream_units.txt
+      get_summary_command "{results}" "{results_base}"
+      printf "%s\tsummarise\tresults=%s\t%s\n" "$sample" "$OUT_DIR/blast/`basename $fasta`.*.results.gz" "$command" >> $OUT_DIR/stream_units.txt
+   done < $OUT_DIR/trim_units.txt
+   get_launcher trim $OUT_DIR/trimming {command_file} $OUT_DIR/configure_cutadapt_env.src
+   trim_launcher=$launcher
+   get_launcher format $OUT_DIR/fasta {command_file}
+   format_launcher=$launcher
+   get_launcher blast $OUT_DIR/blast {command_file} $OUT_DIR/blast_env.inc /bin/sh
+   blast_launcher="/bin/sh {command_file}"
+   if [ $HPC_TYPE == "local" ]; then
+      blast_launcher="$launcher"      # (else align_prism runs blast with tardis)
+   fi
+   get_launcher summarise $OUT_DIR/summary {command_file} $OUT_DIR/configure_summary_env.src /bin/sh
+   summary_launcher="cd $OUT_DIR/summary; $launcher"
+echo "#!/bin/bash
+export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
+export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
+
+cd $OUT_DIR
+mkdir -p trimming fasta blast summary stream stream/blast
+cp $OUT_DIR/$summary_toml summary/tardis.toml
+python $OUT_DIR/sample_stream.py -j $stream_jobs -W $OUT_DIR/stream -l \"trim=$trim_launcher\" -l \"format=$format_launcher\" -l \"blast=$blast_launcher\" -l \"summarise=$summary_launcher\" -M trim=$OUT_DIR/all.trim -M format=$OUT_DIR/all.format -M blast=$OUT_DIR/all.blast -M summarise=$OUT_DIR/all.summarise $OUT_DIR/stream_units.txt > $OUT_DIR/stream.log 2>&1
+if [ \$? != 0 ]; then
+   echo \"warning stream returned an error code\"
+   exit 1
+fi
+     " >  $OUT_DIR/all.stream.sh
+   chmod +x $OUT_DIR/all.stream.sh
+
+
    ################ kmer_analysis script
-   # summaries kmer distribution
+   # summaries kmer distribution - canonical 6-mer profiles of all the samples (weighted by tag count), joined into a single 
+   # k-mer x sample table (and .npz sample x k-mer matrix), and a sample x sample distance matrix, by kmer_profile.py. (This used 
+   # to run kmer_prism.sh on each file, with no cohort matrix). It is run through tardis, as the html step is, so that on slurm it
+   # runs on a compute node rather than the submit host
 echo "#!/bin/bash
 export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
 export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
 
 cd $OUT_DIR
 mkdir -p kmer_analysis
-$SEQ_PRISMS_BIN/kmer_prism.sh $dry_run_phrase -C $HPC_TYPE -a fasta -p \"-k 6 -A --weighting_method tag_count\" -O $OUT_DIR/kmer_analysis \`cat $OUT_DIR/input_file_list.txt\` > $OUT_DIR/kmer_analysis.log 2>&1  
+tardis --hpctype $HPC_TYPE python $OUT_DIR/kmer_profile.py -j $NUM_THREADS -k 6 --weighting_method tag_count --matrix_file $OUT_DIR/kmer_analysis/kmer_matrix.npz -D $OUT_DIR/kmer_analysis/kmer_distances.txt -o $OUT_DIR/kmer_analysis/kmer_frequency_table.txt \`cat $OUT_DIR/input_file_list.txt\` \> $OUT_DIR/kmer_analysis.log 2\>$OUT_DIR/kmer_analysis.log  
 
 if [ \$? != 0 ]; then
    echo \"warning kmer_analysis returned an error code\"
@@ -505,15 +1035,21 @@ fi
 
    ################ html script
    # summaries of the summaries 
+   weighting_method=line
+   if [ $summary_format == "collapsed" ]; then
+      weighting_method=column     # weight is in the count column, rather than one record per read
+   fi
 echo "#!/bin/bash
 export SEQ_PRISMS_BIN=$SEQ_PRISMS_BIN
 export MELSEQ_PRISM_BIN=$MELSEQ_PRISM_BIN
 
 cd $OUT_DIR
 mkdir -p html 
-# summaries at genus and species level for the plots
-tardis --hpctype $HPC_TYPE $OUT_DIR/profile_prism.py --weighting_method line --columns 1,2,3,4,5,6,7 \`cat $OUT_DIR/input_file_list.txt\` \> $OUT_DIR/html.log 2\>$OUT_DIR/html.log
-tardis --hpctype $HPC_TYPE $OUT_DIR/profile_prism.py --summary_type summary_table --measure frequency \`cat $OUT_DIR/input_file_list.txt | awk '{printf(\"%s.taxonomy.pickle\\n\", \$1);}' -\` \> $OUT_DIR/html/taxonomy_frequency_table.txt 2\>\>$OUT_DIR/html.log
+# distributions at species level (for the plots) and genus level (for the tabular output) - each summary is read once, 
+# and the distributions at both ranks are built from that. The summary tables are made from the columnar distributions (with
+# ids from the lineage dictionary summary/taxonomy_lineages.txt), the pickles are kept for other uses 
+tardis --hpctype $HPC_TYPE $OUT_DIR/profile_prism.py --summary_type rank_summaries --ranks species,genus --weighting_method $weighting_method --distribution_format both \`cat $OUT_DIR/input_file_list.txt\` \> $OUT_DIR/html.log 2\>$OUT_DIR/html.log
+tardis --hpctype $HPC_TYPE $OUT_DIR/profile_prism.py --summary_type summary_table --measure frequency \`cat $OUT_DIR/input_file_list.txt | awk '{printf(\"%s.taxonomy_species.npy\\n\", \$1);}' -\` \> $OUT_DIR/html/taxonomy_frequency_table.txt 2\>\>$OUT_DIR/html.log
 
 # make a version with readable headings
 # e.g. SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.num_threads4taskblastnword_size16outfmt6stdqlen
@@ -522,16 +1058,18 @@ cat $OUT_DIR/html/taxonomy_frequency_table.txt | python $MELSEQ_PRISM_BIN/edit_s
 #plot
 tardis --hpctype $HPC_TYPE --shell-include-file $OUT_DIR/configure_bioconductor_env.src Rscript --vanilla $OUT_DIR/tax_summary_heatmap.r num_profiles=60 moniker=taxonomy_frequency_table_plot datafolder=$OUT_DIR/html \>\> $OUT_DIR/html.log 2\>$OUT_DIR/html.log  
 # 
-# now do summaries just at genus level for the tabular output - i.e. just repeat above , but pass in the 
-# non-default column(s) you want summarised. (Note that the column numbering is zero based )
+# now do summaries just at genus level for the tabular output - i.e. just repeat above , but using the 
+# genus level distributions
 
-tardis --hpctype $HPC_TYPE $OUT_DIR/profile_prism.py --weighting_method line --columns 1,2,3,4,5,6  \`cat $OUT_DIR/input_file_list.txt\` \>\> $OUT_DIR/html.log 2\>$OUT_DIR/html.log
-tardis --hpctype $HPC_TYPE $OUT_DIR/profile_prism.py --summary_type summary_table --measure frequency \`cat $OUT_DIR/input_file_list.txt | awk '{printf(\"%s.taxonomy.pickle\\n\", \$1);}' -\` \> $OUT_DIR/html/taxonomy_genus_frequency_table.txt 2\>\>$OUT_DIR/html.log
+tardis --hpctype $HPC_TYPE $OUT_DIR/profile_prism.py --summary_type summary_table --measure frequency \`cat $OUT_DIR/input_file_list.txt | awk '{printf(\"%s.taxonomy_genus.npy\\n\", \$1);}' -\` \> $OUT_DIR/html/taxonomy_genus_frequency_table.txt 2\>\>$OUT_DIR/html.log
 
 # make a version with readable headings
 # e.g. SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.num_threads4taskblastnword_size16outfmt6stdqlen
 #evalue0.02.summary.taxonomy.pickle to 966045_CAACTGACTG_psti
 cat $OUT_DIR/html/taxonomy_genus_frequency_table.txt | python $MELSEQ_PRISM_BIN/edit_summary_column_headings.py > $OUT_DIR/html/taxonomy_genus_frequency_table_plot.txt
+# alpha diversity of each sample, and bray-curtis and jaccard distances between all the samples (the plots only show the first num_profiles samples)
+mkdir -p html/diversity
+tardis --hpctype $HPC_TYPE $OUT_DIR/cohort_diversity.py -j 8 -O $OUT_DIR/html/diversity $OUT_DIR/html/taxonomy_genus_frequency_table_plot.txt \>\> $OUT_DIR/html.log 2\>\>$OUT_DIR/html.log
 #plot
 tardis --hpctype $HPC_TYPE --shell-include-file $OUT_DIR/configure_bioconductor_env.src Rscript --vanilla $OUT_DIR/tax_summary_heatmap.r num_profiles=70 moniker=taxonomy_genus_frequency_table_plot datafolder=$OUT_DIR/html \>\> $OUT_DIR/html.log 2\>$OUT_DIR/html.log 
 
@@ -561,6 +1099,12 @@ function run_prism() {
       NUM_THREADS=2
    fi
    make -f melseq_prism.mk -d -k  --no-builtin-rules -j $NUM_THREADS `cat $OUT_DIR/${ANALYSIS}_targets.txt` > $OUT_DIR/${ANALYSIS}.log 2>&1
+   make_status=$?
+   # summarise the performance metrics of the stages run so far 
+   if [ -f $OUT_DIR/stage_metrics.jsonl ]; then
+      $OUT_DIR/stage_metrics.py -t report $OUT_DIR/stage_metrics.jsonl > $OUT_DIR/stage_metrics_report.txt 2>&1
+   fi
+   return $make_status
 }
 
 function clean() {
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import glob
+import gzip
+import time
+import sqlite3
+import argparse
+import numpy
+
+#
+# local warehouse of the taxonomy profiles of finished runs, so that questions across runs (e.g. the abundance of
+# Methanobrevibacter in all the samples of a cohort, over all its runs) can be answered without going back to the
+# summaries, pickles or tables of each run.
+#
+# The warehouse is a sqlite database, with one row per run, one row per profile (run, sample, rank - with the total
+# count of the profile), one row per lineage (e.g. Archaea;Euryarchaeota;...;Methanobrevibacter - with NA patched to
+# taxNA, as in the profile_prism.py tables), and one row per (profile, lineage) count, indexed by lineage so that
+# queries for a taxon do not scan the whole warehouse.
+#
+# ingest loads the profiles of each run folder given, at each rank, from the first of these that the run has :
+#
+# * the columnar distributions (summary/*.taxonomy_<rank>.npy and summary/taxonomy_lineages.txt, see profile_prism.py
+#   --distribution_format)
+# * the summaries (summary/*.summary, expanded or collapsed), aggregated at each rank as by profile_prism.py
+#   --summary_type rank_summaries (each summary is read once for all the ranks)
+# * the data_prism distributions (summary/*.taxonomy_<rank>.pickle, or the summary/*.taxonomy.pickle of older runs,
+#   whose rank is given by the depth of their lineages) - if data_prism can be imported
+# * the summary table of the html step (html/taxonomy_frequency_table.txt for species, html/taxonomy_genus_frequency_table.txt
+#   for genus). Despite the name, these hold the raw bin weights (profile_prism.py --measure frequency writes the raw
+#   projection of each distribution), i.e. counts. A table column which is instead normalised (non-integer values
+#   totalling about 1.0) is detected from its values, and its profile recorded with measure frequency
+#
+# Re-ingesting a run replaces its profiles at that rank. The sample moniker is parsed from the file name, as by
+# edit_summary_column_headings.py (e.g.
+# SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn... => 966045_CAACTGACTG_psti)
+#
+# query writes a taxon x sample table (as profile_prism.py summary_table, with a column per run/sample), or a long
+# table of run, sample, rank, lineage, count and frequency, of the profiles and taxa selected. Counts are not
+# available for normalised profiles, so a count query which selects any of these is refused (they can be queried
+# with --measure frequency)
+#
+
+DEFAULT_SAMPLE_MONIKER_REGEXP = "\.demultiplexed_([^\.]+)\.R1_trimmed"
+RANKS = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]   # summary columns 1-7
+RANK_TABLES = {"species" : "taxonomy_frequency_table.txt", "genus" : "taxonomy_genus_frequency_table.txt"}
+LINEAGE_FILE = "taxonomy_lineages.txt"
+CATALOGUE_FASTA = "catalogue.non-redundant.fasta"       # (the summary of a run-wide catalogue is not a sample - see global_dereplicate.py)
+DATA_PRISM_FOLDER = "/dataset/gseq_processing/active/bin/melseq_prism/seq_prisms"    # as profile_prism.py
+NORMALISED_TOLERANCE = 0.01        # a table column of non-integer values whose total is within this of 1.0 is taken to be normalised
+
+
+class melseq_warehouse_exception(Exception):
+    def __init__(self,args=None):
+        super(melseq_warehouse_exception, self).__init__(args)
+
+
+def open_warehouse(warehouse_file):
+    connection = sqlite3.connect(warehouse_file, timeout=600)
+    connection.execute("create table if not exists runs (run_id integer primary key, run text unique, folder text, ingested real)")
+    connection.execute("create table if not exists profiles (profile_id integer primary key, run_id integer, sample text, rank text, source text, total integer, unique(run_id, sample, rank))")
+    connection.execute("create table if not exists lineages (lineage_id integer primary key, lineage text unique)")
+    connection.execute("create table if not exists counts (profile_id integer, lineage_id integer, count integer, primary key(profile_id, lineage_id)) without rowid")
+    connection.execute("create index if not exists counts_lineage on counts (lineage_id)")
+    connection.execute("create index if not exists profiles_rank on profiles (rank, run_id)")
+    if "measure" not in [row[1] for row in connection.execute("pragma table_info(profiles)")]:
+        # count, or frequency (normalised profiles - see get_profile_measure)
+        connection.execute("alter table profiles add column measure text not null default 'count'")
+        connection.commit()
+    # (an earlier version flagged every profile ingested from the html tables as frequency - restore those which are
+    # not normalised to count)
+    with connection:
+        connection.execute("update profiles set measure = 'count' where measure = 'frequency' and abs(total - 1.0) > ?", (NORMALISED_TOLERANCE,))
+    return connection
+
+
+def parse_sample_moniker(name, sample_moniker_regexp):
+    match = re.search(sample_moniker_regexp, os.path.basename(name))
+    if match is None:
+        return os.path.basename(name)
+    return match.groups()[0]
+
+
+def get_lineage_name(lineage):
+    # note that we patch NA to taxNA , as NA confuses R (as profile_prism.py)
+    return re.sub("NA", "taxNA", ";".join(lineage))
+
+
+def get_prism_class():
+    """
+    the data_prism prism class (to load the .pickle distributions), or None if data_prism cannot be imported
+    """
+    if DATA_PRISM_FOLDER not in sys.path:
+        sys.path.append(DATA_PRISM_FOLDER)
+    try:
+        from data_prism import prism
+    except ImportError:
+        return None
+    return prism
+
+
+def get_summary_files(run_folder):
+    return [filename for filename in sorted(glob.glob(os.path.join(run_folder, "summary", "*.summary")))
+            if not os.path.basename(filename).startswith(CATALOGUE_FASTA)]
+
+
+def get_pickle_files(run_folder, rank, prism_class):
+    """
+    the data_prism distributions of a run at a rank - summary/*.taxonomy_<rank>.pickle, or else summary/*.taxonomy.pickle
+    if its lineages (those of the first file) are of the rank
+    """
+    pickle_files = sorted(glob.glob(os.path.join(run_folder, "summary", "*.taxonomy_%s.pickle" % rank)))
+    if len(pickle_files) > 0:
+        return pickle_files
+    pickle_files = sorted(glob.glob(os.path.join(run_folder, "summary", "*.taxonomy.pickle")))
+    if len(pickle_files) > 0 and get_profile_rank(read_pickle_profile(pickle_files[0], prism_class)) == rank:
+        return pickle_files
+    return []
+
+
+def get_profile_rank(profile):
+    for lineage in profile:
+        return RANKS[min(len(RANKS), len(lineage.split(";"))) - 1]
+    return None
+
+
+def read_pickle_profile(pickle_file, prism_class):
+    distob = prism_class.load(pickle_file)
+    return dict((tax_bin[0], weight) for (tax_bin, weight) in distob.get_spectrum().items())
+
+
+def read_columnar_profiles(run_folder, rank):
+    """
+    yields (source file, {lineage : count}) from the columnar distributions of a run at a rank (if any)
+    """
+    distribution_files = sorted(glob.glob(os.path.join(run_folder, "summary", "*.taxonomy_%s.npy" % rank)))
+    if len(distribution_files) == 0:
+        return
+    with open(os.path.join(run_folder, "summary", LINEAGE_FILE), "r") as lineage_stream:
+        lineages = [record.rstrip("\r\n") for record in lineage_stream]
+    for distribution_file in distribution_files:
+        distribution = numpy.load(distribution_file, mmap_mode="r")
+        yield (distribution_file, dict((lineages[lineage_id], count) for (lineage_id, count) in zip(distribution[0].tolist(), distribution[1].tolist())))
+
+
+def read_summary_profiles(run_folder, ranks):
+    """
+    yields (summary file, {rank : {lineage : count}}) from the summaries of a run. Each summary is read once, and the
+    count of each lineage (the number of records of an expanded summary, or the sum of the count column of a collapsed
+    one) is aggregated at each rank, as by profile_prism.py read_aggregated_summary and get_rank_weights
+    """
+    for summary_file in get_summary_files(run_folder):
+        lineage_counts = {}
+        if summary_file.endswith(".gz"):
+            summary_stream = gzip.open(summary_file, "rt") if sys.version_info[0] >= 3 else gzip.open(summary_file, "r")
+        else:
+            summary_stream = open(summary_file, "r")
+        with summary_stream:
+            for record in summary_stream:
+                fields = record.rstrip("\r\n").split("\t")
+                if len(fields) < 1 + len(RANKS):
+                    continue
+                count = int(fields[1 + len(RANKS)]) if len(fields) > 1 + len(RANKS) else 1
+                lineage = tuple(fields[1:1 + len(RANKS)])
+                lineage_counts[lineage] = lineage_counts.get(lineage, 0) + count
+
+        rank_profiles = {}
+        for rank in ranks:
+            depth = RANKS.index(rank) + 1
+            profile = {}
+            for (lineage, count) in lineage_counts.items():
+                name = get_lineage_name(lineage[0:depth])
+                profile[name] = profile.get(name, 0) + count
+            rank_profiles[rank] = profile
+        yield (summary_file, rank_profiles)
+
+
+def read_table_profiles(table_file):
+    """
+    yields (column heading, {lineage : count}) from a profile_prism.py summary table (a row per taxon, a column per sample)
+    """
+    with open(table_file, "r") as table_stream:
+        header = table_stream.readline().rstrip("\r\n").split("\t")
+        profiles = [{} for heading in header[1:]]
+        for record in table_stream:
+            fields = record.rstrip("\r\n").split("\t")
+            if len(fields) != len(header):
+                continue
+            for (profile, value) in zip(profiles, fields[1:]):
+                count = float(value)
+                if count != 0:
+                    profile[fields[0]] = int(count) if count == int(count) else count
+    for (heading, profile) in zip(header[1:], profiles):
+        yield (heading, profile)
+
+
+def get_profile_measure(profile):
+    """
+    frequency if a profile is normalised - i.e. it has non-integer values, totalling about 1.0 - else count
+    """
+    if any(value != int(value) for value in profile.values()) and abs(sum(profile.values()) - 1.0) <= NORMALISED_TOLERANCE:
+        return "frequency"
+    return "count"
+
+
+def get_run_source(run_folder, rank, prism_class):
+    """
+    source of the profiles of a run at a rank - one of columnar, summaries, pickles or the table file (or None if the
+    run has none of these)
+    """
+    if len(glob.glob(os.path.join(run_folder, "summary", "*.taxonomy_%s.npy" % rank))) > 0:
+        return "columnar"
+    if len(get_summary_files(run_folder)) > 0:
+        return "summaries"
+    if prism_class is not None and len(get_pickle_files(run_folder, rank, prism_class)) > 0:
+        return "pickles"
+    if len(glob.glob(os.path.join(run_folder, "summary", "*.taxonomy*.pickle"))) > 0 and prism_class is None:
+        print("warning - %s has data_prism distributions, but data_prism could not be imported (from %s)" % (run_folder, DATA_PRISM_FOLDER), file=sys.stderr)
+    if rank in RANK_TABLES and os.path.isfile(os.path.join(run_folder, "html", RANK_TABLES[rank])):
+        return os.path.join(run_folder, "html", RANK_TABLES[rank])
+    return None
+
+
+def run_profile_iter(run_folder, sources, prism_class):
+    """
+    yields (rank, source, name, {lineage : count}) for each profile of a run, from the source of each rank (the
+    summaries are read once, for all the ranks they are the source of)
+    """
+    summary_ranks = [rank for (rank, source) in sorted(sources.items()) if source == "summaries"]
+    for (rank, source) in sorted(sources.items()):
+        if source == "columnar":
+            for (name, profile) in read_columnar_profiles(run_folder, rank):
+                yield (rank, name, name, profile)
+        elif source == "pickles":
+            for pickle_file in get_pickle_files(run_folder, rank, prism_class):
+                yield (rank, pickle_file, pickle_file, read_pickle_profile(pickle_file, prism_class))
+        elif source != "summaries":
+            for (name, profile) in read_table_profiles(source):
+                yield (rank, source, name, profile)
+    if len(summary_ranks) > 0:
+        for (summary_file, rank_profiles) in read_summary_profiles(run_folder, summary_ranks):
+            for rank in summary_ranks:
+                yield (rank, summary_file, summary_file, rank_profiles[rank])
+
+
+def get_lineage_ids(connection, lineages, lineage_ids):
+    """
+    fill in lineage_ids (a cache of lineage => id) for the lineages, adding new lineages to the warehouse
+    """
+    new_lineages = [lineage for lineage in lineages if lineage not in lineage_ids]
+    if len(new_lineages) == 0:
+        return
+    connection.executemany("insert or ignore into lineages (lineage) values (?)", [(lineage,) for lineage in new_lineages])
+    for lineage in new_lineages:
+        (lineage_ids[lineage],) = connection.execute("select lineage_id from lineages where lineage = ?", (lineage,)).fetchone()
+
+
+def ingest(options):
+    connection = open_warehouse(options["warehouse_file"])
+    prism_class = get_prism_class()
+    lineage_ids = {}
+    for run_folder in options["filenames"]:
+        run = options["run"] or os.path.basename(os.path.normpath(run_folder))
+        with connection:
+            connection.execute("insert or ignore into runs (run, folder) values (?, ?)", (run, os.path.abspath(run_folder)))
+            connection.execute("update runs set folder = ?, ingested = ? where run = ?", (os.path.abspath(run_folder), time.time(), run))
+            (run_id,) = connection.execute("select run_id from runs where run = ?", (run,)).fetchone()
+
+            sources = {}
+            for rank in options["ranks"]:
+                source = get_run_source(run_folder, rank, prism_class)
+                if source is None:
+                    print("%s : no %s profiles found in %s" % (run, rank, run_folder), file=sys.stderr)
+                    continue
+                sources[rank] = source
+
+                # replace any profiles of the run at this rank
+                old_profiles = [row[0] for row in connection.execute("select profile_id from profiles where run_id = ? and rank = ?", (run_id, rank))]
+                connection.executemany("delete from counts where profile_id = ?", [(profile_id,) for profile_id in old_profiles])
+                connection.execute("delete from profiles where run_id = ? and rank = ?", (run_id, rank))
+
+            (profile_counts, count_counts, normalised_counts) = (dict((rank, 0) for rank in sources), dict((rank, 0) for rank in sources), dict((rank, 0) for rank in sources))
+            for (rank, source, name, profile) in run_profile_iter(run_folder, sources, prism_class):
+                sample = parse_sample_moniker(name, options["sample_moniker_regexp"])
+                # (only a table can hold normalised profiles - the other sources are always counts)
+                measure = "count"
+                if source not in ("columnar", "summaries", "pickles"):
+                    measure = get_profile_measure(profile)
+                cursor = connection.execute("insert into profiles (run_id, sample, rank, source, total, measure) values (?, ?, ?, ?, ?, ?)",
+                                            (run_id, sample, rank, source, sum(profile.values()), measure))
+                profile_id = cursor.lastrowid
+                get_lineage_ids(connection, profile.keys(), lineage_ids)
+                connection.executemany("insert into counts (profile_id, lineage_id, count) values (?, ?, ?)",
+                                       [(profile_id, lineage_ids[lineage], count) for (lineage, count) in profile.items()])
+                profile_counts[rank] += 1
+                count_counts[rank] += len(profile)
+                if measure == "frequency":
+                    normalised_counts[rank] += 1
+            for (rank, source) in sorted(sources.items()):
+                print("%s : ingested %d %s profiles (%d values) from %s" % (run, profile_counts[rank], rank, count_counts[rank],
+                      source if source not in ("columnar", "summaries", "pickles") else "%s in %s" % (source, os.path.join(run_folder, "summary"))), file=sys.stderr)
+                if normalised_counts[rank] > 0:
+                    print("warning - %d of these profiles are normalised (their values total about 1.0), so have no counts - they can only be queried with --measure frequency" % normalised_counts[rank], file=sys.stderr)
+    connection.close()
+
+
+def query(options):
+    connection = open_warehouse(options["warehouse_file"])
+    connection.create_function("regexp", 2, lambda pattern, value: re.search(pattern, value) is not None)
+
+    conditions = ["p.rank = ?"]
+    parameters = [options["rank"]]
+    if options["runs"] is not None:
+        conditions.append("r.run in (%s)" % ",".join("?" * len(options["runs"])))
+        parameters += options["runs"]
+    if options["sample_regexp"] is not None:
+        conditions.append("p.sample regexp ?")
+        parameters.append(options["sample_regexp"])
+    profiles = connection.execute("select p.profile_id, r.run, p.sample, p.total from profiles p join runs r on p.run_id = r.run_id where %s order by r.run, p.sample" % " and ".join(conditions), parameters).fetchall()
+    if options["measure"] == "count":
+        frequency_runs = [row[0] for row in connection.execute("select distinct r.run from profiles p join runs r on p.run_id = r.run_id where %s and p.measure = 'frequency' order by r.run" % " and ".join(conditions), parameters)]
+        if len(frequency_runs) > 0:
+            connection.close()
+            raise melseq_warehouse_exception("some %s profiles of %s are normalised (their values total about 1.0), so have no counts - query with --measure frequency, or select other runs"
+                                             % (options["rank"], ", ".join(frequency_runs)))
+    profile_index = dict((profile_id, i) for (i, (profile_id, run, sample, total)) in enumerate(profiles))
+
+    # counts of the selected taxa (found via the lineage index) in the selected profiles
+    if options["taxa"] is not None:
+        conditions.append("(%s)" % " or ".join(["l.lineage like ?"] * len(options["taxa"])))
+        parameters += ["%%%s%%" % taxon for taxon in options["taxa"]]
+    counts = {}
+    lineages = set()
+    for (profile_id, lineage, count) in connection.execute("select c.profile_id, l.lineage, c.count from counts c join lineages l on c.lineage_id = l.lineage_id join profiles p on c.profile_id = p.profile_id join runs r on p.run_id = r.run_id where %s" % " and ".join(conditions), parameters):
+        counts[(lineage, profile_index[profile_id])] = count
+        lineages.add(lineage)
+    connection.close()
+    lineages = sorted(lineages)
+
+    def get_value(lineage, i):
+        count = counts.get((lineage, i), 0)
+        if options["measure"] == "frequency":
+            return "%.6g" % (count / float(profiles[i][3])) if profiles[i][3] else "0"
+        return str(count)
+
+    if options["output_file"] is None:
+        out_stream = sys.stdout
+    else:
+        out_stream = open(options["output_file"], "w")
+    if options["format"] == "table":
+        print("\t".join(["taxonomy"] + ["%s/%s" % (run, sample) for (profile_id, run, sample, total) in profiles]), file=out_stream)
+        for lineage in lineages:
+            print("\t".join([lineage] + [get_value(lineage, i) for i in range(len(profiles))]), file=out_stream)
+    else:
+        print("\t".join(["run", "sample", "rank", "lineage", "count", "frequency"]), file=out_stream)
+        for (i, (profile_id, run, sample, total)) in enumerate(profiles):
+            for lineage in lineages:
+                if (lineage, i) in counts:
+                    count = counts[(lineage, i)]
+                    print("\t".join([run, sample, options["rank"], lineage, str(count), "%.6g" % (count / float(total)) if total else "0"]), file=out_stream)
+    if options["output_file"] is not None:
+        out_stream.close()
+    print("%d taxa x %d profiles" % (len(lineages), len(profiles)), file=sys.stderr)
+
+
+def stats(options):
+    connection = open_warehouse(options["warehouse_file"])
+    for (run, folder, rank, measure, profile_count) in connection.execute("select r.run, r.folder, p.rank, p.measure, count(*) from runs r join profiles p on p.run_id = r.run_id group by r.run, p.rank, p.measure order by r.run, p.rank"):
+        print("%s\t%s\t%s\t%d profiles (of %s)" % (run, folder, rank, profile_count, measure))
+    (lineage_count,) = connection.execute("select count(*) from lineages").fetchone()
+    (count_count,) = connection.execute("select count(*) from counts").fetchone()
+    print("%d lineages, %d counts" % (lineage_count, count_count))
+    connection.close()
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+local warehouse of the taxonomy profiles of finished runs, for queries across runs
+
+examples :
+
+# load the species and genus profiles of some runs
+./melseq_warehouse.py -t ingest -W /dataset/gseq_processing/scratch/melseq/warehouse.db /dataset/hiseq/scratch/postprocessing/melseq/SQ1917 /dataset/hiseq/scratch/postprocessing/melseq/SQ2004
+
+# Methanobrevibacter in all the samples of those runs, as frequencies
+./melseq_warehouse.py -t query -W /dataset/gseq_processing/scratch/melseq/warehouse.db -R genus --taxa Methanobrevibacter --measure frequency --runs SQ1917,SQ2004
+
+# all the genera of some samples, as a long table
+./melseq_warehouse.py -t query -W /dataset/gseq_processing/scratch/melseq/warehouse.db -R genus --sample_regexp "^9660" --format long -o cohort_genera.txt
+
+./melseq_warehouse.py -t stats -W /dataset/gseq_processing/scratch/melseq/warehouse.db
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames', type=str, nargs="*", help='run folders (ingest)')
+    parser.add_argument('-t', '--task', dest='task', type=str, default="query", choices=["ingest", "query", "stats"], help="what you want to do (default query)")
+    parser.add_argument('-W', '--warehouse_file', dest='warehouse_file', type=str, required=True, help='sqlite warehouse file (created if necessary)')
+    parser.add_argument('-r', '--run', dest='run', type=str, default=None, help='run name (ingest, of a single run folder - default the name of the folder)')
+    parser.add_argument('--ranks', dest='ranks', type=str, default="species,genus", help='comma separated ranks to ingest - any of %s (default species,genus)' % ",".join(RANKS))
+    parser.add_argument('--sample_moniker_regexp', dest='sample_moniker_regexp', type=str, default=DEFAULT_SAMPLE_MONIKER_REGEXP, help='regular expression to parse the sample moniker from the file name (ingest) (default is the whole name, if this does not match)')
+    parser.add_argument('-R', '--rank', dest='rank', type=str, default="genus", help='rank to query (default genus)')
+    parser.add_argument('--runs', dest='runs', type=str, default=None, help='comma separated runs to query (default all)')
+    parser.add_argument('--sample_regexp', dest='sample_regexp', type=str, default=None, help='regular expression the samples to query must match (default all)')
+    parser.add_argument('--taxa', dest='taxa', type=str, default=None, help='comma separated taxa to query - lineages containing any of these (default all)')
+    parser.add_argument('--measure', dest='measure', type=str, default="count", choices=["count", "frequency"], help='count, or frequency (the count as a fraction of the total of the profile) (query) (default count)')
+    parser.add_argument('--format', dest='format', type=str, default="table", choices=["table", "long"], help='taxon x sample table, or long table of run, sample, rank, lineage, count, frequency (query) (default table)')
+    parser.add_argument('-o', '--output_file', dest='output_file', type=str, default=None, help='file to write the query results to (default stdout)')
+
+    args = vars(parser.parse_args())
+
+    if args["task"] == "ingest":
+        if len(args["filenames"]) == 0:
+            raise melseq_warehouse_exception("ingest requires one or more run folders")
+        if args["run"] is not None and len(args["filenames"]) > 1:
+            raise melseq_warehouse_exception("a run name (-r) can only be given for a single run folder")
+        for folder in args["filenames"]:
+            if not os.path.isdir(folder):
+                raise melseq_warehouse_exception("%s is not a folder" % folder)
+    else:
+        if not os.path.isfile(args["warehouse_file"]):
+            raise melseq_warehouse_exception("warehouse %s does not exist" % args["warehouse_file"])
+    args["ranks"] = [rank for rank in args["ranks"].split(",") if len(rank) > 0]
+    for rank in args["ranks"]:
+        if rank not in RANKS:
+            raise melseq_warehouse_exception("unknown rank %s - should be one of %s" % (rank, ",".join(RANKS)))
+    for option in ("runs", "taxa"):
+        if args[option] is not None:
+            args[option] = [item for item in args[option].split(",") if len(item) > 0]
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    if options["task"] == "ingest":
+        ingest(options)
+    elif options["task"] == "query":
+        query(options)
+    elif options["task"] == "stats":
+        stats(options)
+
+
+if __name__ == "__main__":
+   main()
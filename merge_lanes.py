@@ -7,6 +7,9 @@ import platform
 import sys
 import os
 import re 
+import heapq
+import itertools
+import seq_io
 
 
 class generate_commands_exception(Exception):
@@ -72,17 +75,79 @@ def generate_commands(options):
         for (sample, merge_file) in merge_dict:
             print("cat %s > %s"%(" ".join(merge_dict[(sample, merge_file)]),merge_file), file=command_file)
 
+def generate_merge_non_redundant_commands(options):
+
+    merge_dict = analyse_filenames(options)
+
+    with open(options["output_file"],"w") as command_file:
+        for (sample, merge_file) in merge_dict:
+            print("%s -t merge_non_redundant -O %s %s"%(os.path.realpath(__file__), merge_file, " ".join(merge_dict[(sample, merge_file)])), file=command_file)
+
+
+def non_redundant_fasta_iter(filename):
+    """
+    yield (sequence, count) from a non-redundant fasta file such as 
+
+>Sequence1_count=3
+AAAAAAAAAAGGTCTTCAGCAAAAAGCCGCTG
+>Sequence2_count=1
+AAAAAAAAAATCTGCAGCCTGCGCTTCAAACAGCTCCC
+
+    checking that it is sorted by sequence (as written by countUniqueReads.sh and dereplicate_fastq.py), as the merge relies on this
+    """
+    previous = None
+    with seq_io.open_input(filename) as fasta:
+        for (name, seq) in seq_io.fasta_iter(fasta):
+            match = re.search(b"count=(\\d+)", name)
+            if match is None:
+                raise generate_commands_exception("could not parse count from %s in %s"%(name.strip(), filename))
+            if previous is not None and seq <= previous:
+                raise generate_commands_exception("%s is not sorted by sequence (or is not non-redundant) - can't merge it"%filename)
+            previous = seq
+            yield (seq, int(match.groups()[0]))
+
+
+def merge_non_redundant(options):
+    """
+    k-way merge of the (sorted) non-redundant fasta files from different lanes for a sample, summing the counts
+    of identical sequences, and renumbering - so that the merged file is also non-redundant, and has
+    unique sequence names
+    """
+    merged = heapq.merge(*[non_redundant_fasta_iter(filename) for filename in options["input_fof"]])
+
+    temp_output = "%s.part"%options["output_file"]
+    number = 0
+    with open(temp_output, "wb") as out_stream:
+        for (seq, group) in itertools.groupby(merged, lambda item: item[0]):
+            number += 1
+            count = sum(item[1] for item in group)
+            out_stream.write(b">Sequence" + str(number).encode() + b"_count=" + str(count).encode() + b"\n" + seq + b"\n")
+    os.rename(temp_output, options["output_file"])
+    print("merged %d unique sequences from %s to %s"%(number, " ".join(options["input_fof"]), options["output_file"]), file=sys.stderr)
+
+
 def generate_merge_and_trim_commands(options):
 
     merge_dict = analyse_filenames(options)
 
+    units_file = None
+    if options["units_file"] is not None:
+        # (units of inputs <tab> outputs <tab> command, for stage_manifest.py)
+        units_file = open(options["units_file"], "w")
+
     with open(options["output_file"],"w") as command_file:
         for (sample, merge_file) in merge_dict:
             # figure out report file name and stderr filename from merge_file
             report_file=re.sub("R1_trimmed.fastq$","R1.trimReport",merge_file)
             stderr_file=re.sub("R1_trimmed.fastq$","R1.stderr", merge_file)
             #print("tardis --hpctype slurm  --shell-include-file \$MELSEQ_PRISM_BIN/cutadapt_env.inc    -c 999999999 gunzip -c %s \| cutadapt -q 20  -m 40 -o %s - 1\> %s 2\>%s"%(" ".join(merge_dict[(sample, merge_file)]),merge_file,report_file,stderr_file), file=command_file)
-            print("gunzip -c %s | cutadapt -q 20  -m 40 -o %s - 1> %s 2>%s"%(" ".join(merge_dict[(sample, merge_file)]),merge_file,report_file,stderr_file), file=command_file)
+            command = "gunzip -c %s | cutadapt -q 20  -m 40 -o %s - 1> %s 2>%s"%(" ".join(merge_dict[(sample, merge_file)]),merge_file,report_file,stderr_file)
+            print(command, file=command_file)
+            if units_file is not None:
+                print("%s\t%s %s\t%s"%(" ".join(merge_dict[(sample, merge_file)]), merge_file, report_file, command), file=units_file)
+
+    if units_file is not None:
+        units_file.close()
 
 
     
@@ -109,6 +174,19 @@ to
 
 /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/merged_fasta/SQ1738_HWFLWDRXY_s_merged_fastq.txt.gz.demultiplexed_978876_CTTAGTTGCA_psti.R1_trimmed.fastq.non-redundant.fasta
 
+(note that this simple concatenation yields duplicate sequence names, and the result is no longer non-redundant - see below)
+
+#
+# this is used for merging non-redundant fasta files from different lanes, summing the counts of identical sequences
+#
+python merge_lanes.py -t generate_merge_non_redundant_commands -M /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/merged_fasta -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/merge_lanes_commands.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/merge_lanes_input_file_list.txt
+
+would generate commands like
+
+python merge_lanes.py -t merge_non_redundant -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/merged_fasta/SQ1738_HWFLWDRXY_s_merged_fastq.txt.gz.demultiplexed_978876_CTTAGTTGCA_psti.R1_trimmed.fastq.non-redundant.fasta /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/fasta/SQ1738_HWFLWDRXY_s_1_fastq.txt.gz.demultiplexed_978876_CTTAGTTGCA_psti.R1_trimmed.fastq.non-redundant.fasta /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/fasta/SQ1738_HWFLWDRXY_s_2_fastq.txt.gz.demultiplexed_978876_CTTAGTTGCA_psti.R1_trimmed.fastq.non-redundant.fasta
+
+(a lane can also be added to an already merged sample, by merging it with the merged file) 
+
 #
 # this is used for simultaneously trimming and merging upstream (i.e. demultiplex products) files (where the lane number is included in the parent folder file name) 
 #
@@ -141,18 +219,23 @@ cutadapt  -f fastq -q 20  -m 40 -
 )
     """
     parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('input_fof', type=str, nargs=1,help='file of input fasta or fastq filenames')
+    parser.add_argument('input_fof', type=str, nargs="+",help='file of input fasta or fastq filenames (or for merge_non_redundant, the non-redundant fasta files to merge)')
     parser.add_argument('-t', '--task' , dest='task', required=False, default="generate_commands" , type=str,
-                        choices=["generate_commands", "generate_merge_trim_commands"], help="what you want to get / do")
+                        choices=["generate_commands", "generate_merge_trim_commands", "generate_merge_non_redundant_commands", "merge_non_redundant"], help="what you want to get / do")
     parser.add_argument('-O','--output_file', dest='output_file', type=str, default=None, help='output file to write commands to')
     parser.add_argument('-M','--mergedir', dest='mergedir', type=str, default=None, help='name of a folder where the merged files would be written')
+    parser.add_argument('-U','--units_file', dest='units_file', type=str, default=None, help='optional file to also write the units (inputs, outputs and command) of each merge and trim to, for stage_manifest.py (generate_merge_trim_commands)')
     parser.add_argument('-a', '--adapter_phrase' , dest='adapter_phrase', required=False, default="" , type=str, help="adapter phrase to pass to cutadapt ")
     
 
     args = vars(parser.parse_args())
 
-    if not os.path.isfile(args["input_fof"][0]):
-        raise generate_commands_exception("%(input_fof)s is not a file"%args)
+    for filename in args["input_fof"]:
+        if not os.path.isfile(filename):
+            raise generate_commands_exception("%s is not a file"%filename)
+
+    if args["task"] == "merge_non_redundant" and args["output_file"] is None:
+        raise generate_commands_exception("merge_non_redundant requires an output file (-O)")
 
 
     return args
@@ -166,6 +249,10 @@ def main():
         generate_commands(options)
     elif options["task"] == "generate_merge_trim_commands": #
         generate_merge_and_trim_commands(options)
+    elif options["task"] == "generate_merge_non_redundant_commands": # matches the lanes of each sample, and generates commands to merge-count them
+        generate_merge_non_redundant_commands(options)
+    elif options["task"] == "merge_non_redundant": #
+        merge_non_redundant(options)
     else:
         raise generate_commands_exception("unsupported task %(task)s"%options)
         
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import math
+import heapq
+import shlex
+import argparse
+
+#
+# packs the one-command-per-sample command files generated by melseq_prism.sh (trim_commands.txt, format_commands.txt,
+# summary_commands.txt) into balanced jobs, so that tiny samples do not each take a whole slurm array task, and a few
+# large samples started last do not decide when the stage finishes.
+#
+# Each command is weighted by the size of its input - the files given to stage_metrics.py with -i, or failing that,
+# all the (existing, non-script) files named in the command - or by a weight (e.g. a read count) from a weights file.
+# Weights are converted to bytes (by the total size over the total weight of the weighted files that exist), so that
+# weighted and unweighted inputs, and the bytes per second throughput used with -r, are all in the one unit.
+# The commands are then binned longest-processing-time first (largest command to the least loaded job), and the packed
+# command file has one line per job, largest first, e.g.
+#
+#status=0; ( command 1 ); test $? = 0 || status=1; ( command 2 ); test $? = 0 || status=1; test $status = 0
+#
+# so that each command runs in its own subshell (e.g. "set -e" in a summary command only applies to that command - and
+# the subshell is not itself part of an || list, which would disable set -e), all commands in a job are run even if
+# one fails, and the job fails if any did - so it can still be run by tardis -c 1.
+#
+# The number of jobs is either given, or worked out from a target runtime per job and the throughput of the stage
+# (taken from the stage_metrics.jsonl of previous runs, if given, else a default rate)
+#
+
+SCRIPT_SUFFIXES = (".py", ".sh", ".r", ".code", ".mk")
+DEFAULT_BYTES_PER_SECOND = 20 * 1024 * 1024
+
+
+class pack_commands_exception(Exception):
+    def __init__(self,args=None):
+        super(pack_commands_exception, self).__init__(args)
+
+
+def get_command_files(command):
+    """
+    the input files of a command - those given to stage_metrics.py with -i, if any, else all the existing files
+    named in the command, other than scripts
+    """
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        tokens = command.split()
+    inputs = [tokens[i + 1] for i in range(len(tokens) - 1) if tokens[i] in ("-i", "--input")]
+    if len(inputs) > 0:
+        return inputs
+    # (split on shell punctuation as well as space, to look inside quoted commands, and at redirections such as 2>/a/b.stderr)
+    files = []
+    for token in re.split("[\\s'\"|;()<>]+", command):
+        if len(token) > 0 and not token.lower().endswith(SCRIPT_SUFFIXES) and os.path.isfile(token):
+            files.append(token)
+    return files
+
+
+def load_weights(weights_file):
+    """
+    read a tab-delimited file of filename and weight (e.g. a read count)
+    """
+    weights = {}
+    with open(weights_file, "r") as weights_stream:
+        for record in weights_stream:
+            fields = record.strip().split("\t")
+            if len(fields) >= 2 and len(fields[0]) > 0:
+                weights[os.path.realpath(fields[0])] = float(fields[1])
+    return weights
+
+
+def get_bytes_per_weight(weights):
+    """
+    the bytes per unit of weight (e.g. per read) of the weighted files that exist, to convert weights to bytes
+    """
+    weighted_files = [path for path in weights if os.path.isfile(path) and weights[path] > 0]
+    total_weight = sum(weights[path] for path in weighted_files)
+    if total_weight == 0:
+        raise pack_commands_exception("none of the files in the weights file exist (or all have no weight), so weights can't be converted to bytes")
+    return sum(os.path.getsize(path) for path in weighted_files) / float(total_weight)
+
+
+def get_command_weight(command, weights, bytes_per_weight):
+    """
+    the weight of a command in bytes - the (converted) weights of its weighted inputs plus the sizes of the others
+    """
+    weight = 0
+    for filename in get_command_files(command):
+        path = os.path.realpath(filename)
+        if path in weights:
+            weight += weights[path] * bytes_per_weight
+        elif os.path.isfile(path):
+            weight += os.path.getsize(path)
+    return max(1, weight)
+
+
+def get_stage_rate(metrics_file, stage):
+    """
+    median input bytes per second of the per-sample records of a stage in a stage_metrics.jsonl file (see
+    stage_metrics.py), or None if there are none
+    """
+    rates = []
+    with open(metrics_file, "r") as metrics_stream:
+        for record in metrics_stream:
+            try:
+                metrics = json.loads(record)
+            except ValueError:
+                continue
+            if metrics.get("stage") == stage and metrics.get("sample") is not None and metrics.get("exit_code") == 0 \
+                    and metrics.get("input_bytes", 0) > 0 and metrics.get("wall_seconds", 0) > 0:
+                rates.append(metrics["input_bytes"] / metrics["wall_seconds"])
+    if len(rates) == 0:
+        return None
+    return sorted(rates)[len(rates) // 2]
+
+
+def pack(weighted_commands, num_jobs):
+    """
+    longest-processing-time first bin packing - returns a list of (load, [commands]), most loaded first
+    """
+    jobs = [(0, job_number, []) for job_number in range(num_jobs)]
+    heapq.heapify(jobs)
+    for (weight, command) in sorted(weighted_commands, key=lambda item: item[0], reverse=True):
+        (load, job_number, commands) = heapq.heappop(jobs)
+        commands.append(command)
+        heapq.heappush(jobs, (load + weight, job_number, commands))
+    return sorted([(load, commands) for (load, job_number, commands) in jobs if len(commands) > 0], key=lambda job: job[0], reverse=True)
+
+
+def get_job_command(commands):
+    if len(commands) == 1:
+        return commands[0]
+    return "status=0; %s; test $status = 0" % "; ".join("( %s ); test $? = 0 || status=1" % command for command in commands)
+
+
+def pack_commands(options):
+    with open(options["command_file"], "r") as command_stream:
+        commands = [record.strip() for record in command_stream if len(record.strip()) > 0]
+    if len(commands) == 0:
+        open(options["output_file"], "w").close()
+        print("no commands in %(command_file)s" % options, file=sys.stderr)
+        return
+
+    weights = {}
+    bytes_per_weight = 1.0
+    if options["weights_file"] is not None:
+        weights = load_weights(options["weights_file"])
+        bytes_per_weight = get_bytes_per_weight(weights)
+        print("weights converted to bytes at %.2f bytes per unit of weight" % bytes_per_weight, file=sys.stderr)
+    weighted_commands = [(get_command_weight(command, weights, bytes_per_weight), command) for command in commands]
+    total_weight = sum(item[0] for item in weighted_commands)
+
+    num_jobs = len(commands)
+    if options["num_jobs"] is not None:
+        num_jobs = options["num_jobs"]
+    elif options["target_seconds"] is not None:
+        rate = options["bytes_per_second"]
+        if options["metrics_file"] is not None and os.path.isfile(options["metrics_file"]):
+            rate = get_stage_rate(options["metrics_file"], options["stage"]) or rate
+        num_jobs = int(math.ceil(total_weight / (rate * options["target_seconds"])))
+    num_jobs = max(1, min(num_jobs, len(commands)))
+
+    jobs = pack(weighted_commands, num_jobs)
+    with open(options["output_file"], "w") as packed_stream:
+        for (load, job_commands) in jobs:
+            print(get_job_command(job_commands), file=packed_stream)
+
+    print("packed %d commands (total weight %d) into %d jobs - largest job %d, mean %.0f (imbalance %.2f)" % (len(commands), total_weight,
+        len(jobs), jobs[0][0], float(total_weight) / len(jobs), jobs[0][0] / (float(total_weight) / len(jobs))), file=sys.stderr)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+packs a file of commands (one per line) into balanced jobs, largest first, weighting each command by the size of its inputs
+
+examples :
+
+# pack into at most 100 jobs
+./pack_commands.py -n 100 -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/format_commands.packed.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/format_commands.txt
+
+# jobs of about 30 minutes, using the throughput of the summarise stage in previous runs
+./pack_commands.py -r 1800 -m /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stage_metrics.jsonl -s summarise -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summary_commands.packed.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summary_commands.txt
+
+# just order the commands largest first (one per job)
+./pack_commands.py -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/trim_commands.packed.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/trim_commands.txt
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command_file', type=str, help='file of commands, one per line')
+    parser.add_argument('-O', '--output_file', dest='output_file', type=str, required=True, help='packed command file to write')
+    parser.add_argument('-n', '--num_jobs', dest='num_jobs', type=int, default=None, help='number of jobs to pack the commands into (default one per command)')
+    parser.add_argument('-r', '--target_seconds', dest='target_seconds', type=float, default=None, help='target runtime of each job in seconds (instead of -n)')
+    parser.add_argument('-m', '--metrics_file', dest='metrics_file', type=str, default=None, help='stage_metrics.jsonl from previous runs, to estimate the stage throughput (with -r)')
+    parser.add_argument('-s', '--stage', dest='stage', type=str, default=None, help='stage name in the metrics file (with -m)')
+    parser.add_argument('-B', '--bytes_per_second', dest='bytes_per_second', type=float, default=DEFAULT_BYTES_PER_SECOND, help='throughput to assume if there are no metrics (with -r) (default %d)' % DEFAULT_BYTES_PER_SECOND)
+    parser.add_argument('-W', '--weights_file', dest='weights_file', type=str, default=None, help='optional tab-delimited file of input filename and weight (e.g. read count), used instead of the file size (converted to bytes using the sizes of the weighted files)')
+
+    args = vars(parser.parse_args())
+
+    if not os.path.isfile(args["command_file"]):
+        raise pack_commands_exception("%(command_file)s is not a file" % args)
+    if args["num_jobs"] is not None and args["target_seconds"] is not None:
+        raise pack_commands_exception("specify either the number of jobs (-n) or a target runtime (-r), not both")
+    if args["metrics_file"] is not None and args["stage"] is None:
+        raise pack_commands_exception("a stage (-s) is needed to use the metrics file")
+    if args["weights_file"] is not None and not os.path.isfile(args["weights_file"]):
+        raise pack_commands_exception("%(weights_file)s is not a file" % args)
+
+    return args
+
+
+def main():
+    options = get_options()
+    pack_commands(options)
+
+
+if __name__ == "__main__":
+   main()
@@ -1,10 +1,17 @@
 #!/usr/bin/env python2.7
 from __future__ import print_function
 
-import itertools,os,re,argparse,string,sys
+import itertools,os,re,argparse,string,sys,gzip
+import multiprocessing
+from collections import Counter
+import numpy
 sys.path.append('/dataset/gseq_processing/active/bin/melseq_prism/seq_prisms')
 from data_prism import prism, build, from_tab_delimited_file, bin_discrete_value
 
+COLLAPSED_COUNT_COLUMN = 8    # (zero based) count column in collapsed summaries 
+ABSENT_BIN = ("\x00absent",)  # a bin which no sample has, used to get the projection value of bins absent from a sample
+RANKS = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]   # summary columns 1-7
+LINEAGE_FILE = "taxonomy_lineages.txt"   # default run-level lineage dictionary of the columnar distributions (in the folder of the summaries)
 
 def my_taxonomy_tuple_provider(filename, *xargs):
     """
@@ -32,9 +39,15 @@ i.e.
 
                         div             phylum          class           order           fam             gen     spec
 
-return a tuple of the first column, and othe columns as requested 
+or a collapsed summary file, with one record per sequence and the count in an extra (last) column, like this :
+
+Sequence188_count=2     Bacteria        Bacteroidetes   Bacteroidia     Bacteroidales   Prevotellaceae  Prevotella      NA      2
+Sequence197_count=1     Bacteria        Bacteroidetes   Bacteroidia     Bacteroidales   Prevotellaceae  Prevotella      Prevotella brevis       1
+
+return a tuple of the weight column (the first xarg - i.e. the sequence name column 0, or the count column of a 
+collapsed summary), and othe columns as requested 
 """
-    tuple_stream = from_tab_delimited_file(filename,0,*xargs[0:])   # pick which fields define the bins 
+    tuple_stream = from_tab_delimited_file(filename,*xargs[0:])   # pick which fields define the weight and the bins 
 
     atuple = tuple_stream.next()
     while True:
@@ -52,11 +65,165 @@ def my_value_provider(taxonomy_tuple, *xargs):
     elif weighting_method == "parse":
         tokens=re.split("=", taxonomy_tuple[0])
         return ((int(tokens[1]), taxonomy_tuple[1]),)
+    elif weighting_method == "column":
+        return ((int(taxonomy_tuple[0]), taxonomy_tuple[1]),)
     else:
         raise Exception("unexpected weightng method %s"%weighting_method)
     
             
-def build_tax_distribution(datafile, weighting_method, columns, moniker):
+def get_weight_column(weighting_method):
+    # the collapsed summary format has the count in the last column, after the 7 ranks
+    if weighting_method == "column":
+        return COLLAPSED_COUNT_COLUMN
+    return 0
+
+def read_aggregated_summary(datafile, weighting_method):
+    """
+    read a summary file once, returning a Counter of (rank1,...,rank7) => total weight
+    """
+    if re.search("\.gz$", datafile) is not None:
+        summary_stream = gzip.open(datafile, "r")
+    else:
+        summary_stream = open(datafile, "r")
+
+    weight_column = get_weight_column(weighting_method)
+    lineage_weights = Counter()
+    for record in summary_stream:
+        fields = record.rstrip("\r\n").split("\t")
+        if len(fields) < 1 + len(RANKS):
+            continue
+        weight = my_value_provider((fields[weight_column], None), weighting_method)[0][0]
+        lineage_weights[tuple(fields[1:1 + len(RANKS)])] += weight
+    summary_stream.close()
+    return lineage_weights
+
+def my_aggregated_tuple_provider(filename, *xargs):
+    """
+    yields (weight, bin) tuples, as my_taxonomy_tuple_provider does, but from lineage weights already aggregated at the
+    required rank (the first xarg) - rather than from the file
+    """
+    for (lineage, weight) in xargs[0]:
+        # note that we patch NA to taxNA , as NA confuses R
+        yield ((weight, re.sub("NA","taxNA", ";".join(lineage))))
+
+def get_lineage_filename(filename, lineage_file):
+    """
+    the lineage dictionary to use for a distribution file - the one given, or else the default in the folder of the file 
+    """
+    if lineage_file is not None:
+        return lineage_file
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), LINEAGE_FILE)
+
+def load_lineage_dictionary(lineage_file):
+    """
+    the lineages of a lineage dictionary, in id order (one lineage per line - the id of a lineage is its line number, from 0)
+    """
+    if not os.path.isfile(lineage_file):
+        return []
+    with open(lineage_file, "r") as lineage_stream:
+        return [record.rstrip("\r\n") for record in lineage_stream]
+
+def save_lineage_dictionary(lineage_file, lineages):
+    # write and rename, so that a reader never sees a partly written dictionary
+    with open("%s.tmp"%lineage_file, "w") as lineage_stream:
+        for lineage in lineages:
+            print(lineage, file=lineage_stream)
+    os.rename("%s.tmp"%lineage_file, lineage_file)
+
+def save_columnar_distribution(filename, bin_weights, lineages, lineage_index):
+    """
+    save a sample distribution (dict of bin name => weight) as a 2 x n int64 array of interned lineage ids (row 0, 
+    ascending) and weights (row 1). New lineages are appended to lineages (and lineage_index, of lineage => id), so 
+    that the ids of lineages already in the dictionary do not change
+    """
+    for lineage in sorted(bin_weights.keys()):
+        if lineage not in lineage_index:
+            lineage_index[lineage] = len(lineages)
+            lineages.append(lineage)
+    ids = sorted(lineage_index[lineage] for lineage in bin_weights)
+    distribution = numpy.array([ids, [bin_weights[lineages[lineage_id]] for lineage_id in ids]], dtype=numpy.int64)
+    numpy.save(filename, distribution)
+    print("saving columnar distribution to %s"%filename)
+
+def load_columnar_distribution(filename):
+    """
+    a columnar distribution, memory-mapped (so it is only read as it is used)
+    """
+    return numpy.load(filename, mmap_mode="r")
+
+def get_bin_weights(distob):
+    """
+    dict of bin name => weight, of a distribution
+    """
+    return dict((tax_bin[0], weight) for (tax_bin, weight) in distob.get_spectrum().items())
+
+def get_rank_weights(lineage_weights, rank):
+    """
+    lineage weights (tuples of ranks => weight) aggregated at a rank 
+    """
+    depth = RANKS.index(rank) + 1
+    rank_weights = Counter()
+    for (lineage, weight) in lineage_weights.items():
+        rank_weights[lineage[0:depth]] += weight
+    return rank_weights
+
+def build_rank_distributions(args):
+    """
+    read a summary file once, and build and save the distribution at each of the requested ranks - e.g. for rank
+    genus (columns 1,2,3,4,5,6), saves datafile.taxonomy_genus.pickle. Returns the datafile, and (for the columnar
+    format, which is saved by the caller as the lineage ids are shared by all samples) the bin weights at each rank
+    """
+    (datafile, weighting_method, ranks, distribution_format) = args
+    lineage_weights = read_aggregated_summary(datafile, weighting_method)
+
+    rank_bin_weights = {}
+    for rank in ranks:
+        rank_weights = get_rank_weights(lineage_weights, rank)
+
+        if distribution_format in ("columnar", "both"):
+            # note that we patch NA to taxNA , as NA confuses R (as my_aggregated_tuple_provider)
+            rank_bin_weights[rank] = dict((re.sub("NA","taxNA", ";".join(lineage)), weight) for (lineage, weight) in rank_weights.items())
+        if distribution_format == "columnar":
+            continue
+
+        distob = prism([datafile], 1)
+        distob.file_to_stream_func = my_aggregated_tuple_provider
+        distob.file_to_stream_func_xargs = [sorted(rank_weights.items())]
+        distob.interval_locator_funcs = [bin_discrete_value]
+        distob.spectrum_value_provider_func = my_value_provider
+        distob.spectrum_value_provider_func_xargs = ["column"]     # the weight is in the first element of each tuple
+        build(distob,"singlethread")
+
+        print("saving distribution to %s.taxonomy_%s.pickle"%(datafile, rank))
+        distob.save("%s.taxonomy_%s.pickle"%(datafile, rank))
+        print("""
+    seq count %d
+    taxonomy bin count %d
+    """%(distob.total_spectrum_value, len(distob.spectrum.keys())))
+
+    return (datafile, rank_bin_weights)
+
+def build_rank_summaries(datafiles, weighting_method, ranks, num_processes, distribution_format="pickle", lineage_file=None):
+    if len(datafiles) == 0:
+        return
+    lineage_file = get_lineage_filename(datafiles[0], lineage_file)
+    lineages = load_lineage_dictionary(lineage_file)
+    lineage_index = dict((lineage, i) for (i, lineage) in enumerate(lineages))
+
+    pool = multiprocessing.Pool(processes=max(1, min(num_processes, len(datafiles))))
+    for (datafile, rank_bin_weights) in pool.imap_unordered(build_rank_distributions, [(datafile, weighting_method, ranks, distribution_format) for datafile in datafiles]):
+        for rank in ranks:
+            if rank in rank_bin_weights:
+                save_columnar_distribution("%s.taxonomy_%s.npy"%(datafile, rank), rank_bin_weights[rank], lineages, lineage_index)
+        print("built %s distributions for %s"%(",".join(ranks), datafile))
+    pool.close()
+    pool.join()
+
+    if distribution_format in ("columnar", "both"):
+        save_lineage_dictionary(lineage_file, lineages)
+        print("saved %d lineages to %s"%(len(lineages), lineage_file))
+
+def build_tax_distribution(datafile, weighting_method, columns, moniker, distribution_format="pickle", lineages=None, lineage_index=None):
     use_columns = [ int(item) for item in re.split(",", columns)]
 
     
@@ -64,15 +231,18 @@ def build_tax_distribution(datafile, weighting_method, columns, moniker):
 
     #distob.DEBUG = True
     distob.file_to_stream_func = my_taxonomy_tuple_provider
-    distob.file_to_stream_func_xargs = use_columns 
+    distob.file_to_stream_func_xargs = [get_weight_column(weighting_method)] + use_columns 
     distob.interval_locator_funcs = [bin_discrete_value]
     distob.spectrum_value_provider_func = my_value_provider
     distob.spectrum_value_provider_func_xargs = [weighting_method]
     
     distdata = build(distob,"singlethread")
 
-    print("saving distribution to %s.taxonomy%s.pickle"%(datafile, moniker))
-    distob.save("%s.taxonomy%s.pickle"%(datafile, moniker))
+    if distribution_format in ("columnar", "both"):
+        save_columnar_distribution("%s.taxonomy%s.npy"%(datafile, moniker), get_bin_weights(distob), lineages, lineage_index)
+    if distribution_format in ("pickle", "both"):
+        print("saving distribution to %s.taxonomy%s.pickle"%(datafile, moniker))
+        distob.save("%s.taxonomy%s.pickle"%(datafile, moniker))
     print("""
     seq count %d
     taxonomy bin count %d
@@ -95,31 +265,105 @@ def parse_sample_moniker(sample_moniker, sample_moniker_regexp):
     else:
         return m.groups()[0]
 
-def get_samples_tax_distribution(sample_tax_summaries, measure, sample_moniker_regexp):
-    tax_bins = [ prism.load(sample_tax_summary).get_spectrum().keys() for sample_tax_summary in sample_tax_summaries ]
-    
-    tax_bins =  list ( set(  reduce(lambda x,y:x+y, tax_bins ) ) ) 
-    tax_bins.sort()
+def get_sample_projection(args):
+    """
+    load a sample distribution (once), and return its bins, the projection of the sample onto its own bins, and
+    the projection value of a bin which the sample does not have (so the sample can be projected onto the union of all
+    the sample bins without re-loading it)
+    """
+    (sample_tax_summary, measure) = args
+    distob = prism.load(sample_tax_summary)
+    sample_bins = list(distob.get_spectrum().keys())
+    if measure == "frequency":
+        projection = distob.get_raw_projection(sample_bins + [ABSENT_BIN])
+    else:
+        projection = distob.get_unsigned_information_projection(sample_bins + [ABSENT_BIN])
+    projection = list(projection)
+    return (sample_bins, projection[:-1], projection[-1])
 
+def get_samples_tax_matrix(sample_tax_summaries, measure, num_processes):
+    """
+    returns the (sorted) union of the sample bins, and a sample x bin matrix of projection values. The projections
+    are still computed per sample by data_prism (in the pool) - only the union of the bins and the assembly of the
+    matrix are done here (the columnar distributions are the vectorised path - see get_columnar_tax_matrix)
+    """
+    pool = multiprocessing.Pool(processes=max(1, min(num_processes, len(sample_tax_summaries))))
+    sample_projections = pool.map(get_sample_projection, [(sample_tax_summary, measure) for sample_tax_summary in sample_tax_summaries])
+    pool.close()
+    pool.join()
+
+    tax_bins = set()
+    for (sample_bins, projection, absent_value) in sample_projections:
+        tax_bins.update(sample_bins)
+    tax_bins = sorted(tax_bins)
+    bin_index = dict((tax_bin, i) for (i, tax_bin) in enumerate(tax_bins))
+
+    # keep integer projections as integers, so the table is formatted as before 
+    all_values = itertools.chain(*[projection + [absent_value] for (sample_bins, projection, absent_value) in sample_projections])
+    if all(isinstance(value, (int, long, numpy.integer)) for value in all_values):
+        dtype = numpy.int64
+    else:
+        dtype = numpy.float64
 
-    if measure == "frequency":
-        samples_tax_distributions = [[item[0] for item in tax_bins]] + [ prism.load(sample_tax_summary).get_raw_projection(tax_bins) for sample_tax_summary in sample_tax_summaries]
+    matrix = numpy.empty((len(sample_projections), len(tax_bins)), dtype=dtype)
+    for (row, (sample_bins, projection, absent_value)) in enumerate(sample_projections):
+        matrix[row,:] = absent_value
+        matrix[row, [bin_index[tax_bin] for tax_bin in sample_bins]] = projection
 
+    return (tax_bins, matrix)
+
+def get_columnar_tax_matrix(sample_tax_summaries, measure, lineage_file=None):
+    """
+    as get_samples_tax_matrix, but from columnar distributions - each is memory-mapped, and its weights are scattered
+    straight into the matrix (the frequency projection of a distribution is its weights, with 0 for absent bins)
+    """
+    if measure != "frequency":
+        raise Exception("the %s measure is not supported for columnar distributions - use the pickled distributions"%measure)
+    lineage_file = get_lineage_filename(sample_tax_summaries[0], lineage_file)
+    lineages = load_lineage_dictionary(lineage_file)
+    distributions = [load_columnar_distribution(sample_tax_summary) for sample_tax_summary in sample_tax_summaries]
+
+    used = numpy.zeros(len(lineages), dtype=bool)
+    for (sample_tax_summary, distribution) in zip(sample_tax_summaries, distributions):
+        if distribution.shape[1] > 0 and distribution[0,-1] >= len(lineages):
+            raise Exception("%s has lineage ids not in %s"%(sample_tax_summary, lineage_file))
+        used[distribution[0]] = True
+
+    # columns in the order of the (sorted) bins, as from the pickled distributions
+    lineage_ids = sorted(numpy.flatnonzero(used).tolist(), key=lambda lineage_id: lineages[lineage_id])
+    column_index = numpy.zeros(len(lineages), dtype=numpy.int64)
+    column_index[lineage_ids] = numpy.arange(len(lineage_ids))
+
+    matrix = numpy.zeros((len(distributions), len(lineage_ids)), dtype=numpy.int64)
+    for (row, distribution) in enumerate(distributions):
+        matrix[row, column_index[distribution[0]]] = distribution[1]
+
+    return ([(lineages[lineage_id],) for lineage_id in lineage_ids], matrix)
+
+def get_samples_tax_distribution(sample_tax_summaries, measure, sample_moniker_regexp, num_processes=1, matrix_file=None, lineage_file=None):
+    columnar = [re.search("\.npy$", sample_tax_summary) is not None for sample_tax_summary in sample_tax_summaries]
+    if all(columnar) and len(columnar) > 0:
+        (tax_bins, matrix) = get_columnar_tax_matrix(sample_tax_summaries, measure, lineage_file)
+    elif any(columnar):
+        raise Exception("expected either all columnar (.npy) or all pickled distributions")
     else:
-        samples_tax_distributions = [[item[0] for item in tax_bins]] + [ prism.load(sample_tax_summary).get_unsigned_information_projection(tax_bins) for sample_tax_summary in sample_tax_summaries]
+        (tax_bins, matrix) = get_samples_tax_matrix(sample_tax_summaries, measure, num_processes)
+    sample_monikers = [parse_sample_moniker(os.path.basename(path.strip()), sample_moniker_regexp) for path in sample_tax_summaries]
 
-    td_iter = itertools.izip(*samples_tax_distributions)
-    #heading = itertools.izip(*[["taxonomy"]]+[[re.split("\.",os.path.basename(path.strip()))[0]] for path in sample_tax_summaries])
-    heading = itertools.izip(*[["taxonomy"]]+[[parse_sample_moniker(os.path.basename(path.strip()), sample_moniker_regexp) ] for path in sample_tax_summaries])
-    td_iter = itertools.chain(heading, td_iter)
+    if matrix_file is not None:
+        # binary copy of the matrix (samples x taxa) for downstream use 
+        numpy.savez(matrix_file, matrix=matrix, taxa=numpy.array([item[0] for item in tax_bins]), samples=numpy.array(sample_monikers))
 
-    for record in td_iter:
-        print(string.join([str(item) for item in record],"\t"))
+    # one taxon (column of the matrix) at a time, rather than copying the whole matrix into a list of lists 
+    print(string.join(["taxonomy"] + sample_monikers, "\t"))
+    for (tax_bin, column) in itertools.izip(tax_bins, matrix.T):
+        print(string.join([str(tax_bin[0])] + [str(item) for item in column.tolist()],"\t"))
 
 def debug(options):
-    test_iter = my_taxonomy_tuple_provider(options["filenames"][0], *[6,7])
-    #test_iter = (my_value_provider(atuple, "line") for atuple in my_taxonomy_tuple_provider(options["filenames"][0], *[6,7]))
-    #test_iter = (my_value_provider(atuple, "parse") for atuple in my_taxonomy_tuple_provider(options["filenames"][0], *[6,7]))
+    test_iter = my_taxonomy_tuple_provider(options["filenames"][0], *[get_weight_column(options["weighting_method"]),6,7])
+    #test_iter = (my_value_provider(atuple, "line") for atuple in my_taxonomy_tuple_provider(options["filenames"][0], *[0,6,7]))
+    #test_iter = (my_value_provider(atuple, "parse") for atuple in my_taxonomy_tuple_provider(options["filenames"][0], *[0,6,7]))
+    #test_iter = (my_value_provider(atuple, "column") for atuple in my_taxonomy_tuple_provider(options["filenames"][0], *[COLLAPSED_COUNT_COLUMN,6,7]))
 
     for item in test_iter:
         print(item)
@@ -136,28 +380,49 @@ example :
 
 ./profile_prism.py --weighting_method parse text.txt
 
+./profile_prism.py --weighting_method column /dataset/gseq_processing/scratch/melseq/SQ1917/summary/*.summary     # collapsed summaries (summarize_counts.py -F collapsed)
+
 ./profile_prism.py --weighting_method line --columns 2,3,4 --moniker L1 /dataset/gseq_processing/scratch/melseq/SQ0990_S2311_L008_R1_sample_afm.fastq.gz/sheep/summary/*.summary
 
 ./profile_prism.py --summary_type summary_table --measure frequency /dataset/gseq_processing/scratch/melseq/SQ0990_S2311_L008_R1_sample_afm.fastq.gz/sheep/summary/*.pickle
 
+./profile_prism.py --summary_type rank_summaries --ranks species,genus --weighting_method line --num_processes 8 /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/summary/*_summary.txt    # writes *_summary.txt.taxonomy_species.pickle and *_summary.txt.taxonomy_genus.pickle 
+
 ./profile_prism.py --weighting_method line --columns 6 /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/summary/*_summary.txt
 
 ./profile_prism.py --summary_type summary_table  --measure frequency /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/summary/*_summary.txt.taxonomy.pickle > /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/by_animal/html/taxonomy_genus_frequency_table.txt
 
+./profile_prism.py --summary_type rank_summaries --ranks species,genus --weighting_method line --distribution_format both /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/summary/*_summary.txt    # also writes *_summary.txt.taxonomy_species.npy etc., and the lineage dictionary summary/taxonomy_lineages.txt
+
+./profile_prism.py --summary_type summary_table  --measure frequency /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/summary/*_summary.txt.taxonomy_genus.npy > /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/by_animal/html/taxonomy_genus_frequency_table.txt
+
+./profile_prism.py --summary_type summary_table  --measure frequency --num_processes 8 --matrix_file /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/by_animal/html/taxonomy_genus_frequency_table.npz /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/summary/*_summary.txt.taxonomy.pickle > /dataset/gseq_processing/scratch/melseq/SQ0990/cattle/by_animal/html/taxonomy_genus_frequency_table.txt
+
 
 """
 
     parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
     parser.add_argument('filenames', type=str, nargs="*",help='input summary files (optionally compressed with gzip)')    
     parser.add_argument('--summary_type', dest='summary_type', default="sample_summaries", \
-                   choices=["sample_summaries", "summary_table", "dump"],help="summary type (default: sample_summaries")
+                   choices=["sample_summaries", "rank_summaries", "summary_table", "dump"],help="summary type (default: sample_summaries")
     parser.add_argument('--measure', dest='measure', default="frequency", \
                    choices=["frequency", "information"],help="measure (default: frequency")
     parser.add_argument('--columns' , dest='columns', default="1,2,3,4,5,6,7" ,help="comma separated list of columns to use to define bins")
     parser.add_argument('--moniker' , dest='moniker', default="" ,help="optional summmary moniker e.g. L1 L2 etc")    
-    parser.add_argument('--weighting_method' , dest='weighting_method', default="parse",choices=["parse", "line"],help="weighting method - either parse weight from seq suffix, or just count lines")
+    parser.add_argument('--weighting_method' , dest='weighting_method', default="parse",choices=["parse", "line", "column"],help="weighting method - either parse weight from seq suffix, or just count lines, or take weight from the count column of a collapsed summary")
+    parser.add_argument('--ranks' , dest='ranks', default="species,genus" ,help="comma separated list of ranks to build distributions at (rank_summaries) - any of %s (default species,genus)"%",".join(RANKS))
+    parser.add_argument('--num_processes', dest='num_processes', type=int, default=4, help="number of processes to use to build (rank_summaries) or load (summary_table) the sample distributions (default 4)")
+    parser.add_argument('--matrix_file', dest='matrix_file', default=None, help="optional file to save the sample x taxonomy matrix to (numpy .npz, with arrays matrix, taxa and samples) (summary_table)")
+    parser.add_argument('--distribution_format', dest='distribution_format', default="pickle", choices=["pickle", "columnar", "both"], \
+                   help="format of the sample distributions to save (sample_summaries, rank_summaries) - pickle (data_prism), columnar (numpy .npy of lineage ids and weights, with a shared lineage dictionary), or both (default pickle)")
+    parser.add_argument('--lineage_file', dest='lineage_file', default=None, help="lineage dictionary of the columnar distributions (default %s in the folder of the (first) input file)"%LINEAGE_FILE)
     parser.add_argument('--sample_moniker_regexp', dest='sample_moniker_regexp', default="^(\S+)_trimmed.fastq.non-redundant.fasta.blastn.GenusPlusQuinella.num_threads4outfmt6stdqlenevalue0.02.summary.taxonomy.pickle")
     args = vars(parser.parse_args())
+
+    args["ranks"] = re.split(",", args["ranks"])
+    for rank in args["ranks"]:
+        if rank not in RANKS:
+            raise Exception("unknown rank %s - should be one of %s"%(rank, ",".join(RANKS)))
     return args
 
         
@@ -169,15 +434,24 @@ def main():
     #return
 
     if args["summary_type"] == "sample_summaries" :
+        if len(args["filenames"]) > 0:
+            lineage_file = get_lineage_filename(args["filenames"][0], args["lineage_file"])
+            lineages = load_lineage_dictionary(lineage_file)
+            lineage_index = dict((lineage, i) for (i, lineage) in enumerate(lineages))
         for filename in  args["filenames"]:
-            tax_dist = build_tax_distribution(filename, weighting_method = args["weighting_method"], columns=args["columns"], moniker=args["moniker"])
+            tax_dist = build_tax_distribution(filename, weighting_method = args["weighting_method"], columns=args["columns"], moniker=args["moniker"], \
+                                              distribution_format=args["distribution_format"], lineages=lineages, lineage_index=lineage_index)
             print(tax_dist)
             #write_summaries(filename,tax_dist)
+        if len(args["filenames"]) > 0 and args["distribution_format"] in ("columnar", "both"):
+            save_lineage_dictionary(lineage_file, lineages)
+    elif args["summary_type"] == "rank_summaries" :
+        build_rank_summaries(args["filenames"], args["weighting_method"], args["ranks"], args["num_processes"], args["distribution_format"], args["lineage_file"])
     elif args["summary_type"] == "dump" :
         debug(args)
     elif args["summary_type"] == "summary_table" :
         #print "summarising %s"%str(args["filename"])
-        get_samples_tax_distribution(args["filenames"], args["measure"], args["sample_moniker_regexp"])
+        get_samples_tax_distribution(args["filenames"], args["measure"], args["sample_moniker_regexp"], args["num_processes"], args["matrix_file"], args["lineage_file"])
 
     
 
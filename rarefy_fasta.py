@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import zlib
+import argparse
+import multiprocessing
+import numpy
+import seq_io
+
+#
+# rarefies (subsamples) non-redundant fasta files to a target depth (number of reads), so that the deepest samples
+# do not dominate the cost of blast and summarise - e.g. with a depth of 100000, a sample of 3 million reads is blasted
+# as 100000 reads, while a sample of 50000 reads is left as it is.
+#
+# The reads of a sample are sampled without replacement, as if the non-redundant fasta were expanded to one record per
+# read, but without expanding it : each read is given a uniform random key, and the reads with the depth smallest keys
+# are kept. The file is read once, in batches of records - for a record of count c, only the keys less than the current
+# depth-th smallest key (the threshold) can be kept, so only their number (binomial(c, threshold)) and values are drawn,
+# and the candidates of the batch are merged with those kept so far. At most depth keys, and the records they belong to,
+# are held at once. The kept records are written in their original order, with the count in the name (count=) replaced
+# by the number of their reads kept, e.g.
+#
+#>Sequence59_count=2     (was Sequence59_count=7)
+#
+# (records with no reads kept are dropped). The random seed of each file is the seed given plus a checksum of the file
+# name, so the result for a file is the same whichever other files it is rarefied with.
+#
+# The sampling fraction of each sample (kept reads / reads) is written to a tab-delimited table, so that profiles of
+# rarefied samples can be rescaled - rows of the files rarefied are replaced, rows of other files are kept, e.g.
+#
+#sample_file     reads   records depth   kept_reads      kept_records    fraction
+#SQ1917_...966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta  3021544  181773  100000  100000  14392   0.0330956
+#
+
+BATCH_RECORDS = 65536
+FRACTIONS_HEADER = ["sample_file", "reads", "records", "depth", "kept_reads", "kept_records", "fraction"]
+
+
+class rarefy_fasta_exception(Exception):
+    def __init__(self,args=None):
+        super(rarefy_fasta_exception, self).__init__(args)
+
+
+def get_seed(seed, fasta_file):
+    return (seed + zlib.crc32(os.path.basename(fasta_file).encode("utf-8"))) & 0xffffffff
+
+
+def sample_batch(random_state, counts, threshold):
+    """
+    candidate (keys, record positions) of a batch of records - the keys less than the threshold, of each read
+    """
+    candidate_counts = random_state.binomial(counts, threshold) if threshold < 1 else counts
+    keys = random_state.uniform(0, threshold, candidate_counts.sum())
+    return (keys, numpy.repeat(numpy.arange(len(counts)), candidate_counts))
+
+
+def rarefy_file(rarefy_args):
+    """
+    rarefy a non-redundant fasta to the depth - returns (fasta_file, reads, records, kept reads, kept records)
+    """
+    (fasta_file, output_file, depth, seed) = rarefy_args
+    random_state = numpy.random.RandomState(get_seed(seed, fasta_file))
+
+    # kept_keys and kept_records (the record number of each key) are the (at most depth) smallest keys so far
+    kept_keys = numpy.zeros(0, dtype=numpy.float64)
+    kept_records = numpy.zeros(0, dtype=numpy.int64)
+    kept_seqs = {}
+    threshold = 1.0
+    (reads, records) = (0, 0)
+
+    def add_batch(batch, kept_keys, kept_records, threshold):
+        counts = numpy.array([count for (name, seq, count) in batch], dtype=numpy.int64)
+        (keys, positions) = sample_batch(random_state, counts, threshold)
+        first_record = records - len(batch)
+        keys = numpy.concatenate((kept_keys, keys))
+        record_numbers = numpy.concatenate((kept_records, positions + first_record))
+        if len(keys) > depth:
+            smallest = numpy.argpartition(keys, depth - 1)[:depth]
+            (keys, record_numbers) = (keys[smallest], record_numbers[smallest])
+        if len(keys) >= depth:
+            threshold = keys.max()
+
+        # keep the records which have any keys kept
+        kept = set(record_numbers.tolist())
+        for record_number in list(kept_seqs.keys()):
+            if record_number not in kept:
+                del kept_seqs[record_number]
+        for position in set(positions.tolist()):
+            if position + first_record in kept:
+                (name, seq, count) = batch[position]
+                kept_seqs[position + first_record] = (name, seq)
+        return (keys, record_numbers, threshold)
+
+    batch = []
+    with seq_io.open_input(fasta_file) as fasta_stream:
+        for (name, seq) in seq_io.fasta_iter(fasta_stream):
+            name = name.strip().split()[0]
+            count = seq_io.get_count(name)
+            batch.append((name, seq, count))
+            reads += count
+            records += 1
+            if len(batch) >= BATCH_RECORDS:
+                (kept_keys, kept_records, threshold) = add_batch(batch, kept_keys, kept_records, threshold)
+                batch = []
+    if len(batch) > 0:
+        (kept_keys, kept_records, threshold) = add_batch(batch, kept_keys, kept_records, threshold)
+
+    kept_counts = numpy.bincount(kept_records, minlength=records)
+    kept_reads = 0
+    with seq_io.open_output(output_file) as out_stream:
+        for record_number in sorted(kept_seqs.keys()):
+            (name, seq) = kept_seqs[record_number]
+            count = int(kept_counts[record_number])
+            seq_io.write_fasta(out_stream, re.sub(b"count=\\d+", ("count=%d" % count).encode(), name), seq)
+            kept_reads += count
+
+    return (fasta_file, reads, records, kept_reads, len(kept_seqs))
+
+
+def read_fractions(fractions_file):
+    """
+    rows of an existing fractions table, keyed by sample file
+    """
+    rows = {}
+    if fractions_file is not None and os.path.isfile(fractions_file):
+        with open(fractions_file, "r") as fractions_stream:
+            for record in fractions_stream:
+                fields = record.rstrip("\r\n").split("\t")
+                if len(fields) == len(FRACTIONS_HEADER) and fields[0] != FRACTIONS_HEADER[0]:
+                    rows[fields[0]] = fields
+    return rows
+
+
+def rarefy(options):
+    rows = read_fractions(options["fractions_file"])
+
+    pool = multiprocessing.Pool(processes=max(1, min(options["num_processes"], len(options["filenames"]))))
+    rarefy_args = [(fasta_file, os.path.join(options["output_folder"], os.path.basename(fasta_file)), options["depth"], options["seed"]) for fasta_file in options["filenames"]]
+    (total_reads, total_kept_reads) = (0, 0)
+    for (fasta_file, reads, records, kept_reads, kept_records) in pool.imap(rarefy_file, rarefy_args):
+        fraction = kept_reads / float(max(1, reads))
+        print("%s : kept %d of %d reads (%d of %d sequences) - fraction %.6g" % (fasta_file, kept_reads, reads, kept_records, records, fraction), file=sys.stderr)
+        rows[os.path.basename(fasta_file)] = [os.path.basename(fasta_file), str(reads), str(records), str(options["depth"]), str(kept_reads), str(kept_records), "%.6g" % fraction]
+        total_reads += reads
+        total_kept_reads += kept_reads
+    pool.close()
+    pool.join()
+
+    if options["fractions_file"] is not None:
+        with open(options["fractions_file"], "w") as fractions_stream:
+            print("\t".join(FRACTIONS_HEADER), file=fractions_stream)
+            for sample_file in sorted(rows.keys()):
+                print("\t".join(rows[sample_file]), file=fractions_stream)
+
+    print("rarefied %d files to depth %d - kept %d of %d reads" % (len(options["filenames"]), options["depth"], total_kept_reads, total_reads), file=sys.stderr)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+rarefies non-redundant fasta files to a target depth (number of reads), writing the rarefied files (with the same names) to the output folder
+
+examples :
+
+./rarefy_fasta.py -d 100000 -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/rarefied -F /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/rarefied/rarefaction_fractions.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/*.non-redundant.fasta
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames', type=str, nargs="+", help='non-redundant fasta files (optionally compressed with gzip)')
+    parser.add_argument('-d', '--depth', dest='depth', type=int, required=True, help='number of reads to rarefy each sample to')
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=1, help='random seed (default 1)')
+    parser.add_argument('-O', '--output_folder', dest='output_folder', type=str, required=True, help='folder to write the rarefied fasta files to')
+    parser.add_argument('-F', '--fractions_file', dest='fractions_file', type=str, default=None, help='table of the sampling fraction of each sample to write (rows of other samples already in it are kept)')
+    parser.add_argument('-j', '--num_processes', dest='num_processes', type=int, default=4, help='number of files to rarefy in parallel (default 4)')
+
+    args = vars(parser.parse_args())
+
+    if args["depth"] < 1:
+        raise rarefy_fasta_exception("depth must be at least 1")
+    if not os.path.isdir(args["output_folder"]):
+        raise rarefy_fasta_exception("%s is not a folder" % args["output_folder"])
+    for filename in args["filenames"]:
+        if not os.path.isfile(filename):
+            raise rarefy_fasta_exception("%s is not a file" % filename)
+        if os.path.realpath(os.path.dirname(filename)) == os.path.realpath(args["output_folder"]):
+            raise rarefy_fasta_exception("%s is in the output folder - it would be overwritten" % filename)
+
+    return args
+
+
+def main():
+    options = get_options()
+    rarefy(options)
+
+
+if __name__ == "__main__":
+   main()
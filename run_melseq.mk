@@ -26,7 +26,11 @@
 	$@.sh > $@.mk.log 2>&1
 	date > $@
 
-%.run_blast: %.run_format
+%.run_blast: %.run_dereplicate
+	$@.sh > $@.mk.log 2>&1
+	date > $@
+
+%.run_dereplicate: %.run_format
 	$@.sh > $@.mk.log 2>&1
 	date > $@
 
@@ -43,10 +47,32 @@
 	date > $@
 
 
+####################################################################
+# with stream scheduling, each sample goes through trim, format, blast 
+# and summarise on its own (see sample_stream.py), in place of the 
+# stage-at-a-time sequence above 
+####################################################################
+
+%.run_stream_all: %.run_stream_html
+	date > $@
+
+%.run_stream_html: %.run_stream_kmer_analysis
+	$*.run_html.sh > $@.mk.log 2>&1
+	date > $@
+
+%.run_stream_kmer_analysis: %.run_stream
+	$*.run_kmer_analysis.sh > $@.mk.log 2>&1
+	date > $@
+
+%.run_stream: %.run_demultiplex
+	$@.sh > $@.mk.log 2>&1
+	date > $@
+
+
 ##############################################
 # specify the intermediate files to keep 
 ##############################################
-.PRECIOUS: %.run_all %.run_kmer_analysis %.run_summarise %.run_blast %.run_format %.run_trim %.run_demultiplex 
+.PRECIOUS: %.run_all %.run_kmer_analysis %.run_summarise %.run_blast %.run_dereplicate %.run_format %.run_trim %.run_demultiplex %.run_stream_all %.run_stream_html %.run_stream_kmer_analysis %.run_stream 
 
 ##############################################
 # cleaning - not yet doing this using make  
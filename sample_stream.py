@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import time
+import glob
+import heapq
+import argparse
+import subprocess
+
+#
+# runs each sample through the per-sample stages (trim, format, blast, summarise) on its own, so that a sample goes on
+# to its next stage as soon as its own previous stage is done - rather than each stage waiting for the slowest sample
+# of the previous stage, as when the stages are run one at a time by melseq_prism.mk. The run then takes about as long
+# as the slowest single sample, rather than the sum of the slowest sample of each stage.
+#
+# The stream file (written by melseq_prism.sh -a stream) has one line per sample and stage, in stage order, of
+#
+# sample <tab> stage <tab> bindings <tab> command
+#
+# where bindings are optional, space-separated name=pattern pairs, for files whose names are only known once the
+# previous stages are done - e.g. results=/.../blast/X.non-redundant.fasta.*.results.gz . Just before the command is run,
+# each pattern is matched, and {name} in the command is replaced by the (first) matching file, and {name_base} by its
+# name without the part of the pattern after the last wildcard (e.g. X.non-redundant.fasta.blastn.GTDB1...)
+#
+# Each command is written to a command file in the work folder, and run by the launcher of its stage (e.g. tardis -c 1
+# ... source _condition_text_input_{command_file}) - by default /bin/sh {command_file}. At most -j commands are run at
+# once, those of samples furthest through the stages first. A done marker is written for each sample and stage, so that
+# a restart carries on from where each sample got to, and when all the samples have done a stage, the stage marker given
+# with -M (e.g. all.trim) is written, as when the stage is run on its own. A sample whose command fails goes no further,
+# but the other samples carry on (as make -k)
+#
+
+POLL_SECONDS = 2
+
+
+class sample_stream_exception(Exception):
+    def __init__(self,args=None):
+        super(sample_stream_exception, self).__init__(args)
+
+
+def read_stream(stream_file):
+    """
+    (samples in order, stages in order, dict of (sample, stage) -> (bindings, command))
+    """
+    (samples, stages, steps) = ([], [], {})
+    with open(stream_file, "r") as stream:
+        for record in stream:
+            fields = record.rstrip("\r\n").split("\t", 3)
+            if len(fields[0].strip()) == 0:
+                continue
+            if len(fields) != 4:
+                raise sample_stream_exception("expected sample, stage, bindings and command in %s" % record)
+            (sample, stage, bindings, command) = fields
+            if sample not in steps:
+                samples.append(sample)
+                steps[sample] = {}
+            if stage not in stages:
+                stages.append(stage)
+            steps[sample][stage] = (bindings.split(), command)
+    for sample in samples:
+        missing = [stage for stage in stages if stage not in steps[sample]]
+        if len(missing) > 0:
+            raise sample_stream_exception("sample %s has no %s command" % (sample, ", ".join(missing)))
+    return (samples, stages, steps)
+
+
+def bind_command(bindings, command):
+    """
+    the command, with the names bound to the files matching their patterns
+    """
+    for binding in bindings:
+        (name, pattern) = binding.split("=", 1)
+        filenames = sorted(glob.glob(pattern))
+        if len(filenames) == 0:
+            raise sample_stream_exception("no file matches %s (for {%s})" % (pattern, name))
+        filename = filenames[0]
+        suffix = pattern.split("*")[-1] if "*" in pattern else ""
+        base = os.path.basename(filename)
+        if len(suffix) > 0 and base.endswith(suffix):
+            base = base[:-len(suffix)]
+        command = command.replace("{%s}" % name, filename).replace("{%s_base}" % name, base)
+    return command
+
+
+def get_step_filename(work_folder, sample, stage, suffix):
+    return os.path.join(work_folder, "%s.%s.%s" % (sample, stage, suffix))
+
+
+def write_marker(filename):
+    with open(filename, "w") as marker_stream:
+        print(time.strftime("%a %b %d %H:%M:%S %Z %Y"), file=marker_stream)
+
+
+def start_step(options, sample, stage, bindings, command):
+    command_file = get_step_filename(options["work_folder"], sample, stage, "sh")
+    with open(command_file, "w") as command_stream:
+        print(bind_command(bindings, command), file=command_stream)
+    launcher = options["launchers"].get(stage, "/bin/sh {command_file}").replace("{command_file}", command_file)
+    log_stream = open(get_step_filename(options["work_folder"], sample, stage, "log"), "w")
+    process = subprocess.Popen(launcher, shell=True, stdout=log_stream, stderr=subprocess.STDOUT)
+    return (process, log_stream)
+
+
+def run_stream(options):
+    (samples, stages, steps) = read_stream(options["stream_file"])
+
+    # carry on from where each sample got to
+    next_stage = {}
+    ready = []
+    for (order, sample) in enumerate(samples):
+        next_stage[sample] = 0
+        while next_stage[sample] < len(stages) and os.path.isfile(get_step_filename(options["work_folder"], sample, stages[next_stage[sample]], "done")):
+            next_stage[sample] += 1
+        if next_stage[sample] < len(stages):
+            heapq.heappush(ready, (-next_stage[sample], order, sample))
+    print("streaming %d samples through %s (%d already done)" % (len(samples), ", ".join(stages), len(samples) - len(ready)), file=sys.stderr)
+
+    stage_done = [sum(1 for sample in samples if next_stage[sample] > i) for i in range(len(stages))]
+    stage_failed = [0] * len(stages)
+
+    def check_stage(i):
+        if stage_done[i] == len(samples) and stages[i] in options["stage_markers"]:
+            write_marker(options["stage_markers"][stages[i]])
+            print("%s done for all samples" % stages[i], file=sys.stderr)
+
+    for i in range(len(stages)):
+        check_stage(i)
+
+    running = {}
+    failed = []
+    while len(ready) > 0 or len(running) > 0:
+        while len(ready) > 0 and len(running) < options["num_jobs"]:
+            (stage_index, order, sample) = heapq.heappop(ready)
+            stage = stages[-stage_index]
+            (bindings, command) = steps[sample][stage]
+            try:
+                (process, log_stream) = start_step(options, sample, stage, bindings, command)
+            except sample_stream_exception as e:
+                print("%s %s : could not start - %s" % (sample, stage, str(e)), file=sys.stderr)
+                failed.append((sample, stage))
+                stage_failed[-stage_index] += 1
+                continue
+            running[process] = (sample, -stage_index, order, log_stream, time.time())
+
+        time.sleep(POLL_SECONDS)
+        for process in [process for process in running if process.poll() is not None]:
+            (sample, i, order, log_stream, started) = running.pop(process)
+            log_stream.close()
+            if process.returncode != 0:
+                print("%s %s : failed (%d) after %.0f seconds - see %s" % (sample, stages[i], process.returncode, time.time() - started,
+                    get_step_filename(options["work_folder"], sample, stages[i], "log")), file=sys.stderr)
+                failed.append((sample, stages[i]))
+                stage_failed[i] += 1
+                continue
+            print("%s %s : done in %.0f seconds" % (sample, stages[i], time.time() - started), file=sys.stderr)
+            write_marker(get_step_filename(options["work_folder"], sample, stages[i], "done"))
+            stage_done[i] += 1
+            check_stage(i)
+            if i + 1 < len(stages):
+                heapq.heappush(ready, (-(i + 1), order, sample))
+
+    for (i, stage) in enumerate(stages):
+        print("%s : %d of %d samples done, %d failed" % (stage, stage_done[i], len(samples), stage_failed[i]), file=sys.stderr)
+    if len(failed) > 0:
+        raise sample_stream_exception("%d samples failed (%s)" % (len(failed), ", ".join("%s at %s" % item for item in failed)))
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+runs each sample through the per-sample stages on its own, so that each sample goes on to its next stage as soon as its previous stage is done
+
+examples :
+
+./sample_stream.py -j 50 -W /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stream -l "trim=tardis -c 1 --hpctype slurm -d /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/trimming --shell-include-file /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/configure_cutadapt_env.src source _condition_text_input_{command_file}" -M trim=/dataset/hiseq/scratch/postprocessing/melseq/SQ1917/all.trim /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stream_units.txt
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('stream_file', type=str, help='stream file - lines of sample <tab> stage <tab> bindings <tab> command')
+    parser.add_argument('-W', '--work_folder', dest='work_folder', type=str, required=True, help='folder for the command files, logs and done markers of each sample and stage')
+    parser.add_argument('-j', '--num_jobs', dest='num_jobs', type=int, default=50, help='maximum number of commands to run at once (default 50)')
+    parser.add_argument('-l', '--launcher', dest='launchers', type=str, action='append', default=[], help='stage=launcher, where the launcher runs {command_file} (default /bin/sh {command_file}) (may be repeated)')
+    parser.add_argument('-M', '--stage_marker', dest='stage_markers', type=str, action='append', default=[], help='stage=file, written when all samples have done the stage (may be repeated)')
+
+    args = vars(parser.parse_args())
+
+    if not os.path.isfile(args["stream_file"]):
+        raise sample_stream_exception("%s is not a file" % args["stream_file"])
+    if not os.path.isdir(args["work_folder"]):
+        raise sample_stream_exception("%s is not a folder" % args["work_folder"])
+    if args["num_jobs"] < 1:
+        raise sample_stream_exception("number of jobs must be at least 1")
+    for option in ("launchers", "stage_markers"):
+        if any("=" not in item for item in args[option]):
+            raise sample_stream_exception("expected stage=value, in %s" % " ".join(args[option]))
+        args[option] = dict(item.split("=", 1) for item in args[option])
+
+    return args
+
+
+def main():
+    options = get_options()
+    run_stream(options)
+
+
+if __name__ == "__main__":
+   main()
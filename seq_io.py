@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import gzip
+import subprocess
+
+#
+# shared sequence and record i/o for the melseq_prism python tools.
+#
+# Everything is bytes, and read in large blocks which are split into lines in one go, rather than line by line -
+# on multi-Gb fasta the per-record overhead of regular expressions, text decoding and small reads dominates.
+#
+# open_input transparently decompresses gzip input (including multi-member files, as written by e.g. bgzip or by
+# concatenating .gz files). Large gzip files are decompressed by pigz (or igzip) in a separate process if one is on the
+# path, which is both parallel and overlaps decompression with parsing. open_output gives a buffered binary stream.
+#
+# the record iterators are
+#
+# line_iter       lines (without the line ending)
+# fasta_iter      (name, sequence) - name without the >, sequence lines joined
+# fastq_iter      (name, sequence, quality) - name without the @
+# sequence_iter   just the sequences of a fasta or fastq stream
+# tabular_iter    lists of tab-separated fields (e.g. blast -outfmt 6)
+#
+
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+PARALLEL_GZIP_MIN_SIZE = 64 * 1024 * 1024      # smaller files are decompressed in-process, as starting a decompressor is not worth it
+PARALLEL_GZIP_COMMANDS = (("pigz", "-dc"), ("igzip", "-dc"))
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class seq_io_exception(Exception):
+    def __init__(self,args=None):
+        super(seq_io_exception, self).__init__(args)
+
+
+def is_gzipped(filename):
+    with open(filename, "rb") as test_stream:
+        return test_stream.read(2) == GZIP_MAGIC
+
+
+def find_executable(name):
+    for folder in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def get_parallel_decompressor():
+    for command in PARALLEL_GZIP_COMMANDS:
+        path = find_executable(command[0])
+        if path is not None:
+            return [path] + list(command[1:])
+    return None
+
+
+class decompressor_stream(object):
+    """
+    the (binary) output of a decompressor process, which is checked for errors when closed
+    """
+    def __init__(self, command, filename):
+        self.filename = filename
+        self.process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, bufsize=READ_BLOCK_SIZE)
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.stdout.close()
+        if self.process.wait() != 0:
+            raise seq_io_exception("error decompressing %s (exit code %d)" % (self.filename, self.process.returncode))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # (the decompressor may be blocked writing, if we stopped reading)
+            self.process.kill()
+            self.process.wait()
+        return False
+
+
+def open_input(filename, parallel=True):
+    """
+    open a plain or gzipped file (or - for stdin) for reading as bytes. (We check the gzip magic number, rather than
+    the name, as the pipeline's file names do not reliably say whether they are compressed)
+    """
+    if filename == "-":
+        return getattr(sys.stdin, "buffer", sys.stdin)
+    if not is_gzipped(filename):
+        return open(filename, "rb", READ_BLOCK_SIZE)
+    if parallel and os.path.getsize(filename) >= PARALLEL_GZIP_MIN_SIZE:
+        command = get_parallel_decompressor()
+        if command is not None:
+            return decompressor_stream(command, filename)
+    return gzip.open(filename, "rb")
+
+
+def open_output(filename=None, compress=False):
+    """
+    open a buffered binary output stream (stdout if filename is None or -)
+    """
+    if filename is None or filename == "-":
+        return getattr(sys.stdout, "buffer", sys.stdout)
+    if compress:
+        return gzip.open(filename, "wb")
+    return open(filename, "wb", WRITE_BUFFER_SIZE)
+
+
+def block_iter(stream, block_size=READ_BLOCK_SIZE):
+    block = stream.read(block_size)
+    while len(block) > 0:
+        yield block
+        block = stream.read(block_size)
+
+
+def line_iter(stream):
+    """
+    yield the lines of a binary stream, without the line ending (\\n or \\r\\n). Each block is split in one go, and
+    only the partial line at the end of each block is carried over
+    """
+    partial = b""
+    for block in block_iter(stream):
+        lines = (partial + block).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            if line[-1:] == b"\r":
+                line = line[:-1]
+            yield line
+    if len(partial) > 0:
+        yield partial.rstrip(b"\r")
+
+
+def count_lines(stream):
+    return sum(block.count(b"\n") for block in block_iter(stream))
+
+
+def fasta_iter(stream):
+    """
+    yield (name, sequence) - the name is the whole name line without the >, and multi-line sequences are joined
+    """
+    name = None
+    seq_lines = []
+    for line in line_iter(stream):
+        if line[0:1] == b">":
+            if name is not None:
+                yield (name, b"".join(seq_lines))
+            name = line[1:]
+            seq_lines = []
+        elif name is not None:
+            seq_lines.append(line)
+    if name is not None:
+        yield (name, b"".join(seq_lines))
+
+
+def fastq_iter(stream):
+    """
+    yield (name, sequence, quality) from (4 line) fastq - the name is the whole name line without the @
+    """
+    lines = line_iter(stream)
+    for name in lines:
+        if len(name) == 0:
+            continue
+        if name[0:1] != b"@":
+            raise seq_io_exception("expected a fastq name line, but found %s" % name[0:80])
+        seq = next(lines, b"")
+        next(lines, None)
+        yield (name[1:], seq, next(lines, b""))
+
+
+def sequence_iter(stream):
+    """
+    yield the sequences from fastq (every 4th line, from the 2nd) or fasta (every line that is not a name line - as
+    grep -v ">" in countUniqueReads.sh, so that multi-line sequences are not joined)
+    """
+    lines = line_iter(stream)
+    first = next(lines, None)
+    if first is None:
+        return
+    if first[0:1] == b"@":
+        seq = next(lines, None)
+        while seq is not None:
+            yield seq
+            next(lines, None)
+            next(lines, None)
+            next(lines, None)
+            seq = next(lines, None)
+    else:
+        if first[0:1] != b">":
+            yield first
+        for line in lines:
+            if line[0:1] != b">":
+                yield line
+
+
+def tabular_iter(stream, max_split=-1):
+    """
+    yield the tab-separated fields of each non-empty line
+    """
+    for line in line_iter(stream):
+        if len(line) > 0:
+            yield line.split(b"\t", max_split)
+
+
+def get_count(name):
+    """
+    parse the count from a non-redundant sequence name - e.g. Sequence59_count=2 => 2
+    """
+    tokens = name.split(b"count=")
+    if len(tokens) < 2:
+        raise seq_io_exception("unable to parse count from %s" % name)
+    return int(tokens[1].split()[0])
+
+
+def write_fasta(out_stream, name, seq):
+    out_stream.write(b">" + name + b"\n" + seq + b"\n")
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import glob
+import time
+import json
+import fcntl
+import hashlib
+import argparse
+
+#
+# per-sample, per-stage manifest of completed work, so that a rerun of a stage only redoes the samples whose inputs
+# or parameters have changed, or whose outputs are missing or have been changed since.
+#
+# Each stage is described by a units file, with one line per unit of work (usually a sample) of
+#
+# inputs <tab> outputs <tab> command
+#
+# where inputs and outputs are space-separated file names (outputs may be glob patterns - e.g. for blast results, whose
+# full names are decided by align_prism), and the command is optional. filter writes the commands (or with -L, the
+# inputs) of the units which are not current, each followed by a record step, so that when the command succeeds, a
+# record of the unit is appended to the manifest (one JSON record per line, under an exclusive lock - as stage_metrics.py)
+# e.g.
+#
+#{"stage": "format", "unit": "3f1c...", "params": "9a0b...", "inputs": [["/.../x.fastq", 81234, 1690000000123, "5d41..."]], "outputs": [["/.../x.non-redundant.fasta", 1234, 1690000001456]], ...}
+#
+# A unit is current if its latest record has the same parameters, its inputs have the same content (the content digest
+# is only recomputed if the size or modification time of an input has changed, so that a check is cheap) and its outputs
+# still exist, unchanged. The parameters are a digest of the -p strings, the command, and the names, sizes and modification
+# times of any -P files (e.g. the blast database, taxonomiser, tag index).
+#
+# With -a (adopt), a unit with no record whose outputs all exist and are newer than its inputs is taken to be current
+# (and recorded), so that existing results are not redone the first time a stage is run with a manifest
+#
+
+DIGEST_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class stage_manifest_exception(Exception):
+    def __init__(self,args=None):
+        super(stage_manifest_exception, self).__init__(args)
+
+
+def get_file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as digest_stream:
+        block = digest_stream.read(DIGEST_BLOCK_SIZE)
+        while len(block) > 0:
+            digest.update(block)
+            block = digest_stream.read(DIGEST_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def get_stat(filename):
+    """
+    (size, modification time in milliseconds), or None if the file does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_size, int(stat.st_mtime * 1000))
+
+
+def get_unit_id(stage, inputs, outputs):
+    return hashlib.sha1(("%s\t%s\t%s" % (stage, " ".join(inputs), " ".join(outputs))).encode()).hexdigest()[0:16]
+
+
+def get_params_digest(params, command, param_files):
+    digest = hashlib.sha1()
+    for param in params:
+        digest.update(("p\t%s\n" % param).encode())
+    digest.update(("c\t%s\n" % command).encode())
+    for pattern in param_files:
+        for filename in sorted(glob.glob(pattern)) or [pattern]:
+            digest.update(("f\t%s\t%s\n" % (filename, get_stat(filename))).encode())
+    return digest.hexdigest()
+
+
+def read_units(units_file):
+    """
+    yield (inputs, outputs, command) from a units file
+    """
+    with open(units_file, "r") as units_stream:
+        for record in units_stream:
+            fields = record.rstrip("\r\n").split("\t", 2)
+            if len(fields[0].strip()) == 0:
+                continue
+            fields += [""] * (3 - len(fields))
+            yield (fields[0].split(), fields[1].split(), fields[2])
+
+
+def read_manifest(manifest_file, stage):
+    """
+    the latest record of each unit of a stage
+    """
+    records = {}
+    if not os.path.isfile(manifest_file):
+        return records
+    with open(manifest_file, "r") as manifest_stream:
+        for record in manifest_stream:
+            try:
+                unit_record = json.loads(record)
+            except ValueError:
+                continue        # (e.g. a partly written record)
+            if unit_record.get("stage") == stage:
+                records[unit_record["unit"]] = unit_record
+    return records
+
+
+def append_records(manifest_file, records):
+    with open(manifest_file, "a") as manifest_stream:
+        fcntl.flock(manifest_stream.fileno(), fcntl.LOCK_EX)
+        try:
+            for record in records:
+                manifest_stream.write(json.dumps(record, sort_keys=True) + "\n")
+            manifest_stream.flush()
+        finally:
+            fcntl.flock(manifest_stream.fileno(), fcntl.LOCK_UN)
+
+
+def get_pending_filename(manifest_file, stage):
+    return "%s.%s.pending" % (manifest_file, stage)
+
+
+def is_current(unit_record, params_digest):
+    """
+    whether the recorded unit has the same parameters, the same input content, and unchanged outputs
+    """
+    if unit_record is None or unit_record.get("params") != params_digest:
+        return False
+    for (filename, size, mtime) in unit_record["outputs"]:
+        if get_stat(filename) != (size, mtime):
+            return False
+    for (filename, size, mtime, digest) in unit_record["inputs"]:
+        stat = get_stat(filename)
+        if stat is None:
+            return False
+        if stat != (size, mtime) and get_file_digest(filename) != digest:
+            return False
+    return True
+
+
+def can_adopt(inputs, outputs):
+    """
+    whether all the outputs exist, and are newer than all the inputs (as make would decide)
+    """
+    output_files = [filename for pattern in outputs for filename in glob.glob(pattern)]
+    if len(output_files) == 0 or any(len(glob.glob(pattern)) == 0 for pattern in outputs):
+        return False
+    input_stats = [get_stat(filename) for filename in inputs]
+    if any(stat is None for stat in input_stats):
+        return False
+    newest_input = max([stat[1] for stat in input_stats] + [0])
+    return all(get_stat(filename)[1] >= newest_input for filename in output_files)
+
+
+def get_unit_record(stage, unit, params_digest):
+    """
+    a manifest record of a unit that has just been done - the outputs (patterns) must all exist
+    """
+    outputs = []
+    for pattern in unit["outputs"]:
+        filenames = sorted(glob.glob(pattern))
+        if len(filenames) == 0:
+            raise stage_manifest_exception("output %s of %s does not exist" % (pattern, " ".join(unit["inputs"])))
+        outputs += [[filename] + list(get_stat(filename)) for filename in filenames]
+    inputs = []
+    for filename in unit["inputs"]:
+        stat = get_stat(filename)
+        if stat is None:
+            raise stage_manifest_exception("input %s does not exist" % filename)
+        inputs.append([filename] + list(stat) + [get_file_digest(filename)])
+    return {"stage": stage, "unit": unit["unit"], "params": params_digest, "inputs": inputs, "outputs": outputs, "recorded": time.time()}
+
+
+def filter_units(options):
+    """
+    write the commands (or inputs) of the units which are not current, and note them as pending, for the record step
+    """
+    records = read_manifest(options["manifest_file"], options["stage"])
+    script = os.path.realpath(__file__)
+    (current_count, adopted) = (0, [])
+    pending = []
+    with open(options["output_file"], "w") as out_stream:
+        for (inputs, outputs, command) in read_units(options["units_file"]):
+            unit = {"unit": get_unit_id(options["stage"], inputs, outputs), "inputs": inputs, "outputs": outputs}
+            params_digest = get_params_digest(options["params"], command, options["param_files"])
+            if not options["force"]:
+                if is_current(records.get(unit["unit"]), params_digest):
+                    current_count += 1
+                    continue
+                if options["adopt"] and unit["unit"] not in records and can_adopt(inputs, outputs):
+                    adopted.append(get_unit_record(options["stage"], unit, params_digest))
+                    continue
+            unit["params"] = params_digest
+            pending.append(unit)
+            if options["list_inputs"]:
+                for filename in inputs:
+                    print(filename, file=out_stream)
+            else:
+                print("%s && python %s -t record -m %s -s %s -u %s" % (command, script, options["manifest_file"], options["stage"], unit["unit"]), file=out_stream)
+
+    with open(get_pending_filename(options["manifest_file"], options["stage"]), "w") as pending_stream:
+        for unit in pending:
+            print(json.dumps(unit, sort_keys=True), file=pending_stream)
+    if len(adopted) > 0:
+        append_records(options["manifest_file"], adopted)
+
+    print("%s : %d units current, %d adopted, %d to do" % (options["stage"], current_count, len(adopted), len(pending)), file=sys.stderr)
+
+
+def record_units(options):
+    """
+    record units which have been done - those given, or else all the pending units of the stage whose outputs exist
+    """
+    pending = {}
+    pending_filename = get_pending_filename(options["manifest_file"], options["stage"])
+    if os.path.isfile(pending_filename):
+        with open(pending_filename, "r") as pending_stream:
+            for record in pending_stream:
+                unit = json.loads(record)
+                pending[unit["unit"]] = unit
+
+    records = []
+    if len(options["units"]) > 0:
+        for unit_id in options["units"]:
+            if unit_id not in pending:
+                raise stage_manifest_exception("%s is not a pending unit of %s (in %s)" % (unit_id, options["stage"], pending_filename))
+            records.append(get_unit_record(options["stage"], pending[unit_id], pending[unit_id]["params"]))
+    else:
+        for unit in pending.values():
+            try:
+                records.append(get_unit_record(options["stage"], unit, unit["params"]))
+            except stage_manifest_exception as e:
+                print("not recording : %s" % str(e), file=sys.stderr)
+    append_records(options["manifest_file"], records)
+    print("%s : recorded %d units" % (options["stage"], len(records)), file=sys.stderr)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+per-sample manifest of completed stage work, so that reruns only redo the samples whose inputs, parameters or outputs have changed
+
+examples :
+
+# write the summary commands of the samples which are not current (each followed by a record step)
+./stage_manifest.py -t filter -m /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stage_manifest.jsonl -s summarise -p expanded -P /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summarize_counts.py -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summary_commands.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summary_units.txt
+
+# list the blast inputs which are not current, and after blasting them, record all of those that now have results
+./stage_manifest.py -t filter -L -m /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stage_manifest.jsonl -s blast --params="-task blastn -word_size 16 -evalue 0.02" -P "/dataset/gseq_processing/scratch/melseq/gtdb/GTDB1.*" -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast_file_list.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/blast_units.txt
+./stage_manifest.py -t record -m /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stage_manifest.jsonl -s blast
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('units_file', type=str, nargs="?", default=None, help='units file (filter) - lines of inputs <tab> outputs <tab> command')
+    parser.add_argument('-t', '--task' , dest='task', required=True, type=str, choices=["filter", "record"], help="what you want to do")
+    parser.add_argument('-m', '--manifest_file', dest='manifest_file', type=str, required=True, help='manifest file (appended to)')
+    parser.add_argument('-s', '--stage', dest='stage', type=str, required=True, help='stage name')
+    parser.add_argument('-p', '--params', dest='params', type=str, action='append', default=[], help='parameters of the stage (filter) (may be repeated)')
+    parser.add_argument('-P', '--param_files', dest='param_files', type=str, action='append', default=[], help='file (or glob pattern) the stage depends on - e.g. database, script (filter) (may be repeated)')
+    parser.add_argument('-O', '--output_file', dest='output_file', type=str, default=None, help='file to write the commands (or inputs) of the units to do to (filter)')
+    parser.add_argument('-L', '--list_inputs', dest='list_inputs', action='store_true', default=False, help='write the inputs of the units to do, rather than their commands (filter)')
+    parser.add_argument('-a', '--adopt', dest='adopt', action='store_true', default=False, help='take units with no record, whose outputs exist and are newer than the inputs, to be current (filter)')
+    parser.add_argument('-f', '--force', dest='force', action='store_true', default=False, help='do all the units, regardless of the manifest (filter)')
+    parser.add_argument('-u', '--unit', dest='units', type=str, action='append', default=[], help='pending unit to record (record) (default all pending units whose outputs exist) (may be repeated)')
+
+    args = vars(parser.parse_args())
+
+    if args["task"] == "filter":
+        if args["units_file"] is None or not os.path.isfile(args["units_file"]):
+            raise stage_manifest_exception("filter requires a units file")
+        if args["output_file"] is None:
+            raise stage_manifest_exception("filter requires an output file (-O)")
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    if options["task"] == "filter":
+        filter_units(options)
+    elif options["task"] == "record":
+        record_units(options)
+    else:
+        raise stage_manifest_exception("unsupported task %(task)s" % options)
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import re
+import time
+import json
+import gzip
+import fcntl
+import socket
+import resource
+import subprocess
+import argparse
+
+#
+# per-stage, per-sample performance metrics for the melseq_prism stages.
+#
+# run wraps a command (a stage script, or one line of a stage command file), and appends one JSON record to a
+# metrics file (one record per line, written under an exclusive lock, as many tardis jobs append to the same file) e.g.
+#
+#{"stage": "format", "sample": "966045_CAACTGACTG_psti.R1", "wall_seconds": 41.2, "cpu_seconds": 39.8, "max_rss_mb": 812.4, ...}
+#
+# The command is run by the shell, and its exit code is passed back. CPU time and peak memory are for the command and
+# everything it starts (getrusage of the children), and read / written bytes are all bytes passed through read and write
+# calls (from /proc/self/io, so linux only - this includes pipes). Input and output file sizes (and optionally the number
+# of records in the outputs) are recorded for any files named with -i and -o. The tardis chunk is identified by the slurm
+# job and array task ids (if set), host and working folder
+#
+# report summarises one or more metrics files as per-stage throughput tables, and lists the slowest samples - and given
+# the metrics of a previous run as a baseline, the stages that have become slower
+#
+
+SAMPLE_KEY_REGEXP = "demultiplexed_([^.]+\.R\d)"
+
+
+class stage_metrics_exception(Exception):
+    def __init__(self,args=None):
+        super(stage_metrics_exception, self).__init__(args)
+
+
+def get_io_counts():
+    """
+    bytes read and written by this process, and the children it has waited for (linux only - otherwise None)
+    """
+    try:
+        with open("/proc/self/io", "r") as io_stream:
+            io_counts = dict(record.strip().split(": ") for record in io_stream if ":" in record)
+        return (int(io_counts["rchar"]), int(io_counts["wchar"]))
+    except (IOError, OSError, KeyError, ValueError):
+        return (None, None)
+
+
+def get_sample(options):
+    """
+    the sample as given, or else parsed from the inputs, outputs or command e.g.
+    ...SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq... => 966045_CAACTGACTG_psti.R1
+    (or failing that, the name of the first input or output). None means the record is for a whole stage
+    """
+    if options["sample"] is not None:
+        return options["sample"]
+    for text in options["inputs"] + options["outputs"] + [" ".join(options["command"])]:
+        match = re.search(SAMPLE_KEY_REGEXP, text)
+        if match is not None:
+            return match.groups()[0]
+    for filename in options["inputs"] + options["outputs"]:
+        return os.path.basename(filename)
+    return None
+
+
+def count_records(filename):
+    """
+    number of records in a fasta (name lines), fastq (lines / 4) or other (lines) file, optionally compressed with gzip
+    """
+    with open(filename, "rb") as test_stream:
+        magic = test_stream.read(2)
+    opener = gzip.open if magic == b"\x1f\x8b" else open
+    lines = 0
+    names = 0
+    first = None
+    with opener(filename, "rb") as record_stream:
+        for record in record_stream:
+            if first is None:
+                first = record[0:1]
+            lines += 1
+            if record[0:1] == b">":
+                names += 1
+    if first == b">":
+        return names
+    elif first == b"@":
+        return lines // 4
+    return lines
+
+
+def get_file_sizes(filenames):
+    return sum(os.path.getsize(filename) for filename in filenames if os.path.isfile(filename))
+
+
+def append_record(metrics_file, record):
+    with open(metrics_file, "a") as metrics_stream:
+        fcntl.flock(metrics_stream.fileno(), fcntl.LOCK_EX)
+        try:
+            metrics_stream.write(json.dumps(record, sort_keys=True) + "\n")
+            metrics_stream.flush()
+        finally:
+            fcntl.flock(metrics_stream.fileno(), fcntl.LOCK_UN)
+
+
+def run(options):
+    command = " ".join(options["command"])
+
+    (read_before, written_before) = get_io_counts()
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    exit_code = subprocess.call(command, shell=True)
+    end = time.time()
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    (read_after, written_after) = get_io_counts()
+
+    record = {
+        "stage": options["stage"],
+        "sample": get_sample(options),
+        "command": command,
+        "exit_code": exit_code,
+        "start": start,
+        "wall_seconds": round(end - start, 3),
+        "cpu_seconds": round((usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime), 3),
+        "max_rss_mb": round(usage_after.ru_maxrss / 1024.0, 1),    # (ru_maxrss is in kilobytes on linux)
+        "read_bytes": None if read_before is None else read_after - read_before,
+        "written_bytes": None if written_before is None else written_after - written_before,
+        "input_files": len(options["inputs"]),
+        "input_bytes": get_file_sizes(options["inputs"]),
+        "output_files": len(options["outputs"]),
+        "output_bytes": get_file_sizes(options["outputs"]),
+        "output_records": None,
+        "job": os.environ.get("SLURM_ARRAY_JOB_ID", os.environ.get("SLURM_JOB_ID")),
+        "chunk": os.environ.get("SLURM_ARRAY_TASK_ID"),
+        "host": socket.gethostname(),
+        "workdir": os.getcwd()
+    }
+    if options["count_records"] and exit_code == 0:
+        record["output_records"] = sum(count_records(filename) for filename in options["outputs"] if os.path.isfile(filename))
+
+    append_record(options["metrics_file"], record)
+    return exit_code
+
+
+def read_metrics(metrics_file):
+    """
+    read a metrics file, keeping only the latest record for each stage and sample (so that stages that are
+    re-run are not counted twice)
+    """
+    latest = {}
+    with open(metrics_file, "r") as metrics_stream:
+        for record in metrics_stream:
+            if len(record.strip()) == 0:
+                continue
+            try:
+                metrics = json.loads(record)
+            except ValueError:
+                print("warning, skipping unparseable record in %s : %s" % (metrics_file, record.strip()), file=sys.stderr)
+                continue
+            key = (metrics["stage"], metrics["sample"])
+            if key not in latest or metrics["start"] >= latest[key]["start"]:
+                latest[key] = metrics
+    return list(latest.values())
+
+
+def sum_field(records, field):
+    values = [record[field] for record in records if record.get(field) is not None]
+    if len(values) == 0:
+        return None
+    return sum(values)
+
+
+def format_value(value, fmt="%.1f"):
+    if value is None:
+        return "-"
+    return fmt % value
+
+
+def get_stage_summaries(records):
+    """
+    per-stage totals and throughputs. Stage level records (the stage scripts, with no sample) are summarised separately
+    from the per-sample records
+    """
+    stages = {}
+    for record in records:
+        scope = "samples" if record["sample"] is not None else "stage"
+        stages.setdefault((record["stage"], scope), []).append(record)
+
+    summaries = []
+    for ((stage, scope), stage_records) in stages.items():
+        wall = sum_field(stage_records, "wall_seconds")
+        summary = {
+            "stage": stage,
+            "scope": scope,
+            "runs": len(stage_records),
+            "failed": len([record for record in stage_records if record["exit_code"] != 0]),
+            "wall_seconds": wall,
+            "cpu_seconds": sum_field(stage_records, "cpu_seconds"),
+            "max_rss_mb": max(record["max_rss_mb"] for record in stage_records),
+            "input_mb": sum_field(stage_records, "input_bytes") / 1048576.0,
+            "output_mb": sum_field(stage_records, "output_bytes") / 1048576.0,
+            "output_records": sum_field(stage_records, "output_records"),
+            "first_start": min(record["start"] for record in stage_records),
+            "last_end": max(record["start"] + record["wall_seconds"] for record in stage_records)
+        }
+        read_bytes = sum_field(stage_records, "read_bytes")
+        summary["read_mb"] = None if read_bytes is None else read_bytes / 1048576.0
+        summary["elapsed_seconds"] = summary["last_end"] - summary["first_start"]
+        summary["mean_wall_seconds"] = wall / len(stage_records)
+        summary["input_mb_per_second"] = summary["input_mb"] / wall if wall > 0 and summary["input_mb"] > 0 else None
+        summary["read_mb_per_second"] = summary["read_mb"] / wall if wall > 0 and summary["read_mb"] is not None else None
+        summary["records_per_second"] = summary["output_records"] / wall if wall > 0 and summary["output_records"] is not None else None
+        summaries.append(summary)
+
+    return sorted(summaries, key=lambda summary: (summary["first_start"], summary["scope"]))
+
+
+def report(options):
+    records = []
+    for metrics_file in options["command"]:
+        records += read_metrics(metrics_file)
+    summaries = get_stage_summaries(records)
+
+    print("stage throughput\n")
+    print("\t".join(["stage", "scope", "runs", "failed", "elapsed_s", "wall_s", "mean_wall_s", "cpu_s", "max_rss_mb", "input_mb", "output_mb", "read_mb", "input_mb_per_s", "read_mb_per_s", "output_records", "records_per_s"]))
+    for summary in summaries:
+        print("\t".join([summary["stage"], summary["scope"], str(summary["runs"]), str(summary["failed"]),
+            format_value(summary["elapsed_seconds"]), format_value(summary["wall_seconds"]), format_value(summary["mean_wall_seconds"]),
+            format_value(summary["cpu_seconds"]), format_value(summary["max_rss_mb"]), format_value(summary["input_mb"]),
+            format_value(summary["output_mb"]), format_value(summary["read_mb"]), format_value(summary["input_mb_per_second"], "%.2f"),
+            format_value(summary["read_mb_per_second"], "%.2f"), format_value(summary["output_records"], "%d"),
+            format_value(summary["records_per_second"], "%.1f")]))
+
+    print("\nslowest samples\n")
+    print("\t".join(["stage", "sample", "wall_s", "cpu_s", "max_rss_mb", "input_mb", "output_records", "job", "chunk", "host"]))
+    sample_records = sorted([record for record in records if record["sample"] is not None], key=lambda record: record["wall_seconds"], reverse=True)
+    for record in sample_records[0:options["top"]]:
+        print("\t".join([record["stage"], record["sample"], format_value(record["wall_seconds"]), format_value(record["cpu_seconds"]),
+            format_value(record["max_rss_mb"]), format_value(record["input_bytes"] / 1048576.0), format_value(record["output_records"], "%d"),
+            str(record["job"]), str(record["chunk"]), str(record["host"])]))
+
+    if options["baseline_file"] is not None:
+        # compare the mean time per run (i.e. per sample, for the per-sample records), as the runs may have different numbers of samples
+        baseline = dict(((summary["stage"], summary["scope"]), summary) for summary in get_stage_summaries(read_metrics(options["baseline_file"])))
+        print("\ncompared with %s\n" % options["baseline_file"])
+        print("\t".join(["stage", "scope", "baseline_mean_wall_s", "mean_wall_s", "ratio", "baseline_max_rss_mb", "max_rss_mb", "flag"]))
+        for summary in summaries:
+            previous = baseline.get((summary["stage"], summary["scope"]))
+            if previous is None:
+                continue
+            ratio = summary["mean_wall_seconds"] / previous["mean_wall_seconds"] if previous["mean_wall_seconds"] > 0 else None
+            flag = "SLOWER" if ratio is not None and ratio > options["regression_ratio"] else ""
+            print("\t".join([summary["stage"], summary["scope"], format_value(previous["mean_wall_seconds"]), format_value(summary["mean_wall_seconds"]),
+                format_value(ratio, "%.2f"), format_value(previous["max_rss_mb"]), format_value(summary["max_rss_mb"]), flag]))
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+records per-stage, per-sample performance metrics (wall and cpu time, peak memory, bytes and records in and out) of the
+melseq_prism stages, and reports on them
+
+examples :
+
+# run a command, appending its metrics to stage_metrics.jsonl (the command is everything after -- , and is run by the shell)
+./stage_metrics.py -t run -m /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stage_metrics.jsonl -s format -i /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/trimming/SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq -o /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta --count_records -- "./dereplicate_fastq.py -o /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/trimming/SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq"
+
+# summarise the metrics of a run
+./stage_metrics.py -t report /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stage_metrics.jsonl
+
+# and compare with a previous run
+./stage_metrics.py -t report -B /dataset/hiseq/scratch/postprocessing/melseq/SQ1738/stage_metrics.jsonl /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/stage_metrics.jsonl
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', type=str, nargs=argparse.REMAINDER, help='command to run (run), or metrics files (report)')
+    parser.add_argument('-t', '--task', dest='task', type=str, default="run", choices=["run", "report"], help="what you want to do")
+    parser.add_argument('-m', '--metrics_file', dest='metrics_file', type=str, default=None, help='metrics file to append to (run)')
+    parser.add_argument('-s', '--stage', dest='stage', type=str, default=None, help='stage name (run)')
+    parser.add_argument('-S', '--sample', dest='sample', type=str, default=None, help='sample name (run) - if not given, parsed from the inputs, outputs or command, if possible')
+    parser.add_argument('-i', '--input', dest='inputs', type=str, action='append', default=[], help='input file of the command (run) - may be repeated')
+    parser.add_argument('-o', '--output', dest='outputs', type=str, action='append', default=[], help='output file of the command (run) - may be repeated')
+    parser.add_argument('--count_records', dest='count_records', action='store_true', default=False, help='count the records in the output files (run)')
+    parser.add_argument('-B', '--baseline_file', dest='baseline_file', type=str, default=None, help='metrics file of a previous run to compare with (report)')
+    parser.add_argument('-n', '--top', dest='top', type=int, default=20, help='number of slowest samples to list (report) (default 20)')
+    parser.add_argument('--regression_ratio', dest='regression_ratio', type=float, default=1.2, help='flag stages whose mean time per run is more than this multiple of the baseline (report) (default 1.2)')
+
+    args = vars(parser.parse_args())
+
+    if len(args["command"]) > 0 and args["command"][0] == "--":
+        args["command"] = args["command"][1:]
+    if len(args["command"]) == 0:
+        raise stage_metrics_exception("nothing to do - need a command (run) or metrics files (report)")
+
+    if args["task"] == "run":
+        if args["metrics_file"] is None or args["stage"] is None:
+            raise stage_metrics_exception("run requires a metrics file (-m) and stage (-s)")
+    elif args["task"] == "report":
+        for filename in args["command"]:
+            if not os.path.isfile(filename):
+                raise stage_metrics_exception("%s is not a file" % filename)
+        if args["baseline_file"] is not None and not os.path.isfile(args["baseline_file"]):
+            raise stage_metrics_exception("%(baseline_file)s is not a file" % args)
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    if options["task"] == "run":
+        sys.exit(run(options))
+    elif options["task"] == "report":
+        report(options)
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import os
+import argparse
+import seq_io
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "gtdb"))    # for tag_index, when run from the source folder
+import tag_index
+
+#
+# fast path for blast - assigns the sequences of each non-redundant fasta file which exactly match a restriction tag
+# of the reference genomes, using the tag -> LCA lineage index compiled by gtdb/format_database.py -t build_tag_index
+# (see gtdb/tag_index.py), so that only the unmatched sequences need to be blasted.
+#
+# classify writes, for each input fasta,
+#
+# * the unmatched sequences, to a fasta file of the same name in the misses folder - these are blasted as usual
+# * the assigned sequences, to <input fasta name>.tag_assignments.txt in the assignments folder, e.g.
+#
+#Sequence59_count=2      Bacteria        Firmicutes_A    Clostridia      Christensenellales      CAG-74  GCA-900199385   GCA-900199385 sp902764875
+#
+# and append_summary then appends these to the summary of the blasted sequences, in the same (expanded or collapsed)
+# format as gtdb/summarize_counts.py.
+#
+# Note that a sequence is only assigned here if its tag occurs exactly in the reference genomes, and it is assigned to
+# the LCA of the genomes containing that exact tag - whereas blast would also consider near matches (within 10% of the
+# best bitscore) in other genomes, and so can give a less specific LCA for the same sequence
+#
+
+
+class tag_lookup_exception(Exception):
+    def __init__(self,args=None):
+        super(tag_lookup_exception, self).__init__(args)
+
+
+def get_assignments_filename(fasta_file, assignments_folder):
+    return os.path.join(assignments_folder, "%s.tag_assignments.txt" % os.path.basename(fasta_file))
+
+
+def classify(options):
+    """
+    split each input fasta into the sequences assigned from the tag index, and those to blast
+    """
+    index = tag_index.tag_index(options["tag_index"])
+    print("loaded %d tags (%s, %d bases) from %s" % (len(index), index.site, index.tag_length, options["tag_index"]), file=sys.stderr)
+
+    (total_sequences, total_assigned, total_reads, total_assigned_reads) = (0, 0, 0, 0)
+    for fasta_file in options["filenames"]:
+        (sequences, assigned, reads, assigned_reads) = (0, 0, 0, 0)
+        with seq_io.open_input(fasta_file) as fasta_stream, \
+                seq_io.open_output(os.path.join(options["output_folder"], os.path.basename(fasta_file))) as misses_stream, \
+                seq_io.open_output(get_assignments_filename(fasta_file, options["assignments_folder"])) as assignments_stream:
+            for (name, seq) in seq_io.fasta_iter(fasta_stream):
+                qseqid = name.strip().split()[0]
+                count = seq_io.get_count(qseqid)
+                sequences += 1
+                reads += count
+                lineage = index.get(seq)
+                if lineage is None:
+                    seq_io.write_fasta(misses_stream, qseqid, seq)
+                else:
+                    assigned += 1
+                    assigned_reads += count
+                    ranks = "\t".join(lineage)
+                    if not isinstance(ranks, bytes):
+                        ranks = ranks.encode("utf-8")
+                    assignments_stream.write(qseqid + b"\t" + ranks + b"\n")
+        print("%s : %d of %d sequences (%d of %d reads) assigned from the tag index" % (fasta_file, assigned, sequences, assigned_reads, reads), file=sys.stderr)
+        total_sequences += sequences
+        total_assigned += assigned
+        total_reads += reads
+        total_assigned_reads += assigned_reads
+
+    print("tag lookup : %d of %d sequences (%.1f%%), %d of %d reads (%.1f%%) assigned from the tag index - %d sequences to blast" % (total_assigned,
+        total_sequences, 100.0 * total_assigned / max(1, total_sequences), total_assigned_reads, total_reads, 100.0 * total_assigned_reads / max(1, total_reads),
+        total_sequences - total_assigned), file=sys.stderr)
+    index.close()
+
+
+def append_summary(options):
+    """
+    append the tag assignments to a summary written by the taxonomiser - cloned to match the count in the sequence
+    name (expanded), or once with the count appended (collapsed)
+    """
+    (summary_file,) = options["filenames"]
+    assigned = 0
+    with seq_io.open_input(options["assignments_file"]) as assignments_stream, open(summary_file, "ab") as summary_stream:
+        for record in seq_io.line_iter(assignments_stream):
+            if len(record) == 0:
+                continue
+            count = seq_io.get_count(record.split(b"\t", 1)[0])
+            if options["summary_format"] == "collapsed":
+                summary_stream.write(record + b"\t" + str(count).encode() + b"\n")
+            else:
+                summary_stream.write((record + b"\n") * count)
+            assigned += 1
+    print("appended %d tag assignments from %s to %s" % (assigned, options["assignments_file"], summary_file), file=sys.stderr)
+
+
+def get_options():
+    description = """
+    """
+    long_description = """
+assigns sequences which exactly match a restriction tag of the reference genomes, so that only the rest need to be blasted
+
+examples :
+
+# write the sequences to blast to tag_index_misses/, and the assignments to tag_index_assignments/
+./tag_lookup.py -t classify -X /dataset/gseq_processing/scratch/melseq/gtdb/GTDB1_PstI.tags -O /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/tag_index_misses -A /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/tag_index_assignments /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/fasta/*.non-redundant.fasta
+
+# add the assignments of a sample to its summary
+./tag_lookup.py -t append_summary -F expanded -A /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/tag_index_assignments/SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta.tag_assignments.txt /dataset/hiseq/scratch/postprocessing/melseq/SQ1917/summary/SQ1917_HGT5JDRX2_s_merged_fastq.txt.gz.demultiplexed_966045_CAACTGACTG_psti.R1_trimmed.fastq.non-redundant.fasta.blastn.GTDB1.num_threads4taskblastnword_size16outfmt6stdqlenevalue0.02.summary
+
+    """
+    parser = argparse.ArgumentParser(description=description, epilog=long_description, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames', type=str, nargs="+", help='non-redundant fasta files (classify), or a summary file (append_summary)')
+    parser.add_argument('-t', '--task' , dest='task', required=True, type=str, choices=["classify", "append_summary"], help="what you want to do")
+    parser.add_argument('-X', '--tag_index', dest='tag_index', type=str, default=None, help='tag index compiled by gtdb/format_database.py -t build_tag_index (classify)')
+    parser.add_argument('-O', '--output_folder', dest='output_folder', type=str, default=None, help='folder to write the sequences to blast to (classify)')
+    parser.add_argument('-A', '--assignments', dest='assignments', type=str, default=None, help='folder to write the assignments to (classify), or the assignments file to append (append_summary)')
+    parser.add_argument('-F', '--summary_format', dest='summary_format', type=str, default="expanded", choices=["expanded", "collapsed"], help="summary format (append_summary) (default expanded)")
+
+    args = vars(parser.parse_args())
+
+    if args["task"] == "classify":
+        if args["tag_index"] is None or not os.path.isfile(args["tag_index"]):
+            raise tag_lookup_exception("classify requires a tag index (-X)")
+        for folder in (args["output_folder"], args["assignments"]):
+            if folder is None or not os.path.isdir(folder):
+                raise tag_lookup_exception("classify requires existing output (-O) and assignments (-A) folders")
+        args["assignments_folder"] = args["assignments"]
+    elif args["task"] == "append_summary":
+        if len(args["filenames"]) != 1:
+            raise tag_lookup_exception("append_summary takes one summary file")
+        if args["assignments"] is None or not os.path.isfile(args["assignments"]):
+            raise tag_lookup_exception("append_summary requires an assignments file (-A)")
+        args["assignments_file"] = args["assignments"]
+
+    return args
+
+
+def main():
+    options = get_options()
+
+    if options["task"] == "classify":
+        classify(options)
+    elif options["task"] == "append_summary":
+        append_summary(options)
+    else:
+        raise tag_lookup_exception("unsupported task %(task)s" % options)
+
+
+if __name__ == "__main__":
+   main()